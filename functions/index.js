@@ -11,6 +11,7 @@ const db = admin.database();
  * Receive data from pubsub, then
  * Write telemetry raw data to bigquery
  * Maintain last data on firebase realtime database
+ * Payloads are either a json document or a binary batch of samples (see decodeTelemetry)
  */
 exports.receiveTelemetry = functions
 	.region('europe-west1')
@@ -18,32 +19,93 @@ exports.receiveTelemetry = functions
 	.topic('events')
 	.onPublish((message, context) => {
 		const attributes = message.attributes;
-		const payload = message.json;
-
 		const deviceId = attributes['deviceId'];
+		const raw = Buffer.from(message.data, 'base64');
+
+		let rows;
+		if (raw.length > 0 && raw[0] === TELEMETRY_VERSION) {
+			rows = decodeTelemetry(raw).map(sample => ({
+				humidity: sample.humidity,
+				pumpActive: sample.pumpActive,
+				lightActive: sample.lightActive,
+				deviceId: deviceId,
+				timestamp: sample.timestamp.toISOString()
+			}));
+		} else {
+			const payload = message.json;
+			rows = [{
+				humidity: payload.humidity,
+				pumpActive: payload.pump_active,
+				lightActive: payload.light_active,
+				deviceId: deviceId,
+				// sample time (epoch sec.), spooled samples are published after a reconnect
+				timestamp: payload.timestamp !== undefined
+					? new Date(payload.timestamp * 1000).toISOString()
+					: context.timestamp
+			}];
+		}
 
-		const data = {
-			humidity: payload.humidity,
-			pumpActive: payload.pump_active,
-			lightActive: payload.light_active,
-			deviceId: deviceId,
-			timestamp: context.timestamp
-		};
-
-		if (
-			payload.humidity < 0 ||
-			payload.humidity > 100
-		) {
-			// Validate and do nothing
+		// Validate and drop invalid samples
+		rows = rows.filter(data => data.humidity >= 0 && data.humidity <= 100);
+		if (rows.length === 0) {
 			return;
 		}
 
 		return Promise.all([
-			insertIntoBigquery(data),
-			updateCurrentDataFirebase(data)
+			insertIntoBigquery(rows),
+			updateCurrentDataFirebase(rows[rows.length - 1])
 		]);
 	});
 
+const TELEMETRY_VERSION = 1;
+
+/**
+ * Decode a binary telemetry batch, the counterpart of pi/src/telemetry.py. Version 1 layout (little endian):
+ *   uint8   version (1)
+ *   uint32  timestamp of the first sample (epoch sec.)
+ *   uint16  number of samples n
+ *   varint  n-1 timestamp deltas to the previous sample in sec. (unsigned LEB128)
+ *   uint8   n humidity values in %
+ *   uint8   ceil(n/4) flag bytes, 2 bits per sample: bit 2i = pump active, bit 2i+1 = light active
+ */
+function decodeTelemetry(buffer) {
+	const version = buffer.readUInt8(0);
+	if (version !== TELEMETRY_VERSION) {
+		throw new Error(`Unsupported telemetry version ${version}`);
+	}
+	let timestamp = buffer.readUInt32LE(1);
+	const count = buffer.readUInt16LE(5);
+	let pos = 7;
+
+	const timestamps = [timestamp];
+	for (let i = 1; i < count; i++) {
+		let delta = 0;
+		let factor = 1;
+		let byte;
+		do {
+			byte = buffer[pos++];
+			delta += (byte & 0x7f) * factor;
+			factor *= 128;
+		} while (byte >= 0x80);
+		timestamp += delta;
+		timestamps.push(timestamp);
+	}
+
+	const humidityPos = pos;
+	const flagsPos = pos + count;
+	const samples = [];
+	for (let i = 0; i < count; i++) {
+		const flags = buffer[flagsPos + (i >> 2)] >> (2 * (i % 4));
+		samples.push({
+			timestamp: new Date(timestamps[i] * 1000),
+			humidity: buffer[humidityPos + i],
+			pumpActive: (flags & 1) !== 0,
+			lightActive: (flags & 2) !== 0
+		});
+	}
+	return samples;
+}
+
 /**
  * Maintain last status in firebase
  */
@@ -57,7 +119,7 @@ function updateCurrentDataFirebase(data) {
 }
 
 /**
- * Store all the raw data in bigquery
+ * Store all the raw data in bigquery, data is a row or an array of rows
  */
 function insertIntoBigquery(data) {
 	const bigquery = new BigQuery();
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+
+# Analog/digital converter backends for the MCP3008 chip.
+# see https://learn.adafruit.com/reading-a-analog-in-and-controlling-audio-volume-with-the-raspberry-pi/script
+
+from hardware import IN, OUT
+
+# MCP3008 has 8 single-ended input channels (0 thru 7) with 10bit resolution
+ADC_CHANNELS = 8
+ADC_MAX = 1023
+ALL_CHANNELS = tuple(range(ADC_CHANNELS))
+
+
+def checkChannels(channels):
+    """Raise a ValueError if one of the channels is not a valid MCP3008 channel"""
+    for channel in channels:
+        if (channel < 0 or channel >= ADC_CHANNELS):
+            raise ValueError('Invalid adc channel {}, must be 0 thru {}'.format(channel, ADC_CHANNELS - 1))
+
+
+class AdcBackend:
+    """Base class of the MCP3008 backends. A backend reads one or several channels per call:
+    - read(channel): return the raw 10bit value (0-1023) of one channel
+    - scan(channels): return a list with the raw values of all given channels, in the given order
+    - close(): release the underlying hardware resources
+    Subclasses implement scan, read is derived from it.
+    """
+
+    def read(self, channel):
+        """Read the raw value of a single channel"""
+        return self.scan((channel,))[0]
+
+    def scan(self, channels=ALL_CHANNELS):
+        """Read the raw values of several channels in one call"""
+        raise NotImplementedError
+
+    def close(self):
+        """Release hardware resources"""
+
+
+class BitBangAdc(AdcBackend):
+    """Software SPI: bit-bangs the MCP3008 protocol on four GPIO pins. Works on any wiring, but costs
+    ~35 GPIO calls per sample. The command bits of each channel are computed once."""
+
+    def __init__(self, gpio, clockpin, mosipin, misopin, cspin):
+        self.gpio = gpio
+        self.clockpin = clockpin
+        self.mosipin = mosipin
+        self.misopin = misopin
+        self.cspin = cspin
+
+        # set up the SPI interface pins
+        gpio.setup(mosipin, OUT)
+        gpio.setup(misopin, IN)
+        gpio.setup(clockpin, OUT)
+        gpio.setup(cspin, OUT)
+
+        # start bit + single-ended bit + 3 channel bits, MSB first
+        self.commandBits = []
+        for channel in ALL_CHANNELS:
+            commandout = (channel | 0x18) << 3
+            self.commandBits.append(tuple(bool(commandout & (0x80 >> i)) for i in range(5)))
+
+    def scan(self, channels=ALL_CHANNELS):
+        checkChannels(channels)
+        # local names avoid attribute lookups in the bit loops
+        output = self.gpio.output
+        inp = self.gpio.input
+        clockpin = self.clockpin
+        mosipin = self.mosipin
+        misopin = self.misopin
+        cspin = self.cspin
+
+        values = []
+        for channel in channels:
+            output(cspin, True)
+            output(clockpin, False)  # start clock low
+            output(cspin, False)     # bring CS low
+
+            for bit in self.commandBits[channel]:
+                output(mosipin, bit)
+                output(clockpin, True)
+                output(clockpin, False)
+
+            adcout = 0
+            # read in one empty bit, one null bit and 10 ADC bits
+            for i in range(12):
+                output(clockpin, True)
+                output(clockpin, False)
+                adcout <<= 1
+                if (inp(misopin)):
+                    adcout |= 0x1
+
+            output(cspin, True)
+            values.append(adcout >> 1)  # first bit is 'null' so drop it
+        return values
+
+
+class SpiDevAdc(AdcBackend):
+    """Hardware SPI through the spidev kernel driver: one 3-byte block transfer per channel. Requires the
+    MCP3008 to be wired to the SPI0 pins (SCLK, MISO, MOSI, CE0/CE1) and SPI to be enabled in raspi-config.
+    The MCP3008 only starts a new conversion after CS was released, so a scan is a sequence of 3-byte
+    transactions issued from one call rather than a single long transfer."""
+
+    def __init__(self, bus=0, device=0, max_speed_hz=1000000):
+        try:
+            import spidev
+        except ImportError:
+            raise ValueError('adc_backend "spidev" requires the spidev package (pip install spidev)')
+        self.spi = spidev.SpiDev()
+        self.spi.open(bus, device)
+        self.spi.max_speed_hz = max_speed_hz
+        self.spi.mode = 0
+        # start byte, single-ended bit + channel in the upper nibble, padding byte
+        self.commands = [[0x01, (0x08 | channel) << 4, 0x00] for channel in ALL_CHANNELS]
+
+    def scan(self, channels=ALL_CHANNELS):
+        checkChannels(channels)
+        xfer2 = self.spi.xfer2
+        values = []
+        for channel in channels:
+            # xfer2 overwrites its argument with the received bytes, pass a copy
+            reply = xfer2(list(self.commands[channel]))
+            values.append(((reply[1] & 0x03) << 8) | reply[2])
+        return values
+
+    def close(self):
+        self.spi.close()
+
+
+class FakeAdc(AdcBackend):
+    """In-memory backend for machines without a MCP3008. Returns the values set with set(), initially
+    all channels read ADC_MAX / 2."""
+
+    def __init__(self, values=None):
+        self.values = [ADC_MAX // 2] * ADC_CHANNELS
+        if values is not None:
+            for channel, value in enumerate(values):
+                self.set(channel, value)
+
+    def set(self, channel, value):
+        """Set the raw value returned for a channel"""
+        checkChannels((channel,))
+        self.values[channel] = max(0, min(ADC_MAX, int(value)))
+
+    def scan(self, channels=ALL_CHANNELS):
+        checkChannels(channels)
+        values = self.values
+        return [values[channel] for channel in channels]
+
+
+def createAdc(backend, gpio, clockpin, mosipin, misopin, cspin):
+    """Create the adc backend configured by name: bitbang (default, on the pins of the gpio backend), spidev or fake"""
+    if (backend == 'bitbang'):
+        return BitBangAdc(gpio, clockpin, mosipin, misopin, cspin)
+    elif (backend == 'spidev'):
+        return SpiDevAdc()
+    elif (backend == 'fake'):
+        return FakeAdc()
+    raise ValueError('Unknown adc_backend "{}", must be one of bitbang, spidev, fake'.format(backend))
@@ -0,0 +1,275 @@
+#!/usr/bin/env python3
+
+# Benchmarks of the hot paths on simulated hardware (see simulation.py), runs on any Linux box.
+# The results are written as json and compared against a stored baseline, a regression fails the run.
+#
+# usage: python3 benchmark.py [--only tick,config] [--output results.json] [--save-baseline]
+# see python3 benchmark.py --help
+
+import argparse
+import json
+import logging
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+from adc import BitBangAdc
+from clock import VirtualClock
+from device_control import SPICLK, SPICS, SPIMISO, SPIMOSI, DeviceControl, zoneConfigs
+from hardware import SimulatedGpio
+from logs import ROOT, RingBufferHandler, applyLevels
+from providers import ConfigurationProvider, DataProvider, thaw
+from simulation import FakeMqttClient, SoilMoistureModel, StaticCredentials
+
+DEFAULT_CONFIG = '../resources/wassermat.json'
+DEFAULT_BASELINE = '../resources/benchmark_baseline.json'
+# metrics ending with one of these suffixes are better if higher, all others (latencies, memory) if lower
+HIGHER_IS_BETTER = ('_per_sec',)
+# metrics (or benchmark.metric) reported but not compared: too noisy on a shared machine, resp. bound by the fsync
+# latency of the storage rather than by the code
+NOT_COMPARED = ('max_us', 'config.write_per_sec')
+
+
+def percentile(values, p):
+    """p-th percentile (0..1) of sorted values"""
+    return values[min(len(values) - 1, int(p * len(values)))]
+
+
+def rate(count, fn):
+    """Call fn() count times, return the calls per second"""
+    start = time.perf_counter()
+    for i in range(count):
+        fn()
+    return count / (time.perf_counter() - start)
+
+
+def latencies(count, fn):
+    """Call fn() count times, return mean, p50, p99 and max latency in microseconds"""
+    samples = []
+    timer = time.perf_counter
+    for i in range(count):
+        start = timer()
+        fn()
+        samples.append((timer() - start) * 1e6)
+    samples.sort()
+    return {'mean_us': sum(samples) / len(samples), 'p50_us': percentile(samples, 0.5),
+            'p99_us': percentile(samples, 0.99), 'max_us': samples[-1]}
+
+
+class Bench:
+    """Environment of the benchmarks: a copy of the config in a temporary directory, spool inside it, no history"""
+
+    def __init__(self, configFile, quick=False):
+        self.directory = tempfile.mkdtemp(prefix='wassermat-bench-')
+        self.scale = 0.1 if quick else 1.0
+        with open(configFile) as f:
+            config = json.load(f)
+        config['spool_dir'] = os.path.join(self.directory, 'spool')
+        config['history_dir'] = None
+        self.cfgFile = os.path.join(self.directory, 'wassermat.json')
+        with open(self.cfgFile, 'w') as f:
+            json.dump(config, f)
+        self.configuration = ConfigurationProvider(self.cfgFile)
+        # log levels of the config, the lines go to a ring buffer which is never written
+        root = logging.getLogger(ROOT)
+        root.propagate = False
+        root.addHandler(RingBufferHandler())
+        applyLevels(self.configuration.snapshot)
+
+    def count(self, n):
+        return max(10, int(n * self.scale))
+
+    def deviceControl(self, adc=None):
+        clock = VirtualClock(time.time())
+        gpio = SimulatedGpio()
+        if adc is None:
+            adc = SoilMoistureModel(clock, gpio, zoneConfigs(self.configuration.snapshot))
+        data = DataProvider(self.configuration.getParam('data_buffer_size'), clock=clock)
+        return DeviceControl(data, self.configuration, threading.Event(), adc=adc, gpio=gpio, clock=clock), clock
+
+    def readadc(self):
+        """DeviceControl.readadc through the bit-banged MCP3008 protocol on simulated pins"""
+        gpio = SimulatedGpio()
+        control, clock = self.deviceControl(BitBangAdc(gpio, SPICLK, SPIMOSI, SPIMISO, SPICS))
+        return {'calls_per_sec': rate(self.count(20000), lambda: control.readadc(0))}
+
+    def tick(self):
+        """One iteration of DeviceControl.run(): sensor scan, filters, schedules, data provider update"""
+        control, clock = self.deviceControl()
+        control.step()
+        result = latencies(self.count(20000), lambda: clock.sleep(control.step()))
+        # tracing slows the allocations down, measure the memory in a separate pass
+        tracemalloc.start()
+        for i in range(self.count(2000)):
+            clock.sleep(control.step())
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        result['traced_peak_bytes'] = peak
+        return result
+
+    def dataProvider(self):
+        """setData and getData from two threads at the same time"""
+        data = DataProvider(self.configuration.getParam('data_buffer_size'))
+        count = self.count(200000)
+        gets = [0]
+        done = threading.Event()
+
+        def reader():
+            while not done.is_set():
+                data.getData(statistics=True)
+                gets[0] += 1
+
+        thread = threading.Thread(target=reader)
+        start = time.perf_counter()
+        thread.start()
+        for i in range(count):
+            data.setData(50.0 + (i % 7), i % 2 == 0, False)
+        elapsed = time.perf_counter() - start
+        done.set()
+        thread.join()
+        return {'set_per_sec': count / elapsed, 'get_per_sec': gets[0] / elapsed}
+
+    def config(self):
+        """getParam on the current snapshot, write of a changed config (validation, fsync'ed file, subscribers)"""
+        configuration = self.configuration
+        result = {'get_param_per_sec': rate(self.count(500000), lambda: configuration.getParam('watering_threshold'))}
+        config = thaw(configuration.snapshot)
+        values = [config['watering_threshold'], config['watering_threshold'] + 1]
+        counter = [0]
+
+        def write():
+            counter[0] += 1
+            config['watering_threshold'] = values[counter[0] % 2]
+            configuration.write(config)
+
+        result['write_per_sec'] = rate(self.count(500), write)
+        return result
+
+    def publish(self):
+        """GcpIotClient payload encoding and spool to broker publishing against the stand-in broker"""
+        from gcp_iot_client import GcpIotClient
+
+        clock = VirtualClock(time.time())
+        client = FakeMqttClient(clock, latency=0.0)
+        data = DataProvider(clock=clock)
+        stopEvent = threading.Event()
+        iot = GcpIotClient(data, self.configuration, stopEvent, clock=clock, clientFactory=lambda clientId: client,
+                           credentials=StaticCredentials())
+        result = {}
+        try:
+            sample = {'humidity': 48.5, 'pump_active': False, 'light_active': True}
+            result['encode_json_per_sec'] = rate(self.count(50000), lambda: iot.encode_sample(clock.time(), sample))
+
+            mqttClient = iot.get_client('project', 'region', 'registry', 'device', StaticCredentials(), None,
+                                        'localhost', 1883)
+            iot.publisher.attach(mqttClient)
+            client.loop(0)
+            count = self.count(20000)
+            payload = json.dumps(sample).encode('utf-8')
+            start = time.perf_counter()
+            for i in range(count):
+                iot.spool.append(payload)
+            appended = time.perf_counter()
+            while len(client.messages) < count:
+                iot.publish_spooled('/devices/device/events')
+                iot.publisher.retransmitExpired()
+                client.loop(1.0)
+            end = time.perf_counter()
+            result['spool_append_per_sec'] = count / (appended - start)
+            result['publish_per_sec'] = count / (end - appended)
+        finally:
+            iot.spool.close()
+        return result
+
+    def close(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+BENCHMARKS = ('readadc', 'tick', 'dataProvider', 'config', 'publish')
+
+
+def best(runs):
+    """Combine the results of several runs of a benchmark: the best value of each metric, which is the least
+    disturbed by other processes"""
+    result = {}
+    for metric in runs[0]:
+        values = [run[metric] for run in runs]
+        result[metric] = max(values) if metric.endswith(HIGHER_IS_BETTER) else min(values)
+    return result
+
+
+def compare(results, baseline, tolerance):
+    """Return the list of regressions: metrics worse than the baseline by more than tolerance (0..1)"""
+    regressions = []
+    for name, metrics in sorted(results.items()):
+        for metric, value in sorted(metrics.items()):
+            expected = baseline.get(name, {}).get(metric)
+            if not expected or metric in NOT_COMPARED or '{}.{}'.format(name, metric) in NOT_COMPARED:
+                continue
+            if metric.endswith(HIGHER_IS_BETTER):
+                worse = value < expected * (1 - tolerance)
+            else:
+                worse = value > expected * (1 + tolerance)
+            if worse:
+                regressions.append('{}.{}: {:.1f} (baseline {:.1f})'.format(name, metric, value, expected))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the wassermat hot paths on simulated hardware')
+    parser.add_argument('--config', default=DEFAULT_CONFIG, help='config file (default %(default)s)')
+    parser.add_argument('--only', default=None, help='comma separated benchmarks, of ' + ', '.join(BENCHMARKS))
+    parser.add_argument('--output', default=None, help='write the results to this json file')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE, help='baseline json file (default %(default)s)')
+    parser.add_argument('--save-baseline', action='store_true', help='store the results as new baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='allowed relative regression against the baseline (default %(default)s)')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='runs per benchmark, the best value of each metric is kept (default %(default)s)')
+    parser.add_argument('--quick', action='store_true', help='10%% of the iterations, for smoke tests')
+    args = parser.parse_args(argv)
+
+    names = BENCHMARKS if args.only is None else [name.strip() for name in args.only.split(',')]
+    for name in names:
+        if name not in BENCHMARKS:
+            parser.error('Unknown benchmark "{}"'.format(name))
+
+    bench = Bench(args.config, args.quick)
+    results = {}
+    try:
+        for name in names:
+            results[name] = best([getattr(bench, name)() for i in range(args.repeat)])
+            print('{}: {}'.format(name, ', '.join('{} {:.1f}'.format(k, v) for k, v in sorted(results[name].items()))))
+    finally:
+        bench.close()
+    # kB on Linux
+    results['process'] = {'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, sort_keys=True, indent=4)
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, sort_keys=True, indent=4)
+        print('Baseline saved to {}'.format(args.baseline))
+        return 0
+
+    if not os.path.isfile(args.baseline):
+        print('No baseline {}, run with --save-baseline first'.format(args.baseline))
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    regressions = compare(results, baseline, args.tolerance)
+    for regression in regressions:
+        print('REGRESSION ' + regression)
+    print('{} regression(s) against {}'.format(len(regressions), args.baseline))
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
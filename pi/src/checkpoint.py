@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+
+# Warm state checkpoint: controller and publisher state survive a restart of the process.
+
+import json
+import os
+import threading
+import time
+
+from clock import SystemClock
+from logs import getLogger
+
+log = getLogger('checkpoint')
+
+VERSION = 1
+
+
+class Checkpoint(threading.Thread):
+    """Small json file with the state of the components, written by a background thread every 'interval' sec. if
+    the state changed, and soon after touch() (eg. when a pump switched), so the callers never wait for the disk.
+    An unchanged state is written again once the last write is maxAge / 2 sec. old, so a state which is still valid
+    after a long stable period is not discarded on the next start.
+    The file is replaced atomically (temporary file, fsync, rename).
+    - load(): read the file of the previous run, state older than 'maxAge' sec. is ignored
+    - restored(name): the section of a component from the previous run, None if there is none
+    - register(name, function): function() returns the current state (json types) of a component
+    - save(): write the current state now, eg. on shutdown
+    """
+
+    def __init__(self, path, stopEvent, interval=30.0, maxAge=600.0, clock=time.time):
+        super(Checkpoint, self).__init__(name='Checkpoint')
+        self.daemon = True
+        self.path = path
+        self.stopEvent = stopEvent
+        self.interval = interval
+        self.maxAge = maxAge
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.sections = {}
+        self.previous = {}
+        self.written = None
+        self.writtenAt = None
+        self.wakeup = threading.Event()
+
+    def load(self):
+        """Load the state of the previous run, returns its age in sec. or None if there is no usable state"""
+        try:
+            with open(self.path) as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            log.warning('Ignoring unreadable checkpoint %s: %s', self.path, e)
+            return None
+        age = self.clock() - state.get('saved', 0)
+        if state.get('version') != VERSION or age > self.maxAge or age < -60:
+            log.info('Ignoring checkpoint %s saved %.0fs ago', self.path, age)
+            return None
+        self.previous = state.get('sections', {})
+        log.info('Restoring checkpoint saved %.1fs ago', age)
+        return age
+
+    def restored(self, name):
+        return self.previous.get(name)
+
+    def register(self, name, function):
+        with self.lock:
+            self.sections[name] = function
+
+    def touch(self):
+        """State changed in a way which should survive a crash, save soon"""
+        self.wakeup.set()
+
+    def collect(self):
+        with self.lock:
+            sections = list(self.sections.items())
+        return dict((name, function()) for name, function in sections)
+
+    def save(self):
+        """Write the current state if it changed since the last write or the last write is getting old"""
+        sections = self.collect()
+        now = self.clock()
+        if sections == self.written and now - self.writtenAt < self.maxAge / 2:
+            return False
+        tmpFile = self.path + '.tmp'
+        with open(tmpFile, 'w') as f:
+            json.dump({'version': VERSION, 'saved': now, 'sections': sections}, f, sort_keys=True)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmpFile, self.path)
+        self.written = sections
+        self.writtenAt = now
+        return True
+
+    def run(self):
+        # a stop ends the wait at once, the final state is saved right away
+        SystemClock().callWhenSet(self.stopEvent, self.wakeup.set)
+        while not self.stopEvent.is_set():
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            try:
+                self.save()
+            except (OSError, ValueError) as e:
+                log.warning('Checkpoint not saved: %s', e)
+        self.save()
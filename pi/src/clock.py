@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+
+# Clocks: the system clock, or a virtual clock for simulations.
+
+import heapq
+import itertools
+import threading
+import time
+
+
+class SystemClock:
+    """Wall clock time and real sleeps"""
+
+    def time(self):
+        return time.time()
+
+    def monotonic(self):
+        return time.monotonic()
+
+    def sleep(self, secs):
+        time.sleep(secs)
+
+    def wait(self, event, timeout):
+        """Wait until the event is set or the timeout expired, returns True if the event is set"""
+        return event.wait(timeout)
+
+    def callWhenSet(self, event, callback):
+        """Call callback() from a daemon thread once the event is set, eg. to wake up a wait on another event"""
+        def waiter():
+            event.wait()
+            callback()
+        threading.Thread(target=waiter, name='CallWhenSet', daemon=True).start()
+
+
+class VirtualClock:
+    """Simulated time for single threaded simulations. Time only advances by sleep() (or wait() on an event which
+    is not set). Callbacks registered with callAt() run when the time passes their due time, in time order, with
+    the clock set to their due time; a callback must not sleep itself.
+    """
+
+    def __init__(self, start=0.0):
+        self.now = float(start)
+        self.timers = []
+        self.sequence = itertools.count()
+
+    def time(self):
+        return self.now
+
+    def monotonic(self):
+        return self.now
+
+    def callAt(self, ts, callback):
+        """Run callback() when the time reaches ts"""
+        heapq.heappush(self.timers, (ts, next(self.sequence), callback))
+
+    def callLater(self, delay, callback):
+        self.callAt(self.now + delay, callback)
+
+    def sleep(self, secs):
+        """Advance the time by secs, running the callbacks due until then"""
+        target = self.now + max(0.0, secs)
+        while self.timers and self.timers[0][0] <= target:
+            ts, unused_sequence, callback = heapq.heappop(self.timers)
+            self.now = max(self.now, ts)
+            callback()
+        self.now = target
+
+    def wait(self, event, timeout):
+        """Advance the time until the event is set by a callback or the timeout expired"""
+        target = self.now + max(0.0, timeout if timeout is not None else 0.0)
+        while not event.is_set() and self.timers and self.timers[0][0] <= target:
+            self.sleep(self.timers[0][0] - self.now)
+        if not event.is_set():
+            self.now = max(self.now, target)
+        return event.is_set()
+
+    def callWhenSet(self, event, callback):
+        """Nothing to do: single threaded, events are set by callbacks and every wait() checks its event"""
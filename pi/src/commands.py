@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+
+# Commands received on the mqtt commands topic: manual pump runs, light overrides and immediate reports.
+
+import collections
+import json
+import os
+import socket
+import threading
+
+from logs import getLogger
+from metrics import REGISTRY
+from providers import COMMAND_SCHEMAS, thaw, validate
+
+log = getLogger('commands')
+
+# commands executed by DeviceControl
+DEVICE_COMMANDS = ('pump', 'light', 'report')
+# number of idempotency keys remembered
+KEEP_IDS = 256
+
+
+class CommandDispatcher:
+    """Validates command messages and calls the handlers registered for the command with the validated arguments
+    (a ConfigSnapshot, see COMMAND_SCHEMAS). A message is a json object with the command name in 'command' or in
+    the subfolder of the topic (/devices/<id>/commands/<command>), eg.
+    {"command": "pump", "zone": "default", "seconds": 30, "id": "a1"}
+    A message with the 'id' of one of the last KEEP_IDS commands is a repetition (eg. sent again by the cloud after
+    a timeout) and ignored. Used by the thread receiving the messages only."""
+
+    def __init__(self, registry=None):
+        self.registry = registry if registry is not None else REGISTRY
+        # command name -> handlers
+        self.handlers = collections.defaultdict(list)
+        self.seen = collections.OrderedDict()
+
+    def register(self, name, handler):
+        """Call handler(args) for every command 'name'"""
+        if name not in COMMAND_SCHEMAS:
+            raise ValueError('Unknown command "{}"'.format(name))
+        self.handlers[name].append(handler)
+
+    def forward(self, target, names=DEVICE_COMMANDS):
+        """Pass the commands 'names' to target.submit(name, args), eg. DeviceControl or a CommandSender"""
+        for name in names:
+            self.register(name, lambda args, name=name: target.submit(name, args))
+
+    def count(self, name, result):
+        self.registry.counter('wassermat_commands_total', 'Commands received by result',
+                              {'command': name, 'result': result}).inc()
+
+    def dispatch(self, payload, subfolder=None):
+        """Handle a command message, returns True if it was executed"""
+        name = subfolder
+        try:
+            message = json.loads(payload.decode('utf-8')) if payload else {}
+            if not isinstance(message, dict):
+                raise ValueError('not a json object')
+            name = message.pop('command', None) or subfolder
+            if name not in COMMAND_SCHEMAS:
+                raise ValueError('unknown command {!r}'.format(name))
+            args = validate(message, COMMAND_SCHEMAS[name])
+        except (UnicodeDecodeError, ValueError) as e:
+            log.error('Command rejected: %s / payload=%s', e, payload)
+            self.count(name if name in COMMAND_SCHEMAS else 'unknown', 'rejected')
+            return False
+
+        if args.id is not None:
+            if args.id in self.seen:
+                log.info('Command %s %s already received, ignored', name, args.id)
+                self.count(name, 'duplicate')
+                return False
+            self.seen[args.id] = True
+            if len(self.seen) > KEEP_IDS:
+                self.seen.popitem(last=False)
+
+        handlers = self.handlers.get(name)
+        if not handlers:
+            log.warning('Command %s not handled', name)
+            self.count(name, 'unhandled')
+            return False
+        log.info('Command %s %s', name, dict(args))
+        for handler in handlers:
+            handler(args)
+        self.count(name, 'executed')
+        return True
+
+
+class CommandSender:
+    """Passes device commands from the publisher to the sampler process (see processes.py) as datagrams on the
+    unix socket 'path', same interface as DeviceControl.submit()"""
+
+    def __init__(self, path):
+        self.path = path
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+
+    def submit(self, name, args):
+        try:
+            self.socket.sendto(json.dumps([name, thaw(args)]).encode('utf-8'), self.path)
+        except OSError as e:
+            # sampler not running (restarting), the command is lost
+            log.error('Command %s not passed to the sampler: %s', name, e)
+
+    def close(self):
+        self.socket.close()
+
+
+class CommandReceiver(threading.Thread):
+    """Receives the commands of a CommandSender in the sampler process and submits them to DeviceControl"""
+
+    def __init__(self, path, device, stopEvent):
+        super(CommandReceiver, self).__init__(name='CommandReceiver')
+        self.daemon = True
+        self.path = path
+        self.device = device
+        self.stopEvent = stopEvent
+        if os.path.exists(path):
+            os.unlink(path)
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.socket.bind(path)
+        # checks the stop event in between
+        self.socket.settimeout(0.5)
+
+    def run(self):
+        while not self.stopEvent.is_set():
+            try:
+                data = self.socket.recv(65536)
+            except socket.timeout:
+                continue
+            try:
+                name, args = json.loads(data.decode('utf-8'))
+                self.device.submit(name, validate(args, COMMAND_SCHEMAS[name]))
+            except (KeyError, TypeError, ValueError) as e:
+                log.error('Invalid command from the publisher: %s / %s', e, data)
+        self.socket.close()
+        os.unlink(self.path)
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+
+# Factories of the components shared by the execution modes (threads, processes and asyncio), configured by the
+# config values. Kept out of wassermat.py: importing the entry script would run it a second time as a module.
+
+from checkpoint import Checkpoint
+from metrics import MetricsServer
+from statusserver import StatusServer
+from timeseries import TimeSeriesStore
+
+
+def createCheckpoint(configuration, stopEvent, process=None):
+    """Checkpoint of the config (None if not configured) with the state of the previous run loaded. In process mode
+    the sampler has its own file, each file is written by one process"""
+    if not configuration.getParam('checkpoint_file'):
+        return None
+    path = configuration.getParam('checkpoint_file')
+    if process is not None:
+        path = '{}.{}'.format(path, process)
+    checkpoint = Checkpoint(path, stopEvent, interval=configuration.getParam('checkpoint_interval'),
+                            maxAge=configuration.getParam('checkpoint_max_age'))
+    checkpoint.load()
+    return checkpoint
+
+
+def createStore(configuration, stopEvent):
+    """History store of the config, None if not configured"""
+    if not configuration.getParam('history_dir'):
+        return None
+    return TimeSeriesStore(configuration.getParam('history_dir'), stopEvent, retention={
+        'raw': configuration.getParam('history_retention_raw_days'),
+        'minute': configuration.getParam('history_retention_minute_days'),
+        'hour': configuration.getParam('history_retention_hour_days'),
+        'day': configuration.getParam('history_retention_day_days')})
+
+
+def startMetricsServer(configuration, process=None):
+    """Started metrics server of the config, None if not configured. A child process other than the publisher
+    serves on the next port, resp. on <metrics_socket>.<process>"""
+    port = configuration.getParam('metrics_port')
+    socketPath = configuration.getParam('metrics_socket')
+    if port is None and not socketPath:
+        return None
+    if process is not None:
+        port = port + 1 if port is not None else None
+        socketPath = '{}.{}'.format(socketPath, process) if socketPath else None
+    metricsServer = MetricsServer(host=configuration.getParam('metrics_bind'), port=port, socketPath=socketPath)
+    metricsServer.start()
+    return metricsServer
+
+
+def startStatusServer(configuration, data, store):
+    """Started LAN status server of the config, None if not configured"""
+    if configuration.getParam('lan_port') is None:
+        return None
+    statusServer = StatusServer(data, store, host=configuration.getParam('lan_bind'),
+                                port=configuration.getParam('lan_port'),
+                                historyRefresh=configuration.getParam('lan_history_refresh'))
+    statusServer.start()
+    return statusServer
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+
+# JWT credentials for the Google Cloud IoT Core mqtt bridge.
+
+import datetime
+import threading
+import time
+
+from logs import getLogger
+
+log = getLogger('credentials')
+
+
+class CredentialManager:
+    """Provides the JWT used as mqtt password. The private key is read and parsed once. Tokens expire after
+    'expiresMinutes', the next token is signed in a background timer 'presignSeconds' before the current one is
+    due for refresh, so neither rotate() nor the publish path waits for the RSA signature.
+    A token is due for refresh 'marginSeconds' before it expires, rotate() then switches the password of the
+    existing client and reconnects it once.
+    jwt and cryptography are imported on construction, they take seconds to load on a Pi.
+    """
+
+    def __init__(self, project_id, private_key_file, algorithm, expiresMinutes=20, marginSeconds=60,
+                 presignSeconds=60):
+        self.project_id = project_id
+        self.algorithm = algorithm
+        self.expires = datetime.timedelta(minutes=expiresMinutes)
+        self.margin = datetime.timedelta(seconds=marginSeconds)
+        self.presignSeconds = presignSeconds
+        self.lock = threading.Lock()
+        self.timer = None
+
+        from cryptography.hazmat.backends import default_backend
+        from cryptography.hazmat.primitives import serialization
+
+        # Read and parse the private key file once.
+        with open(private_key_file, 'rb') as f:
+            self.private_key = serialization.load_pem_private_key(f.read(), password=None, backend=default_backend())
+        log.info('Loaded %s private key from file %s', algorithm, private_key_file)
+
+        self.current = self.sign()
+        self.next = None
+        self.schedulePresign()
+
+    def sign(self):
+        """Sign a new token, returns (token, expiry time)"""
+        import jwt
+        iat = datetime.datetime.utcnow()
+        exp = iat + self.expires
+        token = {
+            # The time that the token was issued at
+            'iat': iat,
+            # The time the token expires.
+            'exp': exp,
+            # The audience field should always be set to the GCP project id.
+            'aud': self.project_id
+        }
+        return (jwt.encode(token, self.private_key, algorithm=self.algorithm), exp)
+
+    def token(self):
+        """The current token"""
+        return self.current[0]
+
+    def refreshDue(self):
+        """True if the current token expires within the margin"""
+        return datetime.datetime.utcnow() >= self.current[1] - self.margin
+
+    def schedulePresign(self):
+        """Sign the next token in the background shortly before the current one is due"""
+        self.cancel()
+        due = self.current[1] - self.margin - datetime.datetime.utcnow()
+        delay = max(0.0, due.total_seconds() - self.presignSeconds)
+        self.timer = threading.Timer(delay, self.presign)
+        self.timer.daemon = True
+        self.timer.start()
+
+    def presign(self):
+        nextToken = self.sign()
+        with self.lock:
+            self.next = nextToken
+
+    def rotate(self, client):
+        """Switch the client to the next token with a single reconnect, the socket of the old session is closed.
+        Raises OSError if the reconnect fails, the client then retries with the new token."""
+        with self.lock:
+            nextToken = self.next
+            self.next = None
+        if nextToken is None or datetime.datetime.utcnow() >= nextToken[1] - self.margin:
+            # presign did not run yet (eg. after a suspend), or its token is due itself (eg. after a long outage)
+            nextToken = self.sign()
+        self.current = nextToken
+        self.schedulePresign()
+        client.username_pw_set(username='unused', password=self.token())
+        start = time.time()
+        client.reconnect()
+        log.info('Credentials rotated, reconnected in %.3fs', time.time() - start)
+
+    def cancel(self):
+        """Stop the presign timer"""
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
@@ -1,28 +1,34 @@
 #!/usr/bin/env python3
 
-import RPi.GPIO as GPIO
-import time
+import asyncio
+import collections
 import datetime
+import logging
 import random
 import threading
+import time
+
+from adc import createAdc
+from clock import SystemClock
+from hardware import HIGH, LOW, OUT, createGpio
+from logs import getLogger
+from metrics import REGISTRY
+from filters import FilterBank, burstMedian
+from polling import AdaptivePoller
+from scheduler import Scheduler, parseStarts, parseWindows
+
+log = getLogger('device')
 
 # GPIO SETUP
+# pins of the default zone, used if no zones are configured
 GPIO_PUMP = 8
 GPIO_LIGHT = 22
-GPIO.setmode(GPIO.BCM)
-GPIO.setwarnings(False)
-GPIO.setup(GPIO_PUMP, GPIO.OUT)
-GPIO.setup(GPIO_LIGHT, GPIO.OUT)
-
-PUMP_ON = GPIO.LOW
-PUMP_OFF = GPIO.HIGH
-LIGHT_ON = GPIO.HIGH
-LIGHT_OFF = GPIO.LOW
 
 # HIGH is off, LOW is on
-GPIO.output(GPIO_PUMP, PUMP_OFF)
-# HIGH is off, LOW is on
-GPIO.output(GPIO_LIGHT, LIGHT_OFF)
+PUMP_ON = LOW
+PUMP_OFF = HIGH
+LIGHT_ON = HIGH
+LIGHT_OFF = LOW
 
 # --- sensor SPI configuration (MCP3008) ---
 # see https://learn.adafruit.com/reading-a-analog-in-and-controlling-audio-volume-with-the-raspberry-pi/script
@@ -33,195 +39,491 @@ SPIMISO = 23
 SPIMOSI = 24
 SPICS = 25
 
-# set up the SPI interface pins
-GPIO.setup(SPIMOSI, GPIO.OUT)
-GPIO.setup(SPIMISO, GPIO.IN)
-GPIO.setup(SPICLK, GPIO.OUT)
-GPIO.setup(SPICS, GPIO.OUT)
-
-# humidity sensor connected to adc #0
+# humidity sensor of the default zone connected to adc #0
 sensor_adc = 0;
 
 # --- END sensor SPI configuration (MCP3008) ---
-def startLight():
-    GPIO.output(GPIO_LIGHT, LIGHT_ON)
 
-def stopLight():
-    GPIO.output(GPIO_LIGHT, LIGHT_OFF)
+# config values a zone inherits from the top level config unless it sets them itself
+ZONE_PARAMS = ('watering_scheme', 'watering_threshold', 'watering_threshold_lag', 'watering_start',
+               'watering_duration', 'lightning_start', 'lightning_end', 'lightning_windows',
+               'sensor_filter', 'sensor_filter_window', 'sensor_filter_alpha', 'sensor_hampel_sigmas',
+               'sensor_calibration')
+
+
+def timeStr(ts):
+    """Format an epoch timestamp as local time of day"""
+    return str(datetime.datetime.fromtimestamp(ts).time())
+
+
+class Zone:
+    """Config and state of one zone: a humidity sensor on an adc channel, a pump and an optional light"""
+    __slots__ = ('name', 'channel', 'pumpGpio', 'lightGpio', 'config',
+                 'humidity', 'pumpActivated', 'lightActivated', 'humRaisedAbove', 'humRaisedBelow')
 
-def startPump():
-    GPIO.output(GPIO_PUMP, PUMP_ON)
+    def __init__(self, name, channel, pumpGpio, lightGpio, config, now):
+        self.name = name
+        self.channel = channel
+        self.pumpGpio = pumpGpio
+        self.lightGpio = lightGpio
+        # effective watering/lightning config values (see ZONE_PARAMS)
+        self.config = config
+        self.humidity = 0
+        self.pumpActivated = False
+        self.lightActivated = False
+        self.humRaisedAbove = now
+        self.humRaisedBelow = now
+
+
+def zoneConfigs(config):
+    """Return the effective config dicts of the configured zones, the default zone if there are none"""
+    zones = config.get('zones')
+    if not zones:
+        zones = [{'name': 'default', 'adc_channel': sensor_adc, 'pump_gpio': GPIO_PUMP, 'light_gpio': GPIO_LIGHT}]
+    result = []
+    for zone in zones:
+        effective = {param: config.get(param) for param in ZONE_PARAMS}
+        effective.update(zone)
+        result.append(effective)
+    return result
 
-def stopPump():
-    GPIO.output(GPIO_PUMP, PUMP_OFF)
 
 class DeviceControl(threading.Thread):
-    """The device control object polls the humidity sensor and controls pump and light activity based on these config values:
+    """The device control object polls the humidity sensors and controls pump and light activity of one or several
+    zones based on these config values:
 	- device_poll_interval: poll interval in sec. (eg. 50ms -> 0.05)
+	- device_poll_mode: fixed (default) polls every device_poll_interval, adaptive polls every device_poll_interval
+	  near decisions and backs off up to device_poll_interval_max sec. otherwise (see polling.py)
 	- watering_scheme: fixed or dynamic (see below)
 	- watering_threshold: if watering_scheme is fix: watering is skipped if humidity is above this % level
 	                      if watering_scheme is dynamic: water pump is activated when humidity level falls below this % value
 	- watering_threshold_lag: humidity level must stay below the threshold for sec. before watering starts (dynamic scheme only)
-	- watering_start: watering starts at this time in format hh:mi (fixed scheme only)
+	- watering_start: watering starts at this time in format hh:mi, several start times separated by comma (fixed scheme only)
 	- watering_duration: watering duration in sec. (fixed scheme only)
 	- lightning_start: ightning start time in format hh:mm
-	- lightning_end: lightning end time in format hh:mm
+	- lightning_end: lightning end time in format hh:mm, an end before the start ends on the next day
+	- lightning_windows: optional, several lightning windows hh:mm-hh:mm separated by comma, replaces lightning_start/end
+	- adc_backend: MCP3008 access, bitbang (default), spidev or fake (see adc.py)
+	- gpio_backend: rpi (default) or simulated (see hardware.py)
+	- sensor_oversample: number of adc scans per poll, the median of the burst is used (default 1)
+	- sensor_calibration: optional list of [raw adc value, humidity %] points, interpolated linearly (default raw / 10.24)
+	- sensor_filter: none (default), median, ema or hampel filter of the calibrated values (see filters.py), with
+	  sensor_filter_window (values, median and hampel), sensor_filter_alpha (ema) and sensor_hampel_sigmas (hampel)
+	- zones: optional list of zones, each with name, adc_channel, pump_gpio, light_gpio (optional) and any of the
+	         watering, lightning and sensor values above (except sensor_oversample) to override them for the zone. Without zones, one zone with the
+	         sensor on sensor_adc, pump on GPIO_PUMP and light on GPIO_LIGHT is controlled
+	Light and fixed scheme pump transitions are compiled into a timer heap (see scheduler.py) when their config changes.
+	All zone sensors are read with one adc scan per poll.
+	gpio, adc and clock are created from the config (real time) unless given, eg. by the simulation (see simulation.py).
+	gpio and adc are initialized on the first poll, not on construction.
+	With a checkpoint (see checkpoint.py), pump and light state and the threshold crossing times of each zone are
+	restored from the previous run, so a restart neither restarts the lag window nor switches a running pump off.
+	The poll interval, its lateness against the planned poll time, the poll and adc read durations are published as
+	metrics (see metrics.py).
+	Commands (see commands.py) are queued by submit() from any thread and executed by the next poll, which starts at
+	once: the wait between two polls ends on a command, a config change and on stopEvent. A manual pump run or a
+	timed light override holds its output until it expires (scheduled transitions and the dynamic scheme leave it
+	alone meanwhile), then the output returns to its scheduled state. A light override without duration ends with
+	the next scheduled transition. A config change ends all manual pump runs and overrides.
+	In the asyncio runtime (see eventloop.py) runAsync() replaces the thread: each poll runs in an executor thread
+	(gpio and adc block), the wait in between is a task waiting on 'wakeup' (a LoopEvent).
     """
 
-    def __init__(self, dataProvider, configurationProvider, stopEvent):
+    def __init__(self, dataProvider, configurationProvider, stopEvent, adc=None, gpio=None, clock=None, registry=None,
+                 checkpoint=None, wakeup=None):
         super(DeviceControl, self).__init__()
         self.stopEvent = stopEvent
         self.dataProvider = dataProvider
         self.configurationProvider = configurationProvider
+        self.clock = clock if clock is not None else SystemClock()
+        # created by initHardware() unless given
+        self.gpio = gpio
+        self.adc = adc
+
+        # zone name -> state of the previous run, used when the zone is built the first time
+        self.checkpoint = checkpoint
+        self.restored = {}
+        if checkpoint is not None:
+            self.restored = dict((checkpoint.restored('device') or {}).get('zones', {}))
+            checkpoint.register('device', self.checkpointState)
+
+        # light and fixed scheme pump transitions, compiled again when the config changes
+        self.scheduler = Scheduler()
+        self.zones = []
+        # adc channels read on every poll, index of each zone's channel in the scan
+        self.channels = ()
+        self.zoneChannels = []
+        self.filters = None
+        self.poller = AdaptivePoller()
+        self.zonesDirty = True
+        # (command name, args) submitted by other threads
+        self.commands = collections.deque()
+        # (zone name, 'pump' or 'light') -> end of the manual run or override, None until the next transition
+        self.overrides = {}
+        # ends the wait for the next poll
+        self.wakeup = wakeup if wakeup is not None else threading.Event()
+        configurationProvider.subscribe(self.onConfigChange)
+
+        registry = registry if registry is not None else REGISTRY
+        self.tickInterval = registry.histogram('wassermat_tick_interval_seconds', 'Time between the start of two polls',
+                                               lowest=1e-3, highest=1e4)
+        self.tickPlanned = registry.histogram('wassermat_tick_planned_seconds', 'Configured (planned) poll interval',
+                                              lowest=1e-3, highest=1e4)
+        self.tickLateness = registry.histogram('wassermat_tick_lateness_seconds', 'Poll start after its planned time',
+                                               lowest=1e-5, highest=1e3)
+        self.tickDuration = registry.histogram('wassermat_tick_duration_seconds', 'Duration of one poll',
+                                               lowest=1e-6, highest=10.0)
+        self.adcRead = registry.histogram('wassermat_adc_read_seconds', 'Duration of the adc reads of one poll',
+                                          lowest=1e-6, highest=10.0)
+        # start and planned start of the previous poll, clock time
+        self.lastTick = None
+        self.plannedTick = None
+
+    def onConfigChange(self, snapshot):
+        """Config subscriber, called from the thread writing the config"""
+        self.zonesDirty = True
+        self.wakeup.set()
+
+    def submit(self, name, args):
+        """Queue a command (see commands.py) for the next poll and start it now, thread-safe"""
+        self.commands.append((name, args))
+        self.wakeup.set()
+
+    def initHardware(self):
+        """Create gpio and adc backends of the config if not done yet"""
+        if self.gpio is None:
+            self.gpio = createGpio(self.configurationProvider.getParam('gpio_backend'))
+        if self.adc is None:
+            self.adc = createAdc(self.configurationProvider.getParam('adc_backend'), self.gpio,
+                                 SPICLK, SPIMOSI, SPIMISO, SPICS)
+
+    def checkpointState(self):
+        """State of the zones for the checkpoint, called from the checkpoint thread"""
+        return {'zones': dict((zone.name, {
+            'pump_gpio': zone.pumpGpio, 'light_gpio': zone.lightGpio, 'pump': zone.pumpActivated,
+            'light': zone.lightActivated, 'humidity': zone.humidity,
+            'hum_raised_above': zone.humRaisedAbove, 'hum_raised_below': zone.humRaisedBelow})
+            for zone in list(self.zones))}
+
+    def restoreZone(self, zone):
+        """Take over the state of the previous run if the zone was checkpointed with the same pins, returns True
+        if restored"""
+        state = self.restored.pop(zone.name, None)
+        if state is None or (state.get('pump_gpio'), state.get('light_gpio')) != (zone.pumpGpio, zone.lightGpio):
+            return False
+        zone.humidity = state['humidity']
+        zone.pumpActivated = state['pump']
+        zone.lightActivated = state['light'] and zone.lightGpio is not None
+        zone.humRaisedAbove = state['hum_raised_above']
+        zone.humRaisedBelow = state['hum_raised_below']
+        log.info('Zone %s restored: pump %s, light %s, humidity %s', zone.name, 'on' if zone.pumpActivated else 'off',
+                 'on' if zone.lightActivated else 'off', zone.humidity)
+        return True
+
+    def setLight(self, zone, on):
+        """Switch the light of a zone on or off"""
+        if zone.lightGpio is None or on == zone.lightActivated:
+            return
+        self.gpio.output(zone.lightGpio, LIGHT_ON if on else LIGHT_OFF)
+        zone.lightActivated = on
+        if self.checkpoint is not None:
+            self.checkpoint.touch()
+        log.info('Light of zone %s %s at %s', zone.name, 'activated' if on else 'deactivated',
+                 timeStr(self.clock.time()))
+
+    def setPump(self, zone, on):
+        """Switch the pump of a zone on or off"""
+        if on == zone.pumpActivated:
+            return
+        self.gpio.output(zone.pumpGpio, PUMP_ON if on else PUMP_OFF)
+        zone.pumpActivated = on
+        if self.checkpoint is not None:
+            self.checkpoint.touch()
+        log.info('Pump of zone %s %s at %s', zone.name, 'activated' if on else 'deactivated',
+                 timeStr(self.clock.time()))
+
+    def buildZones(self, config, now):
+        """Create the zones of a config snapshot and compile their schedules. The state of zones which are
+        configured before and after the change is kept, outputs of removed zones are switched off"""
+        self.zonesDirty = False
+        previous = dict((zone.name, zone) for zone in self.zones)
+        if self.overrides:
+            log.info('Config changed, manual pump runs and overrides ended')
+            for name, kind in self.overrides:
+                # the schedules compiled below switch scheduled pumps on again
+                if kind == 'pump' and name in previous:
+                    self.setPump(previous[name], False)
+            self.overrides.clear()
+        retired = []
+        zones = []
+        for zoneConfig in zoneConfigs(config):
+            zone = Zone(zoneConfig['name'], zoneConfig['adc_channel'], zoneConfig['pump_gpio'],
+                        zoneConfig.get('light_gpio'), zoneConfig, now)
+            old = previous.pop(zone.name, None)
+            if old is not None and (old.pumpGpio, old.lightGpio) == (zone.pumpGpio, zone.lightGpio):
+                zone.humidity = old.humidity
+                zone.pumpActivated = old.pumpActivated
+                zone.lightActivated = old.lightActivated
+                zone.humRaisedAbove = old.humRaisedAbove
+                zone.humRaisedBelow = old.humRaisedBelow
+            else:
+                if old is not None:
+                    retired.append(old)
+                else:
+                    self.restoreZone(zone)
+                self.gpio.setup(zone.pumpGpio, OUT)
+                self.gpio.output(zone.pumpGpio, PUMP_ON if zone.pumpActivated else PUMP_OFF)
+                if zone.lightGpio is not None:
+                    self.gpio.setup(zone.lightGpio, OUT)
+                    self.gpio.output(zone.lightGpio, LIGHT_ON if zone.lightActivated else LIGHT_OFF)
+            zones.append(zone)
+
+        for old in retired + list(previous.values()):
+            self.setPump(old, False)
+            self.setLight(old, False)
+            self.scheduler.remove((old.name, 'light'))
+            self.scheduler.remove((old.name, 'pump'))
+
+        self.zones = zones
+        self.channels = tuple(sorted(set(zone.channel for zone in zones)))
+        self.zoneChannels = [self.channels.index(zone.channel) for zone in zones]
+        # the filter windows start empty after a config change
+        self.filters = FilterBank([(zone.config['sensor_filter'], zone.config['sensor_filter_window'],
+                                    zone.config['sensor_filter_alpha'], zone.config['sensor_hampel_sigmas'],
+                                    zone.config['sensor_calibration']) for zone in zones])
+        for zone in zones:
+            self.compileSchedules(zone, now)
+        nextDue = self.scheduler.nextDue()
+        log.info('%d zone(s) configured, next transition at %s',
+                 len(zones), 'never' if nextDue is None else datetime.datetime.fromtimestamp(nextDue))
+
+    def compileSchedules(self, zone, now):
+        """Compile the light and fixed scheme pump windows of a zone.
+        lightning_windows ('hh:mm-hh:mm[,...]') takes precedence over lightning_start/lightning_end,
+        watering_start may list several start times ('hh:mm[,...]')"""
+        config = zone.config
+        if zone.lightGpio is not None:
+            if config['lightning_windows']:
+                windows = parseWindows(config['lightning_windows'])
+            else:
+                windows = parseWindows(config['lightning_start'] + '-' + config['lightning_end'])
+            self.setLight(zone, self.scheduler.compile((zone.name, 'light'), windows, now))
 
-        # internal state values
-        self.lightActivated = False
-        self.pumpActivated = False
-        now = datetime.datetime.now().time()
-        self.humRaisedAbove = now
-        self.humRaisedBelow = now
-
-    def makeTime(self, hhMidateStr):
-        """Make a time object based on a string"""
-        t = time.strptime(hhMidateStr,"%H:%M")
-        return datetime.time(hour=t.tm_hour,minute=t.tm_min,second=t.tm_sec)
-
-    def addSecs(self, tm, secs):
-        """Add secs to a time object"""
-        fulldate = datetime.datetime(100, 1, 1, tm.hour, tm.minute, tm.second)
-        fulldate = fulldate + datetime.timedelta(seconds=secs)
-        return fulldate.time()
-
-    def activateLight(self):
-        """Activate or deactivate light based on configured start & end time"""
-        startTime = self.makeTime(self.configurationProvider.getParam('lightning_start'))
-        endTime = self.makeTime(self.configurationProvider.getParam('lightning_end'))
-        now = datetime.datetime.now().time()
-        if (not self.lightActivated):
-            if (now > startTime and now < endTime):
-                startLight()
-                self.lightActivated = True
-                print('Light activated at '+str(now))
-        else:
-            if (now < startTime or now > endTime):
-                stopLight()
-                self.lightActivated = False
-                print('Light deactivated at '+str(now))
-
-    def activatePumpFixed(self):
-        """Activate or deactivate pump based on configured start & duration time"""
-        startTime = self.makeTime(self.configurationProvider.getParam('watering_start'))
-        endTime = self.addSecs(startTime, self.configurationProvider.getParam('watering_duration'))
-        # print('fixed watering scheme from '+str(startTime)+' to '+str(endTime))
-        now = datetime.datetime.now().time()
-        if (not self.pumpActivated):
-            if (now > startTime and now < endTime):
-                startPump()
-                self.pumpActivated = True
-                print('Pump activated at '+str(now))
+        if config['watering_scheme'] == 'dynamic':
+            self.scheduler.remove((zone.name, 'pump'))
         else:
-            if (now < startTime or now > endTime):
-                stopPump()
-                self.pumpActivated = False
-                print('Pump deactivated at '+str(now))
+            starts = parseStarts(config['watering_start'], config['watering_duration'])
+            self.setPump(zone, self.scheduler.compile((zone.name, 'pump'), starts, now))
+
+    def applySchedules(self, now):
+        """Switch lights and pumps according to the due transitions"""
+        zones = None
+        for (name, kind), on in self.scheduler.due(now):
+            if zones is None:
+                zones = dict((zone.name, zone) for zone in self.zones)
+            zone = zones.get(name)
+            if zone is None:
+                continue
+            if (name, kind) in self.overrides:
+                if self.overrides[(name, kind)] is not None:
+                    # restored when the manual run or override expires
+                    continue
+                del self.overrides[(name, kind)]
+            if kind == 'light':
+                self.setLight(zone, on)
+            else:
+                self.setPump(zone, on)
+
+    def executeCommands(self, config, now):
+        """Execute the submitted commands"""
+        while self.commands:
+            name, args = self.commands.popleft()
+            if name == 'report':
+                # the sample of this poll is the report
+                continue
+            zones = [zone for zone in self.zones if args.zone is None or zone.name == args.zone]
+            if not zones:
+                log.warning('Command %s: unknown zone %s', name, args.zone)
+                continue
+            if name == 'pump':
+                seconds = min(args.seconds, config.command_pump_max_seconds)
+                for zone in zones:
+                    if seconds > 0:
+                        self.setPump(zone, True)
+                        self.overrides[(zone.name, 'pump')] = now + seconds
+                    elif (zone.name, 'pump') in self.overrides:
+                        # ends the manual run
+                        self.overrides[(zone.name, 'pump')] = now
+            elif name == 'light':
+                for zone in zones:
+                    if zone.lightGpio is not None:
+                        self.setLight(zone, args.on)
+                        self.overrides[(zone.name, 'light')] = now + args.seconds if args.seconds else None
+
+    def expireOverrides(self, now):
+        """Return the outputs of expired manual runs and overrides to their scheduled state"""
+        expired = [key for key, until in self.overrides.items() if until is not None and until <= now]
+        if not expired:
+            return
+        zones = dict((zone.name, zone) for zone in self.zones)
+        for key in expired:
+            del self.overrides[key]
+            name, kind = key
+            on = self.scheduler.isActive(key, now)
+            if kind == 'pump':
+                self.setPump(zones[name], on)
+            else:
+                self.setLight(zones[name], on)
+
+    def nextOverrideEnd(self):
+        """End of the next manual run or override, None if there is none"""
+        ends = [until for until in self.overrides.values() if until is not None]
+        return min(ends) if ends else None
 
-    def activatePumpDynamic(self, humidity):
-        """Activate or deactivate pump based on threshold and lag value"""
-        th = self.configurationProvider.getParam('watering_threshold')
-        lag = self.configurationProvider.getParam('watering_threshold_lag')
-        now = datetime.datetime.now().time()
+    def activatePumpDynamic(self, zone, humidity, now):
+        """Activate or deactivate the pump of a zone based on threshold and lag value"""
+        th = zone.config['watering_threshold']
+        lag = zone.config['watering_threshold_lag']
 
         if (humidity < th):
-            if (self.humRaisedAbove > self.humRaisedBelow):
+            if (zone.humRaisedAbove > zone.humRaisedBelow):
                 # from high to low threshold crossing
-                self.humRaisedBelow = now
-                print('humRaisedBelow='+str(self.humRaisedBelow))
+                zone.humRaisedBelow = now
+                log.debug('%s: humRaisedBelow=%s', zone.name, timeStr(zone.humRaisedBelow))
+                if self.checkpoint is not None:
+                    self.checkpoint.touch()
             else:
                 # during below threshold phase
-                lagUntil = self.addSecs(self.humRaisedBelow, lag)
-                if (not self.pumpActivated and lagUntil < now):
-                    startPump()
-                    self.pumpActivated = True
-                    self.humRaisedBelow = now
-                    print('humRaisedBelow='+str(self.humRaisedBelow)+', lagUntil='+str(lagUntil))
-                    print('humidity is '+str(humidity)+', pump activated at '+str(now))
+                lagUntil = zone.humRaisedBelow + lag
+                if (not zone.pumpActivated and lagUntil < now):
+                    self.setPump(zone, True)
+                    zone.humRaisedBelow = now
+                    log.debug('%s: humRaisedBelow=%s, lagUntil=%s', zone.name, timeStr(zone.humRaisedBelow),
+                              timeStr(lagUntil))
+                    log.info('%s: humidity is %s, pump activated at %s', zone.name, humidity, timeStr(now))
         else:
-            if (self.humRaisedAbove < self.humRaisedBelow):
+            if (zone.humRaisedAbove < zone.humRaisedBelow):
                 # from low to high threshold crossing
-                self.humRaisedAbove = now
-                print('humRaisedAbove='+str(self.humRaisedAbove))
+                zone.humRaisedAbove = now
+                log.debug('%s: humRaisedAbove=%s', zone.name, timeStr(zone.humRaisedAbove))
+                if self.checkpoint is not None:
+                    self.checkpoint.touch()
             else:
                 # during below threshold phase
-                lagUntil = self.addSecs(self.humRaisedAbove, lag)
-                if (self.pumpActivated and lagUntil < now):
-                    stopPump()
-                    self.pumpActivated = False
-                    self.humRaisedAbove = now
-                    print('humRaisedAbove='+str(self.humRaisedAbove)+', lagUntil='+str(lagUntil))
-                    print('humidity is '+str(humidity)+', pump deactivated at '+str(now))
+                lagUntil = zone.humRaisedAbove + lag
+                if (zone.pumpActivated and lagUntil < now):
+                    self.setPump(zone, False)
+                    zone.humRaisedAbove = now
+                    log.debug('%s: humRaisedAbove=%s, lagUntil=%s', zone.name, timeStr(zone.humRaisedAbove),
+                              timeStr(lagUntil))
+                    log.info('%s: humidity is %s, pump deactivated at %s', zone.name, humidity, timeStr(now))
 
 
-    # read SPI data from MCP3008 chip, 8 possible adc's (0 thru 7)
-    def readadc(self, adcnum, clockpin, mosipin, misopin, cspin):
+    def readadc(self, adcnum):
+        """Read a single MCP3008 channel (0 thru 7), returns -1 for invalid channels"""
         if ((adcnum > 7) or (adcnum < 0)):
             return -1
-
-        GPIO.output(cspin, True)
-        GPIO.output(clockpin, False)  # start clock low
-        GPIO.output(cspin, False)     # bring CS low
-
-        commandout = adcnum
-        commandout |= 0x18  # start bit + single-ended bit
-        commandout <<= 3    # we only need to send 5 bits here
-        for i in range(5):
-            if (commandout & 0x80):
-                GPIO.output(mosipin, True)
-            else:
-                GPIO.output(mosipin, False)
-            commandout <<= 1
-            GPIO.output(clockpin, True)
-            GPIO.output(clockpin, False)
-
-        adcout = 0
-        # read in one empty bit, one null bit and 10 ADC bits
-        for i in range(12):
-            GPIO.output(clockpin, True)
-            GPIO.output(clockpin, False)
-            adcout <<= 1
-            if (GPIO.input(misopin)):
-                adcout |= 0x1
-
-        GPIO.output(cspin, True)
-
-        adcout >>= 1       # first bit is 'null' so drop it
-        return adcout
-
+        if self.adc is None:
+            self.initHardware()
+        return self.adc.read(adcnum)
+
+    def readBurst(self, count):
+        """Scan all polled adc channels count times, returns the per channel median of the raw values"""
+        start = time.perf_counter()
+        scans = [self.adc.scan(self.channels) for i in range(max(1, count))]
+        self.adcRead.observe(time.perf_counter() - start)
+        return burstMedian(scans)
+
+
+    def tick(self, config, now):
+        """One poll: read all sensors, switch pumps and lights, report the zone values"""
+        if self.zonesDirty:
+            self.initHardware()
+            self.buildZones(config, now)
+
+        # read the analog pins, calibrate and filter the values of all zones
+        raw = self.readBurst(config.sensor_oversample)
+        humidity = self.filters.update(raw[self.zoneChannels])
+        self.applySchedules(now)
+        if self.overrides:
+            self.expireOverrides(now)
+        if self.commands:
+            self.executeCommands(config, now)
+        for zone, value in zip(self.zones, humidity):
+            zone.humidity = round(float(value), 1)
+            if zone.config['watering_scheme'] == 'dynamic' and (zone.name, 'pump') not in self.overrides:
+                self.activatePumpDynamic(zone, zone.humidity, now)
+
+        # every poll, only formatted if enabled
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug('%s humidity=%s', timeStr(now), ' '.join(str(zone.humidity) for zone in self.zones))
+
+        first = self.zones[0]
+        self.dataProvider.setData(first.humidity, first.pumpActivated, first.lightActivated,
+                                  [(zone.name, zone.humidity, zone.pumpActivated, zone.lightActivated)
+                                   for zone in self.zones])
+
+    def step(self):
+        """One iteration of the main loop: poll, then return the sleep time until the next poll, or the next
+        scheduled transition if it is earlier"""
+        started = self.clock.monotonic()
+        if self.lastTick is not None:
+            self.tickInterval.observe(started - self.lastTick)
+            self.tickLateness.observe(max(0.0, started - self.plannedTick))
+        self.lastTick = started
+        start = time.perf_counter()
+
+        # one consistent config snapshot per poll
+        config = self.configurationProvider.snapshot
+        self.tick(config, self.clock.time())
+
+        if config.device_poll_mode == 'adaptive':
+            delay = self.poller.next(config, self.zones)
+        else:
+            delay = config.device_poll_interval
+        nextDue = self.scheduler.nextDue()
+        if self.overrides:
+            overrideEnd = self.nextOverrideEnd()
+            if overrideEnd is not None and (nextDue is None or overrideEnd < nextDue):
+                nextDue = overrideEnd
+        if nextDue is not None:
+            delay = max(0, min(delay, nextDue - self.clock.time()))
+        self.tickDuration.observe(time.perf_counter() - start)
+        self.tickPlanned.observe(delay)
+        self.plannedTick = self.clock.monotonic() + delay
+        return delay
+
+    def shutdown(self):
+        """Turn off all devices and release the adc"""
+        for zone in self.zones:
+            self.setLight(zone, False)
+            self.setPump(zone, False)
+        if self.adc is not None:
+            self.adc.close()
 
     def run(self):
         """The main loop"""
-        print("DeviceControl starting ")
+        log.info('DeviceControl starting')
+        self.clock.callWhenSet(self.stopEvent, self.wakeup.set)
         while (not self.stopEvent.is_set()):
-
-            # read the analog pin
-            hsense = self.readadc(sensor_adc, SPICLK, SPIMOSI, SPIMISO, SPICS)
-            set_humidity = hsense / 10.24        # convert 10bit adc0 (0-1024) sensor out read into 0-100 level
-            set_humidity = round(set_humidity)   # round out decimal value
-            humidity = int(set_humidity)         # cast volume as integer
-
-            print(str(datetime.datetime.now().time())+' humidity='+str(humidity))
-
-            if self.configurationProvider.getParam('watering_threshold') == 'dynamic':
-                self.activatePumpDynamic(humidity)
-            else:
-                self.activatePumpFixed()
-            self.activateLight()
-
-            self.dataProvider.setData(humidity, self.pumpActivated, self.lightActivated)
-            time.sleep(self.configurationProvider.getParam('device_poll_interval'))
-
-        # turn off devices
-        stopLight()
-        stopPump()
-
-        print('DeviceControl stopped')
-
+            # a command or config change arriving during the poll ends the next wait at once
+            self.wakeup.clear()
+            self.clock.wait(self.wakeup, self.step())
+
+        self.shutdown()
+
+        log.info('DeviceControl stopped')
+
+    async def runAsync(self, executor):
+        """The main loop as task of an event loop, the polls run in executor (a single thread). Cancelling the task
+        switches the outputs off"""
+        log.info('DeviceControl starting (asyncio)')
+        loop = asyncio.get_event_loop()
+        try:
+            while not self.stopEvent.is_set():
+                self.wakeup.clear()
+                await self.wakeup.wait(await loop.run_in_executor(executor, self.step))
+        finally:
+            # queued after a poll still running in the executor
+            await loop.run_in_executor(executor, self.shutdown)
+            log.info('DeviceControl stopped')
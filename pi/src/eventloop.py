@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+
+# Asyncio runtime (execution_mode "asyncio"): the control loop and the mqtt client run as tasks of a single event
+# loop instead of two polling threads. Hardware I/O runs in a one-thread executor, paho reads and writes when the
+# loop reports its socket ready. Checkpoint, history store and the metrics and LAN servers keep their threads.
+
+import asyncio
+import signal
+from concurrent.futures import ThreadPoolExecutor
+
+from logs import getLogger
+
+log = getLogger('eventloop')
+
+
+class LoopEvent:
+    """asyncio.Event which may be set from any thread (eg. DeviceControl.submit() called by a command handler or the
+    stop event of a signal), waited for by tasks of loop only"""
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.event = asyncio.Event()
+
+    def set(self):
+        if not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.event.set)
+
+    def clear(self):
+        self.event.clear()
+
+    def is_set(self):
+        return self.event.is_set()
+
+    async def wait(self, timeout=None):
+        """Wait until set or for timeout seconds, returns True if set"""
+        try:
+            await asyncio.wait_for(self.event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        return self.event.is_set()
+
+
+class MqttSocket:
+    """Drives the network loop of a paho client from loop: loop_read() when its socket is readable, loop_write()
+    while it has data to send and loop_misc() (keepalive pings) in keep_alive(). paho 1.4 has no socket callbacks,
+    sync() follows the socket and the pending writes of the client, call it after every call of the client. While
+    paused the socket is not watched (eg. during a blocking reconnect in another thread)."""
+
+    def __init__(self, client, loop, on_read=None):
+        self.client = client
+        self.loop = loop
+        self.on_read = on_read
+        self.sock = None
+        self.writing = False
+        self.paused = False
+
+    def sync(self):
+        if self.paused:
+            return
+        sock = self.client.socket()
+        if sock is not self.sock:
+            # connected, reconnected or closed
+            self.detach()
+            if sock is not None:
+                self.sock = sock
+                self.loop.add_reader(sock, self.read)
+        writing = self.sock is not None and self.client.want_write()
+        if writing != self.writing:
+            if writing:
+                self.loop.add_writer(self.sock, self.write)
+            else:
+                self.loop.remove_writer(self.sock)
+            self.writing = writing
+
+    def detach(self):
+        if self.sock is not None:
+            self.loop.remove_reader(self.sock)
+            if self.writing:
+                self.loop.remove_writer(self.sock)
+        self.sock = None
+        self.writing = False
+
+    def pause(self):
+        self.detach()
+        self.paused = True
+
+    def resume(self):
+        self.paused = False
+        self.sync()
+
+    def read(self):
+        self.client.loop_read()
+        # records already decrypted by the ssl socket are not signalled by the loop
+        sock = self.client.socket()
+        while sock is not None and hasattr(sock, 'pending') and sock.pending() and self.client.loop_read() == 0:
+            sock = self.client.socket()
+        if self.on_read is not None:
+            self.on_read()
+        self.sync()
+
+    def write(self):
+        self.client.loop_write()
+        self.sync()
+
+    async def keep_alive(self, interval):
+        while True:
+            if not self.paused:
+                self.client.loop_misc()
+                self.sync()
+            await asyncio.sleep(interval)
+
+    def close(self):
+        self.detach()
+        self.paused = True
+
+
+async def serve(configuration, stopEvent):
+    """DeviceControl and GcpIotClient as tasks until SIGINT or SIGTERM, then the outputs are switched off and the
+    last batch is spooled"""
+    from commands import CommandDispatcher
+    from device_control import DeviceControl
+    from gcp_iot_client import GcpIotClient
+    from providers import DataProvider
+    from components import createCheckpoint, createStore, startMetricsServer, startStatusServer
+
+    loop = asyncio.get_event_loop()
+    tasks = []
+
+    def stop():
+        log.info('quit_gracefully called')
+        if not stopEvent.is_set():
+            stopEvent.set()
+            for task in tasks:
+                task.cancel()
+
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stop)
+
+    checkpoint = createCheckpoint(configuration, stopEvent)
+    store = createStore(configuration, stopEvent)
+    data = DataProvider(configuration.getParam('data_buffer_size'), store)
+    # gpio and adc calls of the polls, one at a time
+    hardware = ThreadPoolExecutor(max_workers=1, thread_name_prefix='hardware')
+
+    control = DeviceControl(data, configuration, stopEvent, checkpoint=checkpoint, wakeup=LoopEvent(loop))
+    commands = CommandDispatcher()
+    commands.forward(control)
+    client = GcpIotClient(data, configuration, stopEvent, checkpoint=checkpoint, commands=commands)
+
+    threads = [thread for thread in (store, checkpoint) if thread is not None]
+    for thread in threads:
+        thread.start()
+    metricsServer = startMetricsServer(configuration)
+    statusServer = startStatusServer(configuration, data, store)
+
+    # the control loop first, the pumps must not wait for the cloud connection
+    tasks.extend([loop.create_task(control.runAsync(hardware)), loop.create_task(client.run_async())])
+    # like a thread, a task which failed ends on its own
+    for task, result in zip(tasks, await asyncio.gather(*tasks, return_exceptions=True)):
+        if isinstance(result, Exception) and not isinstance(result, asyncio.CancelledError):
+            log.error('Task %s failed', task, exc_info=result)
+    stopEvent.set()
+    hardware.shutdown()
+    for thread in threads:
+        await loop.run_in_executor(None, thread.join)
+    if checkpoint is not None:
+        # final state, after the pumps are off and the last batch is spooled
+        checkpoint.save()
+    if metricsServer is not None:
+        metricsServer.close()
+    if statusServer is not None:
+        statusServer.close()
+
+
+def run(configuration, stopEvent):
+    asyncio.run(serve(configuration, stopEvent))
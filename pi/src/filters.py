@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+
+# Sensor signal processing: burst oversampling, calibration and sliding window filters for all zones at once.
+
+import numpy as np
+
+FILTERS = ('none', 'median', 'ema', 'hampel')
+# scale factor of the median absolute deviation to estimate the standard deviation of normal data
+MAD_SCALE = 1.4826
+
+
+def burstMedian(scans):
+    """Reduce a burst of adc scans (list of equally long lists) to the per channel median"""
+    if len(scans) == 1:
+        return np.asarray(scans[0], dtype=float)
+    return np.median(np.asarray(scans, dtype=float), axis=0)
+
+
+class Calibration:
+    """Maps raw adc values to humidity %. Without points the raw value is scaled linearly (raw / 10.24), otherwise
+    the value is interpolated piecewise linearly between the (raw, %) points, sorted by raw value"""
+
+    def __init__(self, points=None):
+        if points:
+            points = sorted((float(raw), float(percent)) for raw, percent in points)
+            self.raw = np.array([p[0] for p in points])
+            self.percent = np.array([p[1] for p in points])
+        else:
+            self.raw = None
+
+    def __call__(self, raw):
+        if self.raw is None:
+            return raw / 10.24
+        return np.interp(raw, self.raw, self.percent)
+
+
+class FilterGroup:
+    """Sliding window filter of several sensors with the same filter settings. The windows are the rows of one
+    array, so each update filters all sensors of the group with a few numpy operations:
+    - none: the calibrated value
+    - median: median of the last 'window' values
+    - ema: exponential moving average with smoothing factor 'alpha'
+    - hampel: the value, replaced by the window median if it deviates more than 'sigmas' estimated standard
+      deviations (median absolute deviation) from it
+    """
+
+    def __init__(self, kind, window, alpha, sigmas, size):
+        if kind not in FILTERS:
+            raise ValueError('Unknown sensor_filter "{}", must be one of {}'.format(kind, ', '.join(FILTERS)))
+        self.kind = kind
+        self.alpha = alpha
+        self.sigmas = sigmas
+        self.values = np.zeros((size, max(1, window)))
+        self.count = 0
+        self.pos = 0
+        self.ema = None
+
+    def update(self, values):
+        """Add the current values (one per sensor), return the filtered values"""
+        if self.kind == 'none':
+            return values
+        if self.kind == 'ema':
+            if self.ema is None:
+                self.ema = values.copy()
+            else:
+                self.ema += self.alpha * (values - self.ema)
+            return self.ema.copy()
+
+        window = self.values.shape[1]
+        self.values[:, self.pos] = values
+        self.pos = (self.pos + 1) % window
+        self.count = min(self.count + 1, window)
+        # the order of the values in the window does not matter for median and MAD
+        current = self.values[:, :self.count] if self.count < window else self.values
+        median = np.median(current, axis=1)
+        if self.kind == 'median':
+            return median
+        mad = np.median(np.abs(current - median[:, None]), axis=1)
+        outlier = np.abs(values - median) > self.sigmas * MAD_SCALE * mad
+        return np.where(outlier, median, values)
+
+
+class FilterBank:
+    """Signal processing of all zone sensors: calibration per sensor, then the filter of the sensor's zone.
+    Zones with the same filter settings share a FilterGroup. 'settings' is a list with one
+    (filter, window, alpha, sigmas, calibration points) tuple per sensor."""
+
+    def __init__(self, settings):
+        self.calibrations = [Calibration(s[4]) for s in settings]
+        groups = {}
+        for i, s in enumerate(settings):
+            groups.setdefault(tuple(s[:4]), []).append(i)
+        # (sensor indexes, FilterGroup)
+        self.groups = [(np.array(indexes), FilterGroup(key[0], key[1], key[2], key[3], len(indexes)))
+                       for key, indexes in groups.items()]
+
+    def update(self, raw):
+        """Calibrate and filter the raw values (one per sensor), returns the filtered humidity % per sensor"""
+        calibrated = np.array([calibrate(value) for calibrate, value in zip(self.calibrations, raw)], dtype=float)
+        filtered = np.empty_like(calibrated)
+        for indexes, group in self.groups:
+            filtered[indexes] = group.update(calibrated[indexes])
+        return filtered
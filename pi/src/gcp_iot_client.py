@@ -1,15 +1,22 @@
 #!/usr/bin/env python3
 
+import asyncio
 import sys
-import datetime
 import random
 import ssl
-import time
-import jwt
-import paho.mqtt.client as mqtt
 import json
 import threading
 
+from clock import SystemClock
+from credentials import CredentialManager
+from logs import getLogger
+from metrics import REGISTRY
+from publisher import InflightPublisher
+from spool import Spool
+from telemetry import TelemetryBatcher
+
+log = getLogger('gcp')
+
 # gcp configuration
 device_id = 'raspi1'
 sub_topic = 'events'
@@ -26,184 +33,526 @@ mqtt_bridge_port = 8883
 jwt_expires_minutes = 20
 # The initial backoff time after a disconnection occurs, in seconds.
 minimum_backoff_time = 1
-# The maximum backoff time before giving up, in seconds.
+# The backoff time is capped at this value, in seconds.
 MAXIMUM_BACKOFF_TIME = 32
+# Spooled messages read per batch at most.
+spool_replay_batch = 100
+# A report command waits this long at most for the sample of the poll it triggered, in seconds.
+report_wait = 1.0
+# Keepalive and timeout checks of paho in the asyncio runtime, in seconds.
+misc_interval = 5.0
 
 # Whether to wait with exponential backoff before publishing.
 should_backoff = False
 
 class GcpIotClient (threading.Thread):
     """The GcpIotClient object publishes data to and receives config changes from the Google Cloud using the mqtt protocol
-    The data send interval is controlled by the configuration value 'gcp_send_interval'
+    The data send interval is controlled by the configuration value 'gcp_send_interval'.
+    If 'publish_statistics' is true, the humidity min, max, standard deviation and sample count of each send interval are published too.
+    Payloads are written to a disk spool (directory 'spool_dir') first and removed once the broker acknowledged them,
+    so data collected while disconnected is replayed in batches after the reconnect.
+    'telemetry_encoding' selects the payload format: json (one message per send interval) or binary (see telemetry.py),
+    which packs 'telemetry_batch_size' samples or 'telemetry_batch_seconds' sec. of samples into one message.
+    Spooled messages are published through an inflight window of 'publish_window' messages (see publisher.py),
+    messages not acknowledged within 'publish_ack_timeout' sec. are sent again. Between two samples the client keeps
+    publishing the spool backlog and processing network events
+    Across reconnects paho owns the retransmission: it keeps the unacknowledged QoS 1 messages (and those published
+    while disconnected) and sends them again with their mids after the reconnect, so the spool is not rewound and
+    the messages in flight stay in the window until their acks arrive.
+    The simulation (see simulation.py) passes a virtual clock, a factory creating a stand-in mqtt client for a
+    client id and static credentials, otherwise the system clock, paho and a CredentialManager are used.
+    Reconnects, disconnects, backoff time and the spool backlog are published as metrics (see metrics.py).
+    With a checkpoint (see checkpoint.py), the spool cursor and the samples of an incomplete binary batch are restored
+    from the previous run. paho, jwt and cryptography are imported by run(), not on startup.
+    Messages on the commands topic are passed to 'commands' (a CommandDispatcher, see commands.py), a report command
+    ends the wait for the next sample. Setting stopEvent disconnects the client, which ends a network wait at once.
+    In the asyncio runtime (see eventloop.py) run_async() replaces the thread: network events are handled as soon
+    as the socket is readable, key loading, connects and config writes run in the default executor.
     """
 
-    def __init__(self, dataProvider, configurationProvider, stopEvent):
+    def __init__(self, dataProvider, configurationProvider, stopEvent, clock=None, clientFactory=None,
+                 credentials=None, registry=None, checkpoint=None, commands=None):
         super(GcpIotClient, self).__init__()
         self.stopEvent = stopEvent
         self.dataProvider = dataProvider
         self.configurationProvider = configurationProvider
-
-    def create_jwt(self, project_id, private_key_file, algorithm):
-        token = {
-            # The time that the token was issued at
-            'iat': datetime.datetime.utcnow(),
-            # The time the token expires.
-            'exp': datetime.datetime.utcnow() + datetime.timedelta(minutes=60),
-            # The audience field should always be set to the GCP project id.
-            'aud': project_id
-        }
-
-        # Read the private key file.
-        with open(private_key_file, 'r') as f:
-            private_key = f.read()
-
-        print('Creating JWT using {} from private key file {}'.format(
-            algorithm, private_key_file))
-
-        return jwt.encode(token, private_key, algorithm=algorithm)
-
+        self.clock = clock if clock is not None else SystemClock()
+        self.clientFactory = clientFactory if clientFactory is not None else self.create_client
+        self.credentials = credentials
+        self.spool = Spool(configurationProvider.getParam('spool_dir'))
+        # keys of the published messages are their spool sequence numbers
+        self.publisher = InflightPublisher(
+            window=configurationProvider.getParam('publish_window'),
+            timeout=configurationProvider.getParam('publish_ack_timeout'),
+            onAck=self.spool.ack,
+            clock=self.clock,
+            registry=registry)
+        registry = registry if registry is not None else REGISTRY
+        self.reconnects = registry.counter('wassermat_mqtt_reconnects_total', 'Reconnect attempts after a disconnect')
+        self.disconnects = registry.counter('wassermat_mqtt_disconnects_total', 'Connections lost or closed')
+        self.backoffSeconds = registry.counter('wassermat_mqtt_backoff_seconds_total', 'Time spent waiting to reconnect')
+        registry.gauge('wassermat_spool_backlog_messages', 'Spooled messages not yet acknowledged',
+                       function=lambda: len(self.spool))
+        configurationProvider.subscribe(self.on_config_change)
+        self.batcher = None
+        # (data version, time) of a pending report command
+        self.report_requested = None
+        self.commands = commands
+        if commands is not None:
+            commands.register('report', self.request_report)
+        # asyncio runtime only: the event loop, the event ending the wait for the next sample and the event set on
+        # connects and disconnects
+        self.loop = None
+        self.wakeup = None
+        self.connection_changed = None
+        # the client reconnects in an executor thread, nothing is published meanwhile
+        self.reconnecting = False
+        if checkpoint is not None:
+            self.restore(checkpoint.restored('publisher'))
+            checkpoint.register('publisher', self.checkpoint_state)
+
+    def checkpoint_state(self):
+        """State for the checkpoint, called from the checkpoint thread."""
+        batcher = self.batcher
+        state = {'spool_cursor': self.spool.cursor}
+        if batcher is not None:
+            state['batch'] = {'size': batcher.batchSize, 'seconds': batcher.batchSeconds,
+                              'samples': [list(sample) for sample in list(batcher.samples)]}
+        return state
+
+    def restore(self, state):
+        """Continue with the state of the previous run."""
+        if not state:
+            return
+        self.spool.skipTo(state['spool_cursor'])
+        batch = state.get('batch')
+        if batch and batch['samples']:
+            self.batcher = TelemetryBatcher(batch['size'], batch['seconds'])
+            self.batcher.samples = [tuple(sample) for sample in batch['samples']]
+        log.info('Restored spool cursor %s and %s batched samples', state['spool_cursor'],
+                 len(batch['samples']) if batch else 0)
 
     def error_str(self, rc):
         """Convert a Paho error to a human readable string."""
+        import paho.mqtt.client as mqtt
         return '{}: {}'.format(rc, mqtt.error_string(rc))
 
 
-    def on_connect(self, unused_client, unused_userdata, unused_flags, rc):
+    def on_connect(self, client, unused_userdata, unused_flags, rc):
         """Callback for when a device connects."""
-        print('on_connect', mqtt.connack_string(rc))
+        import paho.mqtt.client as mqtt
 
-        # After a successful connect, reset backoff time and stop backing off.
         global should_backoff
         global minimum_backoff_time
+        if rc != 0:
+            # Refused (eg. broker unavailable or token rejected), keep backing off.
+            log.warning('on_connect %s (rc %s)', mqtt.connack_string(rc), rc)
+            should_backoff = True
+            if self.connection_changed is not None:
+                self.connection_changed.set()
+            return
+
+        log.info('on_connect %s', mqtt.connack_string(rc))
+
+        # After a successful connect, reset backoff time and stop backing off.
         should_backoff = False
         minimum_backoff_time = 1
+        # paho sent the messages in flight again.
+        self.publisher.restartTimeouts()
+        if self.connection_changed is not None:
+            self.connection_changed.set()
+
+        # (Re-)subscribe after every connect, subscriptions do not survive a reconnect.
+        # This is the topic that the device will receive configuration updates on.
+        mqtt_config_topic = '/devices/{}/config'.format(device_id)
+
+        # Subscribe to the config topic.
+        client.subscribe(mqtt_config_topic, qos=1)
+
+        # The topic that the device will receive commands on.
+        mqtt_command_topic = '/devices/{}/commands/#'.format(device_id)
+
+        # Subscribe to the commands topic, QoS 1 enables message acknowledgement.
+        log.info('Subscribing to %s', mqtt_command_topic)
+        client.subscribe(mqtt_command_topic, qos=0)
 
 
     def on_disconnect(self, unused_client, unused_userdata, rc):
         """Paho callback for when a device disconnects."""
-        print('on_disconnect', self.error_str(rc))
+        log.warning('on_disconnect %s', self.error_str(rc))
 
         # Since a disconnect occurred, the next loop iteration will wait with
         # exponential backoff.
         global should_backoff
         should_backoff = True
+        self.disconnects.inc()
 
+        # paho sends the messages in flight again after the reconnect, they keep their window slots.
+        if self.connection_changed is not None:
+            self.connection_changed.set()
 
-    def on_publish(self, unused_client, unused_userdata, unused_mid):
-        """Paho callback when a message is sent to the broker."""
+
+    def on_publish(self, unused_client, unused_userdata, mid):
+        """Paho callback when a message is sent to the broker, for QoS 1 when the broker acknowledged it."""
+        self.publisher.onPublish(mid)
+
+
+    def on_config_change(self, snapshot):
+        """Config subscriber, applies the publisher settings once per change."""
+        self.publisher.window = snapshot.publish_window
+        self.publisher.timeout = snapshot.publish_ack_timeout
 
 
     def on_message(self, unused_client, unused_userdata, message):
         """Callback when the device receives a message on a subscription."""
-        global config
-        if (message.topic == '/devices/raspi1/config'):
-            try:
-                self.configurationProvider.write(json.loads(message.payload))
-            except:
-                print("on_message, unexpected error: {} / payload={}".format(sys.exc_info()[0]), message.payload)
-                raise
+        if (message.topic == '/devices/{}/config'.format(device_id)):
+            if self.loop is not None:
+                # The config file is fsync'ed, not in the event loop.
+                self.loop.run_in_executor(None, self.write_config, message.payload)
+            else:
+                self.write_config(message.payload)
+        elif (self.commands is not None and
+              message.topic.startswith('/devices/{}/commands'.format(device_id))):
+            subfolder = message.topic[len('/devices/{}/commands/'.format(device_id)):] or None
+            self.commands.dispatch(message.payload, subfolder)
         else:
-            print('on_message: message topic "'+message.topic+'" not handled')
+            log.warning('on_message: message topic "%s" not handled', message.topic)
+
+
+    def write_config(self, payload):
+        """Apply a config message."""
+        try:
+            self.configurationProvider.write(json.loads(payload))
+        except ValueError as e:
+            # Invalid json or config values, keep the current config.
+            log.error('on_message, config rejected: %s / payload=%s', e, payload)
+        except Exception:
+            # Keep the current config, an exception would end the network loop.
+            log.exception('on_message, unexpected error: %s / payload=%s', sys.exc_info()[0], payload)
+
+
+    def request_report(self, args):
+        """Report command handler, the next sample is taken once the poll it triggered arrived."""
+        self.report_requested = (self.dataProvider.current()[0], self.clock.time())
+        if self.wakeup is not None:
+            self.wakeup.set()
 
 
-    def get_client(self, project_id, cloud_region, registry_id, device_id, private_key_file,
-            algorithm, ca_certs, mqtt_bridge_hostname, mqtt_bridge_port):
+    def report_due(self):
+        """True if a report was requested and its sample arrived (or did not within report_wait)."""
+        version, requested = self.report_requested
+        return self.dataProvider.current()[0] != version or self.clock.time() - requested >= report_wait
+
+
+    def create_client(self, client_id):
+        """Create a paho client, paho is imported here so it is loaded by this thread, not on startup."""
+        import paho.mqtt.client as mqtt
+        return mqtt.Client(client_id=client_id)
+
+
+    def get_client(self, project_id, cloud_region, registry_id, device_id, credentials,
+            ca_certs, mqtt_bridge_hostname, mqtt_bridge_port):
         """Create our MQTT client. The client_id is a unique string that identifies
         this device. For Google Cloud IoT Core, it must be in the format below."""
-        client = mqtt.Client(
-            client_id=('projects/{}/locations/{}/registries/{}/devices/{}'
+        client = self.clientFactory(
+            'projects/{}/locations/{}/registries/{}/devices/{}'
                 .format(
                 project_id,
                 cloud_region,
                 registry_id,
-                device_id)))
+                device_id))
 
         # With Google Cloud IoT Core, the username field is ignored, and the
         # password field is used to transmit a JWT to authorize the device.
         client.username_pw_set(
             username='unused',
-            password=self.create_jwt(
-                project_id, private_key_file, algorithm))
+            password=credentials.token())
 
         # Enable SSL/TLS support.
         client.tls_set(ca_certs=ca_certs, tls_version=ssl.PROTOCOL_TLSv1_2)
 
         # Register message callbacks. https://eclipse.org/paho/clients/python/docs/
         # describes additional callbacks that Paho supports. In this example, the
-        # callbacks just print to standard out.
+        # callbacks just log.
         client.on_connect = self.on_connect
         client.on_publish = self.on_publish
         client.on_disconnect = self.on_disconnect
         client.on_message = self.on_message
 
-        # Connect to the Google MQTT bridge.
-        client.connect(mqtt_bridge_hostname, mqtt_bridge_port)
+        # Connect to the Google MQTT bridge. Subscriptions are made in on_connect.
+        try:
+            client.connect(mqtt_bridge_hostname, mqtt_bridge_port)
+        except OSError as e:
+            # Offline, the run loop reconnects with backoff.
+            log.warning('connect failed: %s', e)
+            global should_backoff
+            should_backoff = True
 
-        # This is the topic that the device will receive configuration updates on.
-        mqtt_config_topic = '/devices/{}/config'.format(device_id)
-
-        # Subscribe to the config topic.
-        client.subscribe(mqtt_config_topic, qos=1)
-
-        # The topic that the device will receive commands on.
-        mqtt_command_topic = '/devices/{}/commands/#'.format(device_id)
+        return client
 
-        # Subscribe to the commands topic, QoS 1 enables message acknowledgement.
-        print('Subscribing to {}'.format(mqtt_command_topic))
-        client.subscribe(mqtt_command_topic, qos=0)
 
-        return client
+    def encode_sample(self, timestamp, sample):
+        """Encode a sample according to the configured telemetry encoding, return the list of payloads to send."""
+        payloads = []
+        if self.configurationProvider.getParam('telemetry_encoding') == 'binary':
+            batchSize = self.configurationProvider.getParam('telemetry_batch_size')
+            batchSeconds = self.configurationProvider.getParam('telemetry_batch_seconds')
+            if (self.batcher is not None and
+                    (self.batcher.batchSize, self.batcher.batchSeconds) != (batchSize, batchSeconds)):
+                payloads.append(self.batcher.flush())
+                self.batcher = None
+            if self.batcher is None:
+                self.batcher = TelemetryBatcher(batchSize, batchSeconds)
+            payloads.append(self.batcher.add(
+                timestamp, sample['humidity'], sample['pump_active'], sample['light_active']))
+        else:
+            if self.batcher is not None:
+                # Encoding switched, send the samples collected so far.
+                payloads.append(self.batcher.flush())
+                self.batcher = None
+            # Spooled samples are replayed late, the cloud function takes the sample time (epoch sec.) from the payload.
+            sample['timestamp'] = int(timestamp)
+            payloads.append(json.dumps(sample).encode('utf-8'))
+        return [payload for payload in payloads if payload is not None]
+
+
+    def spool_sample(self):
+        """Spool a sample of the data window, with an incomplete binary batch if a report is pending."""
+        sample = self.dataProvider.getSample(
+            statistics=self.configurationProvider.getParam('publish_statistics'))
+        log.debug('Spooling sample \'%s\'', sample)
+        payloads = self.encode_sample(self.clock.time(), sample)
+        if self.report_requested is not None:
+            self.report_requested = None
+            log.info('Reporting sample \'%s\'', sample)
+            # an incomplete binary batch is sent with the report
+            if self.batcher is not None:
+                payloads.append(self.batcher.flush())
+        for payload in payloads:
+            if payload is not None:
+                self.spool.append(payload)
+
+
+    def log_statistics(self):
+        stats = self.publisher.statistics()
+        if stats['published'] > 0:
+            log.info('Published {published}, acked {acked} ({msg_per_sec:.1f} msg/s), retransmitted {retransmitted}, '
+                  'inflight {inflight}, ack latency avg {ack_latency_avg}s p99 {ack_latency_p99}s, backlog {backlog}'
+                  .format(backlog=len(self.spool), **stats))
+
+
+    def publish_spooled(self, mqtt_topic):
+        """Publish spooled messages not yet in flight until the inflight window is full."""
+        if self.reconnecting:
+            return
+        while (self.publisher.free() > 0 and self.spool.pending()):
+            batch = self.spool.readBatch(min(spool_replay_batch, self.publisher.free()))
+            if not batch:
+                return
+            for seq, payload in batch:
+                if not self.publisher.publish(mqtt_topic, payload, seq):
+                    # Neither sent nor queued by paho, retry from this message later.
+                    log.warning('publish of message %s failed', seq)
+                    self.spool.rewind(seq)
+                    return
+
+
+    def drain(self, client, mqtt_topic, until):
+        """Publish the spool backlog and process network events until the time 'until'."""
+        while (not self.stopEvent.is_set()):
+            remaining = until - self.clock.time()
+            if remaining <= 0:
+                break
+            if self.report_requested is not None:
+                if self.report_due():
+                    break
+                remaining = min(remaining, 0.05)
+            if should_backoff:
+                # Reconnect is handled by the run loop.
+                self.clock.wait(self.stopEvent, remaining)
+                break
+            self.publish_spooled(mqtt_topic)
+            self.publisher.retransmitExpired()
+            self.spool.maybeSync()
+            client.loop(timeout=min(remaining, 1.0))
+
+
+    def reconnect(self, client, credentials):
+        """Reconnect after a disconnect, with a new token if the current one is due: after an outage longer than
+        the token lifetime the old password is refused."""
+        if credentials.refreshDue():
+            log.info('Refreshing token')
+            credentials.rotate(client)
+        else:
+            client.reconnect()
 
 
     def run(self):
-        print ("GcpIotClient starting ")
+        log.info('GcpIotClient starting')
         global minimum_backoff_time
+        global should_backoff
 
         # Publish to the events or state topic based on the flag.
         mqtt_topic = '/devices/{}/{}'.format(device_id, sub_topic)
 
-        jwt_iat = datetime.datetime.utcnow()
-        jwt_exp_mins = jwt_expires_minutes
+        # The key is loaded once, tokens are signed ahead of time in the background.
+        credentials = self.credentials
+        if credentials is None:
+            credentials = CredentialManager(project_id, private_key_file, algorithm, jwt_expires_minutes)
 
         client = self.get_client(
             project_id, cloud_region, registry_id, device_id,
-            private_key_file, algorithm, ca_certs,
+            credentials, ca_certs,
             mqtt_bridge_hostname, mqtt_bridge_port)
+        self.publisher.attach(client)
+        # wakes up the network wait in client.loop()
+        self.clock.callWhenSet(self.stopEvent, client.disconnect)
 
         while (not self.stopEvent.is_set()):
-            # Process network events.
-            client.loop()
+            # Process network events, a pending report does not wait for them.
+            client.loop(timeout=0 if self.report_requested is not None else 1.0)
 
             # Wait if backoff is required.
             if should_backoff:
-                # If backoff time is too large, give up.
-                if minimum_backoff_time > MAXIMUM_BACKOFF_TIME:
-                    print('Exceeded maximum backoff time. Giving up.')
+                # Wait and connect again, the backoff time is capped but we never give up.
+                delay = minimum_backoff_time + random.randint(0, 1000) / 1000.0
+                log.info('Waiting for %s before reconnecting.', delay)
+                if self.clock.wait(self.stopEvent, delay):
                     break
+                self.backoffSeconds.inc(delay)
+                minimum_backoff_time = min(minimum_backoff_time * 2, MAXIMUM_BACKOFF_TIME)
+                self.reconnects.inc()
+                try:
+                    self.reconnect(client, credentials)
+                except OSError as e:
+                    log.warning('reconnect failed: %s', e)
+
+            self.spool_sample()
+
+            if credentials.refreshDue() and not should_backoff:
+                # Same client, new password: paho closes the old socket and resends unacknowledged messages.
+                log.info('Refreshing token')
+                try:
+                    credentials.rotate(client)
+                except OSError as e:
+                    log.warning('reconnect failed: %s', e)
+                    should_backoff = True
+
+            # Publish until the next sample is due. State should not be updated as often
+            self.drain(client, mqtt_topic, self.clock.time() + self.configurationProvider.getParam('gcp_send_interval'))
+            self.log_statistics()
+
+        credentials.cancel()
+        client.disconnect()
+        self.close_spool()
+
+
+    def close_spool(self):
+        # Keep an incomplete binary batch for the next start.
+        if self.batcher is not None and self.batcher.samples:
+            self.spool.append(self.batcher.flush())
+        self.spool.close()
+        log.info('GcpIotClient stopped')
+
+
+    async def run_async(self):
+        """run() as a task of the asyncio runtime, cancel the task to stop the client."""
+        from eventloop import LoopEvent, MqttSocket
+
+        log.info('GcpIotClient starting (asyncio)')
+        loop = asyncio.get_event_loop()
+        self.loop = loop
+        self.wakeup = asyncio.Event()
+        self.connection_changed = LoopEvent(loop)
+        mqtt_topic = '/devices/{}/{}'.format(device_id, sub_topic)
+
+        credentials = self.credentials
+        if credentials is None:
+            credentials = await loop.run_in_executor(
+                None, CredentialManager, project_id, private_key_file, algorithm, jwt_expires_minutes)
+        client = await loop.run_in_executor(
+            None, self.get_client, project_id, cloud_region, registry_id, device_id,
+            credentials, ca_certs, mqtt_bridge_hostname, mqtt_bridge_port)
+        self.publisher.attach(client)
+        # Acks free the inflight window, refill it at once.
+        socket = MqttSocket(client, loop, on_read=lambda: self.publish_spooled(mqtt_topic))
+        tasks = [loop.create_task(socket.keep_alive(misc_interval)),
+                 loop.create_task(self.connect_async(client, credentials, socket)),
+                 loop.create_task(self.sample_async(mqtt_topic, socket))]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            credentials.cancel()
+            client.disconnect()
+            socket.close()
+            self.close_spool()
+
+
+    async def sample_async(self, mqtt_topic, socket):
+        """Spool a sample every gcp_send_interval, or once the sample of a report command arrived."""
+        loop = asyncio.get_event_loop()
+        while True:
+            self.spool_sample()
+            self.publish_spooled(mqtt_topic)
+            if not should_backoff:
+                self.publisher.retransmitExpired()
+            self.spool.maybeSync()
+            socket.sync()
+            self.log_statistics()
+
+            due = loop.time() + self.configurationProvider.getParam('gcp_send_interval')
+            while True:
+                remaining = due - loop.time()
+                if self.report_requested is not None:
+                    if self.report_due():
+                        break
+                    remaining = min(remaining, 0.05)
+                if remaining <= 0:
+                    break
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), remaining)
+                except asyncio.TimeoutError:
+                    pass
+
 
-                # Otherwise, wait and connect again.
+    async def connect_async(self, client, credentials, socket):
+        """Reconnect with backoff after a disconnect and rotate the token, the blocking connects run in the
+        default executor while the sockets of the client are not watched."""
+        global minimum_backoff_time
+        global should_backoff
+        while True:
+            self.connection_changed.clear()
+            if should_backoff:
+                # Wait and connect again, the backoff time is capped but we never give up.
                 delay = minimum_backoff_time + random.randint(0, 1000) / 1000.0
-                print('Waiting for {} before reconnecting.'.format(delay))
-                time.sleep(delay)
-                minimum_backoff_time *= 2
-                client.connect(mqtt_bridge_hostname, mqtt_bridge_port)
-
-            payload = self.dataProvider.getData()
-            print('Publishing message \'{}\''.format(payload))
-
-            seconds_since_issue = (datetime.datetime.utcnow() - jwt_iat).seconds
-            if seconds_since_issue > 60 * jwt_exp_mins:
-                print('Refreshing token after {}s'.format(seconds_since_issue))
-                jwt_iat = datetime.datetime.utcnow()
-                client = self.get_client(
-                    project_id, cloud_region,
-                    registry_id, device_id, private_key_file,
-                    algorithm, ca_certs, mqtt_bridge_hostname,
-                    mqtt_bridge_port)
-
-            client.publish(mqtt_topic, payload, qos=1)
-
-            # Send events every second. State should not be updated as often
-            time.sleep(self.configurationProvider.getParam('gcp_send_interval'))
-
-        print('GcpIotClient stopped')
+                log.info('Waiting for %s before reconnecting.', delay)
+                await asyncio.sleep(delay)
+                self.backoffSeconds.inc(delay)
+                minimum_backoff_time = min(minimum_backoff_time * 2, MAXIMUM_BACKOFF_TIME)
+                self.reconnects.inc()
+                await self.reconnect_async(lambda: self.reconnect(client, credentials), socket)
+            elif credentials.refreshDue():
+                log.info('Refreshing token')
+                if not await self.reconnect_async(lambda: credentials.rotate(client), socket):
+                    should_backoff = True
+            # Until the CONNACK or a disconnect arrived, at most one send interval.
+            await self.connection_changed.wait(self.configurationProvider.getParam('gcp_send_interval'))
+
+
+    async def reconnect_async(self, reconnect, socket):
+        """Call reconnect() in the default executor, returns False if it failed."""
+        socket.pause()
+        self.reconnecting = True
+        try:
+            await asyncio.get_event_loop().run_in_executor(None, reconnect)
+            return True
+        except OSError as e:
+            log.warning('reconnect failed: %s', e)
+            return False
+        finally:
+            self.reconnecting = False
+            socket.resume()
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+
+# GPIO backends: the Raspberry Pi GPIO pins or a simulation of them.
+
+# pin modes and levels, same values as RPi.GPIO
+OUT = 0
+IN = 1
+LOW = 0
+HIGH = 1
+
+# RPi.GPIO module once set up (pin numbering, warnings), shared by all RpiGpio instances
+_rpiGpio = None
+
+
+def rpiGpio():
+    """Import and set up RPi.GPIO on the first call"""
+    global _rpiGpio
+    if _rpiGpio is None:
+        import RPi.GPIO as GPIO
+        GPIO.setmode(GPIO.BCM)
+        GPIO.setwarnings(False)
+        _rpiGpio = GPIO
+    return _rpiGpio
+
+
+class RpiGpio:
+    """GPIO pins of the Raspberry Pi (BCM numbering) through RPi.GPIO, which is imported and set up when the
+    first instance is created. Setting up a pin again with the same mode does nothing."""
+
+    def __init__(self):
+        self.GPIO = rpiGpio()
+        self.modes = {}
+
+    def setup(self, pin, mode):
+        if self.modes.get(pin) == mode:
+            return
+        self.GPIO.setup(pin, self.GPIO.OUT if mode == OUT else self.GPIO.IN)
+        self.modes[pin] = mode
+
+    def output(self, pin, value):
+        self.GPIO.output(pin, value)
+
+    def input(self, pin):
+        return self.GPIO.input(pin)
+
+    def cleanup(self):
+        self.GPIO.cleanup()
+
+
+class SimulatedGpio:
+    """In-memory GPIO pins. Output levels are kept per pin, input levels can be set with setInput.
+    If a clock is given, every output level change is recorded in 'history' as (time, pin, level)."""
+
+    def __init__(self, clock=None):
+        self.clock = clock
+        self.modes = {}
+        self.levels = {}
+        self.history = []
+
+    def setup(self, pin, mode):
+        self.modes[pin] = mode
+        self.levels.setdefault(pin, LOW)
+
+    def output(self, pin, value):
+        value = HIGH if value else LOW
+        if self.clock is not None and self.levels.get(pin) != value:
+            self.history.append((self.clock.time(), pin, value))
+        self.levels[pin] = value
+
+    def input(self, pin):
+        return self.levels.get(pin, LOW)
+
+    def setInput(self, pin, value):
+        self.levels[pin] = HIGH if value else LOW
+
+    def level(self, pin):
+        """Current level of a pin"""
+        return self.levels.get(pin, LOW)
+
+    def cleanup(self):
+        pass
+
+
+def createGpio(backend):
+    """Create the gpio backend configured by name: rpi (default) or simulated"""
+    if (backend == 'rpi'):
+        return RpiGpio()
+    elif (backend == 'simulated'):
+        return SimulatedGpio()
+    raise ValueError('Unknown gpio_backend "{}", must be one of rpi, simulated'.format(backend))
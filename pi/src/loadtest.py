@@ -0,0 +1,783 @@
+#!/usr/bin/env python3
+
+# Fleet load test: thousands of virtual devices in one asyncio process publish through the publish path of
+# GcpIotClient (DataProvider windows, telemetry encoding, InflightPublisher, replay after a reconnect, connect
+# backoff) to a local mqtt broker stand-in, which can simulate outages. Reports the sustained message rate, the
+# connect storms after the outages and the ack and end-to-end latencies.
+#
+# usage: python3 loadtest.py [--devices 2000] [--duration 120] [--outage 40:50]
+# see python3 loadtest.py --help
+
+import argparse
+import asyncio
+import collections
+import datetime
+import hashlib
+import json
+import logging
+import math
+import random
+import resource
+import struct
+import sys
+import time
+
+import logs
+from gcp_iot_client import (MAXIMUM_BACKOFF_TIME, cloud_region, jwt_expires_minutes, minimum_backoff_time,
+                            project_id, registry_id, sub_topic)
+from metrics import Registry
+from providers import DataProvider, validate
+from publisher import InflightPublisher
+from simulation import MQTT_ERR_NO_CONN, MQTT_ERR_SUCCESS, MessageInfo, parseAssignments
+from telemetry import TelemetryBatcher
+
+log = logs.getLogger('loadtest')
+
+DEFAULT_CONFIG = '../resources/wassermat.json'
+
+# mqtt 3.1.1 packet types
+CONNECT = 1
+CONNACK = 2
+PUBLISH = 3
+PUBACK = 4
+SUBSCRIBE = 8
+SUBACK = 9
+PINGREQ = 12
+PINGRESP = 13
+DISCONNECT = 14
+# CONNACK return codes
+ACCEPTED = 0
+SERVER_UNAVAILABLE = 3
+NOT_AUTHORIZED = 5
+# CONNECT flags: user name, password, clean session
+CONNECT_FLAGS = 0xc2
+KEEPALIVE = 60
+# a device gives up a connect without CONNACK after this time, in sec.
+CONNECT_TIMEOUT = 10.0
+# the devices sign their tokens with per device EC keys, RSA keys for thousands of devices take minutes to generate
+ALGORITHM = 'ES256'
+
+# soil moisture of the traces, in %
+FLOOR = 10.0
+SATURATION = 90.0
+# watering time constant of the traces, in sec. of trace time
+PUMP_TAU = 120.0
+
+
+def packet(kind, flags, body):
+    """Encode an mqtt packet: fixed header with the remaining length as varint, then the body"""
+    length = len(body)
+    header = bytearray([kind << 4 | flags])
+    while True:
+        byte = length & 0x7f
+        length >>= 7
+        header.append(byte | 0x80 if length else byte)
+        if not length:
+            break
+    return bytes(header) + body
+
+
+def string(value):
+    """Length prefixed utf-8 string of the mqtt protocol"""
+    data = value.encode('utf-8') if isinstance(value, str) else value
+    return struct.pack('!H', len(data)) + data
+
+
+def readString(body, pos):
+    """(string as bytes, position after it)"""
+    length, = struct.unpack_from('!H', body, pos)
+    return body[pos + 2:pos + 2 + length], pos + 2 + length
+
+
+async def readPacket(reader):
+    """(type, flags, body) of the next packet, raises asyncio.IncompleteReadError at the end of the stream"""
+    first = (await reader.readexactly(1))[0]
+    length = 0
+    shift = 0
+    while True:
+        byte = (await reader.readexactly(1))[0]
+        length |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            break
+        shift += 7
+    body = await reader.readexactly(length) if length else b''
+    return first >> 4, first & 0x0f, body
+
+
+def clientId(deviceId):
+    """mqtt client id of a device, in the format of IoT Core (see GcpIotClient.get_client)"""
+    return 'projects/{}/locations/{}/registries/{}/devices/{}'.format(project_id, cloud_region, registry_id, deviceId)
+
+
+def deviceKey(seed, deviceId):
+    """EC private key of a device, derived from the seed: the broker (even in another process) finds the public key
+    of every device without a registry"""
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives.asymmetric import ec
+
+    digest = hashlib.sha256('{}:{}'.format(seed, deviceId).encode('utf-8')).digest()
+    # the curve order is close to 2 ** 256, the value is a valid private key below it
+    value = int.from_bytes(digest, 'big') % (2 ** 255) + 1
+    return ec.derive_private_key(value, ec.SECP256R1(), default_backend())
+
+
+def parseAddress(value):
+    """'host:port' -> (host, port)"""
+    host, sep, port = value.rpartition(':')
+    return (host or '127.0.0.1', int(port))
+
+
+def parseOutage(value):
+    """'from:to' in sec. after the start -> (from, to)"""
+    start, sep, end = value.partition(':')
+    return (float(start), float(end))
+
+
+class LocalBroker:
+    """Stand-in for the IoT Core mqtt bridge: the mqtt 3.1.1 subset used by the devices (CONNECT, QoS 0/1 PUBLISH,
+    SUBSCRIBE, PINGREQ, DISCONNECT) on a local port, without TLS. A CONNECT is accepted if its password is a token
+    of the project signed by the key of the device in the client id (see deviceKey), like the device registry of
+    IoT Core. QoS 1 messages are acknowledged after 'latency' sec. During an outage (see outage()) all connections
+    are dropped and connects are refused with 'server unavailable'. Connects, messages and the connect handling
+    time (token verification) are counted in 'registry'."""
+
+    def __init__(self, registry, seed=0, latency=0.0, verify=True):
+        self.seed = seed
+        self.latency = latency
+        self.verify = verify
+        self.down = False
+        self.server = None
+        self.port = None
+        self.writers = set()
+        # device id -> public key
+        self.keys = {}
+        self.connects = dict((result, registry.counter('wassermat_loadtest_broker_connects_total',
+                                                       'CONNECTs handled by the broker', {'result': result}))
+                             for result in ('accepted', 'unavailable', 'refused'))
+        self.received = registry.counter('wassermat_loadtest_broker_messages_total', 'Messages received by the broker')
+        self.bytes = registry.counter('wassermat_loadtest_broker_bytes_total', 'Payload bytes received by the broker')
+        self.connectSeconds = registry.histogram('wassermat_loadtest_broker_connect_seconds',
+                                                 'Broker time per CONNECT, token verification included',
+                                                 lowest=1e-6, highest=10.0, subBuckets=4)
+        registry.gauge('wassermat_loadtest_broker_connections', 'Open broker connections',
+                       function=lambda: len(self.writers))
+
+    async def start(self, host='127.0.0.1', port=0):
+        self.server = await asyncio.start_server(self.handle, host, port, backlog=4096)
+        self.port = self.server.sockets[0].getsockname()[1]
+        log.info('Broker listening on %s:%s', host, self.port)
+
+    def outage(self, duration):
+        """Drop all connections and refuse connects for duration sec."""
+        log.warning('Broker outage for %.0fs, dropping %s connections', duration, len(self.writers))
+        self.down = True
+        for writer in list(self.writers):
+            writer.transport.abort()
+        asyncio.get_event_loop().call_later(duration, self.recover)
+
+    def recover(self):
+        log.warning('Broker outage over')
+        self.down = False
+
+    def close(self):
+        for writer in list(self.writers):
+            writer.transport.abort()
+        if self.server is not None:
+            self.server.close()
+
+    def publicKey(self, deviceId):
+        key = self.keys.get(deviceId)
+        if key is None:
+            key = self.keys[deviceId] = deviceKey(self.seed, deviceId).public_key()
+        return key
+
+    def authorize(self, body):
+        """CONNACK return code of a CONNECT"""
+        import jwt
+
+        pos = readString(body, 0)[1]
+        flags = body[pos + 1]
+        client, pos = readString(body, pos + 4)
+        username = password = None
+        if flags & 0x80:
+            username, pos = readString(body, pos)
+        if flags & 0x40:
+            password, pos = readString(body, pos)
+        if self.down:
+            return SERVER_UNAVAILABLE
+        if not self.verify:
+            return ACCEPTED
+        deviceId = client.decode('utf-8', 'replace').rpartition('/')[2]
+        try:
+            jwt.decode(password or b'', self.publicKey(deviceId), algorithms=[ALGORITHM], audience=project_id)
+        except jwt.InvalidTokenError:
+            return NOT_AUTHORIZED
+        return ACCEPTED
+
+    def reply(self, writer, data):
+        if not writer.is_closing():
+            writer.write(data)
+
+    async def handle(self, reader, writer):
+        self.writers.add(writer)
+        try:
+            kind, flags, body = await readPacket(reader)
+            if kind != CONNECT:
+                return
+            start = time.perf_counter()
+            rc = self.authorize(body)
+            self.connectSeconds.observe(time.perf_counter() - start)
+            self.connects[{ACCEPTED: 'accepted', SERVER_UNAVAILABLE: 'unavailable'}.get(rc, 'refused')].inc()
+            writer.write(packet(CONNACK, 0, bytes([0, rc])))
+            if rc != ACCEPTED:
+                return
+            loop = asyncio.get_event_loop()
+            while True:
+                kind, flags, body = await readPacket(reader)
+                if kind == PUBLISH:
+                    qos = flags >> 1 & 3
+                    pos = readString(body, 0)[1]
+                    if qos:
+                        pos += 2
+                    self.received.inc()
+                    self.bytes.inc(len(body) - pos)
+                    if qos:
+                        puback = packet(PUBACK, 0, body[pos - 2:pos])
+                        if self.latency:
+                            loop.call_later(self.latency, self.reply, writer, puback)
+                        else:
+                            writer.write(puback)
+                elif kind == SUBSCRIBE:
+                    # packet id, then (topic, qos) pairs: grant the requested qos
+                    pos = 2
+                    granted = bytearray()
+                    while pos < len(body):
+                        pos = readString(body, pos)[1]
+                        granted.append(body[pos])
+                        pos += 1
+                    writer.write(packet(SUBACK, 0, body[:2] + bytes(granted)))
+                elif kind == PINGREQ:
+                    writer.write(packet(PINGRESP, 0, b''))
+                elif kind == DISCONNECT:
+                    return
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.writers.discard(writer)
+            writer.close()
+
+
+class DeviceConnection:
+    """Client side of the mqtt connection of a device, with the publish() of the paho client used by
+    InflightPublisher"""
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.mid = 0
+
+    def nextMid(self):
+        self.mid = self.mid % 0xffff + 1
+        return self.mid
+
+    def publish(self, topic, payload, qos=0):
+        if self.writer.is_closing():
+            return MessageInfo(MQTT_ERR_NO_CONN, None)
+        mid = self.nextMid() if qos else None
+        body = string(topic) + (struct.pack('!H', mid) if qos else b'') + payload
+        self.writer.write(packet(PUBLISH, qos << 1, body))
+        return MessageInfo(MQTT_ERR_SUCCESS, mid)
+
+    def subscribe(self, topic, qos=0):
+        self.writer.write(packet(SUBSCRIBE, 2, struct.pack('!H', self.nextMid()) + string(topic) + bytes([qos])))
+
+    def close(self):
+        if not self.writer.is_closing():
+            self.writer.write(packet(DISCONNECT, 0, b''))
+            self.writer.close()
+
+
+class HumidityTrace:
+    """Soil moisture of one plant on trace time, 'speed' times real time: dries exponentially towards FLOOR, faster
+    while the light is on (08:00 to 20:00 trace time), the pump starts below a threshold and waters towards
+    SATURATION for a few seconds. Each device draws its own parameters from rng."""
+
+    def __init__(self, rng, speed, start):
+        self.rng = rng
+        self.speed = speed
+        self.start = start
+        self.moisture = rng.uniform(35.0, 70.0)
+        self.halfLife = rng.uniform(2.0, 6.0) * 86400
+        self.threshold = rng.uniform(30.0, 45.0)
+        self.pumpSeconds = rng.uniform(10.0, 40.0)
+        self.noise = rng.uniform(0.2, 1.0)
+        # time of day at the start, in sec.
+        self.offset = rng.uniform(0, 86400)
+        self.last = self.offset
+        self.pumpUntil = None
+
+    def sample(self, now):
+        """(humidity, pump active, light active) at the real time now"""
+        t = self.offset + (now - self.start) * self.speed
+        dt = max(0.0, t - self.last)
+        self.last = t
+        light = 8 * 3600 <= t % 86400 < 20 * 3600
+        if self.pumpUntil is not None:
+            self.moisture += (SATURATION - self.moisture) * (1 - math.exp(-min(dt, self.pumpSeconds) / PUMP_TAU))
+            if t >= self.pumpUntil:
+                self.pumpUntil = None
+        else:
+            rate = math.log(2) / self.halfLife * (2.0 if light else 1.0)
+            self.moisture = FLOOR + (self.moisture - FLOOR) * math.exp(-dt * rate)
+            if self.moisture < self.threshold:
+                self.pumpUntil = t + self.pumpSeconds
+        humidity = max(0.0, min(100.0, self.moisture + self.rng.gauss(0, self.noise)))
+        return round(humidity, 1), self.pumpUntil is not None, light
+
+
+class VirtualDevice:
+    """One device of the fleet with its own id, key and tokens and the publish path of GcpIotClient: the humidity
+    trace is sampled into a DataProvider every poll interval, every send interval a sample of the window is
+    encoded (json or binary batches) into the backlog, which is published through an InflightPublisher. Messages
+    lost with a connection are published again after the reconnect, failed connects back off like GcpIotClient.
+    The backlog is held in memory, as the spool cursor of GcpIotClient: acknowledged messages are removed, a
+    reconnect rewinds to the oldest message left."""
+
+    def __init__(self, fleet, index):
+        self.fleet = fleet
+        config = fleet.config
+        self.deviceId = '{}{:05d}'.format(fleet.prefix, index)
+        self.clientId = clientId(self.deviceId)
+        self.topic = '/devices/{}/{}'.format(self.deviceId, sub_topic)
+        self.key = deviceKey(fleet.seed, self.deviceId)
+        self.rng = random.Random('{}:{}'.format(fleet.seed, index))
+        self.trace = HumidityTrace(self.rng, fleet.speed, time.time())
+        self.data = DataProvider(config.data_buffer_size, registry=fleet.registry)
+        self.publisher = InflightPublisher(window=config.publish_window, timeout=config.publish_ack_timeout,
+                                           onAck=self.onAck, registry=fleet.registry)
+        self.batcher = None
+        if config.telemetry_encoding == 'binary':
+            self.batcher = TelemetryBatcher(config.telemetry_batch_size, config.telemetry_batch_seconds)
+        # sequence number -> (creation time, payload) of the messages not acknowledged yet
+        self.backlog = collections.OrderedDict()
+        self.seq = 0
+        # next message to publish
+        self.cursor = 0
+        self.connection = None
+        self.connectedSince = None
+
+    def token(self):
+        """JWT for the password, the claims of CredentialManager.sign()"""
+        import jwt
+        iat = datetime.datetime.utcnow()
+        claims = {'iat': iat, 'exp': iat + datetime.timedelta(minutes=jwt_expires_minutes), 'aud': project_id}
+        return jwt.encode(claims, self.key, algorithm=ALGORITHM)
+
+    def encode(self, timestamp, sample):
+        """Payloads of a sample, as GcpIotClient.encode_sample()"""
+        if self.batcher is None:
+            return [json.dumps(sample).encode('utf-8')]
+        payload = self.batcher.add(timestamp, sample['humidity'], sample['pump_active'], sample['light_active'])
+        return [payload] if payload is not None else []
+
+    def spoolSample(self, timestamp):
+        sample = self.data.getSample(statistics=self.fleet.config.publish_statistics)
+        created = time.monotonic()
+        for payload in self.encode(timestamp, sample):
+            self.backlog[self.seq] = (created, payload)
+            self.seq += 1
+            self.fleet.created.inc()
+        if self.connection is not None:
+            self.publisher.retransmitExpired()
+            self.publishPending()
+
+    def publishPending(self):
+        """Publish from the cursor until the inflight window is full"""
+        while self.cursor < self.seq and self.publisher.free() > 0:
+            entry = self.backlog.get(self.cursor)
+            if entry is not None and not self.publisher.publish(self.topic, entry[1], self.cursor):
+                return
+            self.cursor += 1
+
+    def onAck(self, seq):
+        entry = self.backlog.pop(seq, None)
+        if entry is None:
+            return
+        self.fleet.acked.inc()
+        # messages created before the current connection were replayed after a reconnect
+        path = 'replay' if entry[0] < self.connectedSince else 'live'
+        self.fleet.endToEnd[path].observe(time.monotonic() - entry[0])
+
+    async def sample(self):
+        """Poll the trace every poll interval, spool a sample every send interval"""
+        config = self.fleet.config
+        # the devices are not in phase
+        await asyncio.sleep(self.rng.uniform(0, config.device_poll_interval))
+        nextSend = time.monotonic() + self.rng.uniform(0, config.gcp_send_interval)
+        while True:
+            now = time.time()
+            humidity, pumpActive, lightActive = self.trace.sample(now)
+            self.data.setData(humidity, pumpActive, lightActive)
+            if time.monotonic() >= nextSend:
+                nextSend += config.gcp_send_interval
+                self.spoolSample(now)
+            await asyncio.sleep(config.device_poll_interval)
+
+    async def connect(self):
+        """Open a connection, returns the CONNACK return code (None if the connection failed)"""
+        host, port = self.fleet.broker
+        try:
+            reader, writer = await asyncio.open_connection(host, port)
+        except OSError:
+            return None
+        writer.write(packet(CONNECT, 0, string('MQTT') + bytes([4, CONNECT_FLAGS]) + struct.pack('!H', KEEPALIVE) +
+                            string(self.clientId) + string('unused') + string(self.token())))
+        try:
+            kind, flags, body = await asyncio.wait_for(readPacket(reader), CONNECT_TIMEOUT)
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+            writer.close()
+            return None
+        rc = body[1] if kind == CONNACK and len(body) == 2 else None
+        if rc != ACCEPTED:
+            writer.close()
+            return rc
+        self.connection = DeviceConnection(reader, writer)
+        self.connectedSince = time.monotonic()
+        # (re-)subscribe after every connect, as GcpIotClient.on_connect
+        self.connection.subscribe('/devices/{}/config'.format(self.deviceId), 1)
+        self.connection.subscribe('/devices/{}/commands/#'.format(self.deviceId), 0)
+        self.publisher.attach(self.connection)
+        self.cursor = next(iter(self.backlog), self.seq)
+        self.publishPending()
+        return rc
+
+    async def receive(self):
+        """Process the packets of the connection until it is lost"""
+        connection = self.connection
+        try:
+            while True:
+                kind, flags, body = await readPacket(connection.reader)
+                if kind == PUBACK:
+                    self.publisher.onPublish(struct.unpack('!H', body)[0])
+                    self.publishPending()
+                elif kind == PUBLISH and flags >> 1 & 3:
+                    # config or command message
+                    pos = readString(body, 0)[1]
+                    connection.writer.write(packet(PUBACK, 0, body[pos:pos + 2]))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            connection.close()
+            self.connection = None
+            self.publisher.reset()
+
+    async def run(self, delay):
+        """Connect after delay sec., keep connected and publishing until cancelled"""
+        await asyncio.sleep(delay)
+        fleet = self.fleet
+        sampling = asyncio.ensure_future(self.sample())
+        backoff = minimum_backoff_time
+        try:
+            while True:
+                rc = await self.connect()
+                if rc != ACCEPTED:
+                    fleet.connects['failed' if rc is None else 'refused'].inc()
+                    await asyncio.sleep(backoff + self.rng.randint(0, 1000) / 1000.0)
+                    backoff = min(backoff * 2, MAXIMUM_BACKOFF_TIME)
+                    continue
+                fleet.connects['accepted'].inc()
+                fleet.connected += 1
+                backoff = minimum_backoff_time
+                try:
+                    await self.receive()
+                finally:
+                    fleet.connected -= 1
+                fleet.disconnects.inc()
+                # the next loop waits with backoff, as GcpIotClient after a disconnect
+                await asyncio.sleep(backoff + self.rng.randint(0, 1000) / 1000.0)
+        finally:
+            sampling.cancel()
+
+
+class Fleet:
+    """The virtual devices and the measurements of a run: one timeline row per second (connected devices, created,
+    acknowledged and received messages, connects, disconnects, backlog and event loop lag)."""
+
+    def __init__(self, config, devices, broker, speed=1440.0, seed=0, prefix='load'):
+        self.config = config
+        self.broker = broker
+        self.speed = speed
+        self.seed = seed
+        self.prefix = prefix
+        self.registry = Registry()
+        self.connected = 0
+        self.created = self.registry.counter('wassermat_loadtest_created_total', 'Messages created by the devices')
+        self.acked = self.registry.counter('wassermat_loadtest_acked_total', 'Messages acknowledged by the broker')
+        self.disconnects = self.registry.counter('wassermat_loadtest_disconnects_total', 'Connections lost')
+        self.connects = dict((result, self.registry.counter('wassermat_loadtest_connects_total', 'Device connects',
+                                                            {'result': result}))
+                             for result in ('accepted', 'refused', 'failed'))
+        # from the creation of a message to its ack, live or replayed after a reconnect
+        self.endToEnd = dict((path, self.registry.histogram('wassermat_loadtest_end_to_end_seconds',
+                                                            'Time from sample to broker ack', {'path': path},
+                                                            lowest=1e-4, highest=3600.0, subBuckets=8))
+                             for path in ('live', 'replay'))
+        self.loopLag = self.registry.histogram('wassermat_loadtest_loop_lag_seconds', 'Event loop lag',
+                                               lowest=1e-5, highest=100.0, subBuckets=4)
+        self.devices = [VirtualDevice(self, index) for index in range(devices)]
+        self.timeline = []
+        # largest event loop lag since the last timeline row
+        self.lagMax = 0.0
+
+    async def monitorLag(self, interval=0.05):
+        """Lateness of a periodic timer, a lagging loop means the numbers are limited by this process"""
+        while True:
+            start = time.monotonic()
+            await asyncio.sleep(interval)
+            lag = max(0.0, time.monotonic() - start - interval)
+            self.loopLag.observe(lag)
+            self.lagMax = max(self.lagMax, lag)
+
+    async def record(self, localBroker):
+        start = time.monotonic()
+        previous = None
+        tick = 1
+        while True:
+            await asyncio.sleep(max(0.0, start + tick - time.monotonic()))
+            values = {'created': self.created.value, 'acked': self.acked.value,
+                      'connects': self.connects['accepted'].value,
+                      'refused': self.connects['refused'].value + self.connects['failed'].value,
+                      'disconnects': self.disconnects.value}
+            if localBroker is not None:
+                values['received'] = localBroker.received.value
+            row = dict((key, value - previous[key]) if previous else (key, value) for key, value in values.items())
+            row.update({'t': tick, 'connected': self.connected, 'loop_lag_max': round(self.lagMax, 4),
+                        'backlog': sum(len(device.backlog) for device in self.devices)})
+            self.lagMax = 0.0
+            self.timeline.append(row)
+            previous = values
+            tick += 1
+
+    async def run(self, duration, ramp, outages=(), localBroker=None):
+        loop = asyncio.get_event_loop()
+        tasks = [asyncio.ensure_future(self.record(localBroker)), asyncio.ensure_future(self.monitorLag())]
+        for index, device in enumerate(self.devices):
+            tasks.append(asyncio.ensure_future(device.run(ramp * index / len(self.devices))))
+        if localBroker is not None:
+            for start, end in outages:
+                loop.call_later(start, localBroker.outage, end - start)
+        try:
+            await asyncio.sleep(duration)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def outageSummaries(timeline, devices):
+    """Connection drops after the whole fleet was connected, until it is connected again: dropped devices, refused
+    connects, the connect storm after the broker came back (time to reconnect all devices, peak connect rate) and
+    the time until the backlog drained"""
+    summaries = []
+    connected = False
+    start = None
+    for index, row in enumerate(timeline):
+        if row['connected'] >= devices:
+            if start is not None:
+                summaries.append(outageSummary(timeline, start, index))
+                start = None
+            connected = True
+        elif connected and start is None and row['disconnects']:
+            start = index
+    if start is not None:
+        summaries.append(outageSummary(timeline, start, None))
+    return summaries
+
+
+def outageSummary(timeline, start, end):
+    rows = timeline[start:end + 1 if end is not None else None]
+    lowest = min(range(len(rows)), key=lambda i: rows[i]['connected'])
+    # the broker is back with the first accepted connect after the lowest point
+    back = next((i for i in range(lowest, len(rows)) if rows[i]['connects']), None)
+    before = timeline[start - 1]['backlog'] if start else 0
+    drained = None
+    if end is not None:
+        drained = next((row['t'] for row in timeline[end:] if row['backlog'] <= before), None)
+    return {'start': rows[0]['t'], 'dropped': sum(row['disconnects'] for row in rows),
+            'lowest_connected': rows[lowest]['connected'], 'refused': sum(row['refused'] for row in rows),
+            'storm_seconds': rows[-1]['t'] - rows[back]['t'] + 1 if back is not None and end is not None else None,
+            'peak_connects_per_sec': max(row['connects'] for row in rows[back:]) if back is not None else 0,
+            'backlog_peak': max(row['backlog'] for row in timeline[start:]),
+            'drained_seconds': drained - rows[0]['t'] if drained is not None else None}
+
+
+def sustained(timeline, warmup, outages):
+    """Mean rates per second outside the warm-up and the outages (until their backlog drained)"""
+    excluded = []
+    for outage in outages:
+        end = outage['start'] + outage['drained_seconds'] if outage['drained_seconds'] is not None else math.inf
+        excluded.append((outage['start'], end))
+    rows = [row for row in timeline
+            if row['t'] > warmup and not any(start <= row['t'] <= end for start, end in excluded)]
+    if not rows:
+        return None
+    return dict(('{}_per_sec'.format(key), sum(row[key] for row in rows) / len(rows))
+                for key in ('created', 'acked', 'received') if key in rows[0])
+
+
+def summarize(fleet, args, cpu, wallTime):
+    registry = fleet.registry
+    ackLatency = registry.histogram('wassermat_publish_ack_seconds', 'Time from publish to broker ack')
+    connectSeconds = registry.metrics.get(('wassermat_loadtest_broker_connect_seconds', ()))
+    outages = outageSummaries(fleet.timeline, len(fleet.devices))
+    return {
+        'devices': len(fleet.devices),
+        'duration': args.duration,
+        'send_interval': fleet.config.gcp_send_interval,
+        'encoding': fleet.config.telemetry_encoding,
+        'sustained': sustained(fleet.timeline, args.ramp + fleet.config.gcp_send_interval, outages),
+        'ack_latency_p50': ackLatency.quantile(0.5),
+        'ack_latency_p99': ackLatency.quantile(0.99),
+        'end_to_end_p50': fleet.endToEnd['live'].quantile(0.5),
+        'end_to_end_p99': fleet.endToEnd['live'].quantile(0.99),
+        'replay_end_to_end_p99': fleet.endToEnd['replay'].quantile(0.99),
+        'replayed': fleet.endToEnd['replay'].count,
+        'connect_p99': connectSeconds.quantile(0.99) if connectSeconds is not None else None,
+        'outages': outages,
+        'loop_lag_p99': fleet.loopLag.quantile(0.99),
+        'cpu_ratio': cpu / wallTime,
+        'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'timeline': fleet.timeline,
+    }
+
+
+def ms(value):
+    return '{:.1f}ms'.format(value * 1000) if value is not None else '-'
+
+
+def printSummary(summary):
+    print('{devices} devices, {duration:.0f}s, {encoding} every {send_interval:.0f}s'.format(**summary))
+    rates = summary['sustained']
+    if rates is not None:
+        print('sustained: {acked_per_sec:.1f} msg/s acked (offered {created_per_sec:.1f} msg/s)'.format(**rates) +
+              (', broker received {received_per_sec:.1f} msg/s'.format(**rates) if 'received_per_sec' in rates else ''))
+    print('latency (bucket upper bounds): ack p50 {} p99 {}, end-to-end p50 {} p99 {}, {} replayed messages p99 {}'
+          .format(ms(summary['ack_latency_p50']), ms(summary['ack_latency_p99']), ms(summary['end_to_end_p50']),
+                  ms(summary['end_to_end_p99']), summary['replayed'], ms(summary['replay_end_to_end_p99'])))
+    for outage in summary['outages']:
+        print('outage at {start}s: {dropped} disconnects, {refused} connects refused, all devices reconnected {} '
+              'after the broker came back (peak {peak_connects_per_sec} connects/s), backlog peak {backlog_peak} '
+              'drained after {}'.format('in {}s'.format(outage['storm_seconds'])
+                                        if outage['storm_seconds'] is not None else 'never',
+                                        '{}s'.format(outage['drained_seconds'])
+                                        if outage['drained_seconds'] is not None else 'never', **outage))
+    print('broker connect p99 {}, event loop lag p99 {}, cpu {:.0%}, max rss {} kB'.format(
+        ms(summary['connect_p99']), ms(summary['loop_lag_p99']), summary['cpu_ratio'], summary['max_rss_kb']))
+    if summary['loop_lag_p99'] is not None and summary['loop_lag_p99'] > 0.1:
+        print('WARNING: the event loop lagged, the load test process is the bottleneck, run the broker with --serve '
+              'in another process')
+
+
+def raiseFileLimit(needed):
+    """Raise the open files limit to the hard limit, two sockets per device with the broker in this process"""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < needed:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard if hard == resource.RLIM_INFINITY else min(hard, needed),
+                                                    hard))
+        soft = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+        if soft != resource.RLIM_INFINITY and soft < needed:
+            log.warning('Open files limited to %s, %s needed (ulimit -n)', soft, needed)
+
+
+async def serve(args):
+    """Broker stand-in only, until interrupted"""
+    broker = LocalBroker(Registry(), args.seed, args.latency, not args.no_verify)
+    await broker.start(*args.serve)
+    loop = asyncio.get_event_loop()
+    for start, end in args.outage:
+        loop.call_later(start, broker.outage, end - start)
+    print('Broker stand-in on {}:{}'.format(args.serve[0], broker.port))
+    while True:
+        received = broker.received.value
+        await asyncio.sleep(10)
+        print('{} connections, {:.1f} msg/s'.format(len(broker.writers), (broker.received.value - received) / 10.0))
+
+
+async def generate(args, config):
+    fleet = Fleet(config, args.devices, args.broker, speed=args.speed, seed=args.seed, prefix=args.prefix)
+    localBroker = None
+    if args.broker is None:
+        # counted with the metrics of the devices
+        localBroker = LocalBroker(fleet.registry, args.seed, args.latency, not args.no_verify)
+        await localBroker.start()
+        fleet.broker = ('127.0.0.1', localBroker.port)
+    elif args.outage:
+        log.warning('--outage is simulated by the broker stand-in, pass it to the --serve process')
+    try:
+        await fleet.run(args.duration, args.ramp, args.outage, localBroker)
+    finally:
+        if localBroker is not None:
+            localBroker.close()
+    return fleet
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Load test the publish path with a fleet of virtual devices')
+    parser.add_argument('--config', default=DEFAULT_CONFIG, help='config file of the devices (default %(default)s)')
+    parser.add_argument('--set', action='append', default=[], metavar='KEY=VALUE',
+                        help='override a config value, eg. telemetry_encoding=binary or gcp_send_interval=5')
+    parser.add_argument('--devices', type=int, default=1000, help='number of devices (default %(default)s)')
+    parser.add_argument('--duration', type=float, default=60, help='run time in sec. (default %(default)s)')
+    parser.add_argument('--ramp', type=float, default=10,
+                        help='the devices connect one after the other within this time, in sec. (default '
+                             '%(default)s), 0 starts with a connect storm')
+    parser.add_argument('--outage', action='append', default=[], type=parseOutage, metavar='FROM:TO',
+                        help='broker outage, in sec. after the start')
+    parser.add_argument('--latency', type=float, default=0.0, help='broker ack delay in sec.')
+    parser.add_argument('--speed', type=float, default=1440,
+                        help='trace time per real time of the humidity traces (default %(default)s: a day per minute)')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the device keys and traces')
+    parser.add_argument('--prefix', default='load', help='device id prefix (default %(default)s)')
+    parser.add_argument('--no-verify', action='store_true', help='the broker accepts connects without checking tokens')
+    parser.add_argument('--broker', type=parseAddress, default=None, metavar='HOST:PORT',
+                        help='publish to this broker instead of a stand-in in this process')
+    parser.add_argument('--serve', type=parseAddress, default=None, metavar='[HOST:]PORT',
+                        help='run the broker stand-in only, for a load test process started with --broker')
+    parser.add_argument('--output', default=None, help='write the results and the timeline to this json file')
+    parser.add_argument('--verbose', action='store_true', help='log the broker and device events')
+    args = parser.parse_args(argv)
+
+    root = logging.getLogger(logs.ROOT)
+    root.propagate = False
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter(logs.FORMAT))
+    root.addHandler(handler)
+    root.setLevel(logging.INFO if args.verbose else logging.WARNING)
+
+    if args.serve is not None:
+        raiseFileLimit(4096)
+        try:
+            asyncio.run(serve(args))
+        except KeyboardInterrupt:
+            pass
+        return 0
+
+    with open(args.config) as f:
+        config = json.load(f)
+    config.update(parseAssignments(args.set))
+    config = validate(config)
+    raiseFileLimit(args.devices * (1 if args.broker else 2) + 64)
+
+    wallStart = time.monotonic()
+    cpuStart = time.process_time()
+    fleet = asyncio.run(generate(args, config))
+    summary = summarize(fleet, args, time.process_time() - cpuStart, time.monotonic() - wallStart)
+    printSummary(summary)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(summary, f, sort_keys=True, indent=4)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+
+# Logging which never blocks the caller on disk: records go to an in-memory ring buffer, a background thread
+# writes them in batches to a size rotated file (or stderr).
+
+import collections
+import logging
+import os
+import sys
+import threading
+import time
+
+ROOT = 'wassermat'
+LEVELS = {'debug': logging.DEBUG, 'info': logging.INFO, 'warning': logging.WARNING, 'error': logging.ERROR}
+FORMAT = '%(asctime)s %(levelname)s %(name)s: %(message)s'
+
+
+def getLogger(component):
+    """Logger of a component, eg. getLogger('device') -> 'wassermat.device'"""
+    return logging.getLogger(ROOT + '.' + component)
+
+
+class RingBufferHandler(logging.Handler):
+    """Formats records on the caller's thread and appends the lines to a bounded in-memory buffer, the oldest lines
+    are dropped (and counted) if the writer falls behind. On top of the level filter:
+    - consecutive identical messages of a logger are collapsed into the first one and a 'repeated n times' line
+    - each logger may log 'rate' lines per sec. with bursts of 'burst' lines, further lines are suppressed and
+      counted in the next line of the logger that passes
+    emit() never does I/O, the writer is woken up when 'batchLines' lines are pending.
+    """
+
+    def __init__(self, capacity=4096, rate=20.0, burst=100, batchLines=256, clock=time.monotonic):
+        super(RingBufferHandler, self).__init__()
+        self.lines = collections.deque(maxlen=capacity)
+        self.dropped = 0
+        self.rate = rate
+        self.burst = burst
+        self.batchLines = batchLines
+        self.clock = clock
+        self.ready = threading.Event()
+        # logger name -> [tokens, last refill time, suppressed lines]
+        self.buckets = {}
+        # (logger name, level, message) of the last line and its repeats
+        self.last = None
+        self.lastRecord = None
+        self.repeats = 0
+
+    def append(self, line):
+        if len(self.lines) == self.lines.maxlen:
+            self.dropped += 1
+        self.lines.append(line)
+        if len(self.lines) >= self.batchLines:
+            self.ready.set()
+
+    def admit(self, name):
+        """Token bucket of a logger, returns the number of lines suppressed before or None if this one is too"""
+        now = self.clock()
+        bucket = self.buckets.get(name)
+        if bucket is None:
+            bucket = self.buckets[name] = [float(self.burst), now, 0]
+        bucket[0] = min(float(self.burst), bucket[0] + (now - bucket[1]) * self.rate)
+        bucket[1] = now
+        if bucket[0] < 1.0:
+            bucket[2] += 1
+            return None
+        bucket[0] -= 1.0
+        suppressed = bucket[2]
+        bucket[2] = 0
+        return suppressed
+
+    def flushRepeats(self):
+        """Append the 'repeated' line of the last message, call with the handler lock held"""
+        if self.repeats:
+            record = self.lastRecord
+            self.append('{} {} {}: last message repeated {} times'.format(
+                self.formatTime(record), record.levelname, record.name, self.repeats))
+            self.repeats = 0
+
+    def formatTime(self, record):
+        return self.formatter.formatTime(record) if self.formatter else logging.Formatter().formatTime(record)
+
+    def emit(self, record):
+        try:
+            message = record.getMessage()
+            key = (record.name, record.levelno, message)
+            if key == self.last and not record.exc_info:
+                self.repeats += 1
+                self.lastRecord = record
+                return
+            self.flushRepeats()
+            self.last = key
+            self.lastRecord = record
+            suppressed = self.admit(record.name)
+            if suppressed is None:
+                return
+            if suppressed:
+                self.append('{} WARNING {}: {} lines suppressed by the rate limit'.format(
+                    self.formatTime(record), record.name, suppressed))
+            self.append(self.format(record))
+        except Exception:
+            self.handleError(record)
+
+    def drain(self):
+        """Remove and return the pending lines, with the line about dropped lines if any"""
+        self.acquire()
+        try:
+            # repeats pending since the last drain are reported with this batch
+            self.flushRepeats()
+            self.last = None
+            dropped = self.dropped
+            self.dropped = 0
+            for name, bucket in self.buckets.items():
+                if bucket[2]:
+                    self.append('{} lines of {} suppressed by the rate limit'.format(bucket[2], name))
+                    bucket[2] = 0
+            self.ready.clear()
+        finally:
+            self.release()
+        lines = []
+        popleft = self.lines.popleft
+        try:
+            while True:
+                lines.append(popleft())
+        except IndexError:
+            pass
+        if dropped:
+            lines.append('{} lines dropped, log buffer full'.format(dropped))
+        return lines
+
+
+class RotatingLogFile:
+    """Appends to 'path', rotates to path.1 ... path.<backups> when the file would grow beyond maxBytes"""
+
+    def __init__(self, path, maxBytes=1000000, backups=3):
+        self.path = path
+        self.maxBytes = maxBytes
+        self.backups = backups
+        self.file = open(path, 'a')
+        self.size = self.file.tell()
+
+    def rotate(self):
+        self.file.close()
+        for i in range(self.backups - 1, 0, -1):
+            source = '{}.{}'.format(self.path, i)
+            if os.path.exists(source):
+                os.replace(source, '{}.{}'.format(self.path, i + 1))
+        if self.backups > 0:
+            os.replace(self.path, self.path + '.1')
+        else:
+            os.remove(self.path)
+        self.file = open(self.path, 'a')
+        self.size = 0
+
+    def write(self, text):
+        if self.size and self.size + len(text) > self.maxBytes:
+            self.rotate()
+        self.file.write(text)
+        self.file.flush()
+        self.size += len(text)
+
+    def close(self):
+        self.file.close()
+
+
+class StreamLog:
+    """Writes batches to a stream (stderr by default, eg. for journald)"""
+
+    def __init__(self, stream=None):
+        self.stream = stream if stream is not None else sys.stderr
+
+    def write(self, text):
+        self.stream.write(text)
+        self.stream.flush()
+
+    def close(self):
+        pass
+
+
+class LogWriter(threading.Thread):
+    """Background writer of a RingBufferHandler: writes the pending lines with one write call every
+    'flushInterval' sec., or earlier if the handler signals a full batch. close() writes the rest."""
+
+    def __init__(self, handler, output, flushInterval=10.0):
+        super(LogWriter, self).__init__(name='LogWriter')
+        self.daemon = True
+        self.handler = handler
+        self.output = output
+        self.flushInterval = flushInterval
+        self.stopped = threading.Event()
+
+    def flush(self):
+        lines = self.handler.drain()
+        if lines:
+            try:
+                self.output.write('\n'.join(lines) + '\n')
+            except OSError as e:
+                # disk full or removed, the lines are lost but logging goes on
+                sys.stderr.write('log write failed: {}\n'.format(e))
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.handler.ready.wait(self.flushInterval)
+            self.flush()
+
+    def close(self):
+        self.stopped.set()
+        self.handler.ready.set()
+        if self.is_alive():
+            self.join()
+        self.flush()
+        self.output.close()
+
+
+def applyLevels(snapshot):
+    """Set the level of the root logger (log_level) and of single components (log_levels, eg. {"device": "debug"}).
+    Components not listed in log_levels (anymore) follow the root logger."""
+    logging.getLogger(ROOT).setLevel(LEVELS[snapshot.log_level])
+    levels = snapshot.log_levels or {}
+    for name, logger in list(logging.Logger.manager.loggerDict.items()):
+        if isinstance(logger, logging.Logger) and name.startswith(ROOT + '.'):
+            logger.setLevel(logging.NOTSET)
+    for component, level in levels.items():
+        getLogger(component).setLevel(LEVELS[level])
+
+
+def setupLogging(configurationProvider, process=None):
+    """Route the wassermat loggers through a ring buffer to a LogWriter on log_file (stderr if not set), levels
+    follow the config. A child process (see processes.py) passes its name and writes its own file, eg.
+    wassermat.sampler.log, the files are rotated by one process each. Returns the started writer, close it on exit"""
+    config = configurationProvider.snapshot
+    handler = RingBufferHandler(config.log_buffer_lines, config.log_rate_limit, config.log_rate_burst)
+    handler.setFormatter(logging.Formatter(FORMAT))
+    if config.log_file:
+        path = config.log_file
+        if process is not None:
+            root, extension = os.path.splitext(path)
+            path = '{}.{}{}'.format(root, process, extension)
+        output = RotatingLogFile(path, config.log_max_bytes, config.log_backups)
+    else:
+        output = StreamLog()
+    writer = LogWriter(handler, output, config.log_flush_interval)
+
+    root = logging.getLogger(ROOT)
+    root.addHandler(handler)
+    # the lines are written by the writer only
+    root.propagate = False
+    applyLevels(config)
+    configurationProvider.subscribe(applyLevels)
+    writer.start()
+    return writer
@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+
+# Runtime metrics of the control loop and the cloud client, exposed in the Prometheus text format over http on a
+# local port or a unix socket.
+
+import http.server
+import math
+import os
+import socketserver
+import threading
+
+from logs import getLogger
+
+log = getLogger('metrics')
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def formatLabels(labels, extra=None):
+    items = list(labels) + ([extra] if extra is not None else [])
+    if not items:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in items) + '}'
+
+
+def formatValue(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """Monotonic counter. Updated without a lock: every metric has a single writer thread, readers may see a value
+    which is one update behind"""
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self):
+        yield self.name, self.labels, self.value
+
+
+class Gauge:
+    """Current value, either set by its writer or read from 'function' when the metrics are collected"""
+    kind = 'gauge'
+
+    def __init__(self, name, help, labels=(), function=None):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.value = 0
+        self.function = function
+
+    def set(self, value):
+        self.value = value
+
+    def samples(self):
+        yield self.name, self.labels, self.function() if self.function is not None else self.value
+
+
+class Histogram:
+    """HDR-style histogram with log-linear buckets: the bucket bounds double every 'subBuckets' buckets from
+    'lowest' up to 'highest', so the relative error of a value is at most 2 ** (1 / subBuckets) over the whole
+    range. observe() is a log2 and three additions, without lock (single writer, see Counter); quantile()
+    estimates a quantile from the bucket counts"""
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), lowest=1e-6, highest=100.0, subBuckets=2):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.lowest = lowest
+        self.subBuckets = subBuckets
+        size = int(math.ceil(math.log2(highest / lowest) * subBuckets))
+        self.bounds = [lowest * 2 ** (i / subBuckets) for i in range(size + 1)]
+        # the last bucket counts the values above highest
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def index(self, value):
+        if value <= self.lowest:
+            return 0
+        index = int(math.ceil(math.log2(value / self.lowest) * self.subBuckets - 1e-9))
+        return min(index, len(self.bounds))
+
+    def observe(self, value):
+        self.counts[self.index(value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """Upper bound of the bucket containing the q-th quantile (0..1), None if empty"""
+        counts = list(self.counts)
+        total = sum(counts)
+        if not total:
+            return None
+        rank = q * total
+        cumulative = 0
+        for index, count in enumerate(counts):
+            cumulative += count
+            if cumulative >= rank and count:
+                return self.bounds[index] if index < len(self.bounds) else math.inf
+        return math.inf
+
+    def samples(self):
+        counts = list(self.counts)
+        cumulative = 0
+        for bound, count in zip(self.bounds, counts):
+            cumulative += count
+            yield self.name + '_bucket', self.labels + (('le', '{:.6g}'.format(bound)),), cumulative
+        cumulative += counts[-1]
+        yield self.name + '_bucket', self.labels + (('le', '+Inf'),), cumulative
+        yield self.name + '_sum', self.labels, self.sum
+        yield self.name + '_count', self.labels, cumulative
+
+
+class Registry:
+    """The metrics of the process. Metrics are created once by name and labels, creating a metric again returns
+    the existing one, so several instances of a component (eg. in the simulation) share their metrics"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # (name, labels) -> metric, in registration order
+        self.metrics = {}
+
+    def register(self, cls, name, help, labels=(), **kwargs):
+        key = (name, tuple(sorted(labels.items())) if isinstance(labels, dict) else tuple(labels))
+        with self.lock:
+            metric = self.metrics.get(key)
+            if metric is None:
+                metric = cls(name, help, key[1], **kwargs)
+                self.metrics[key] = metric
+            elif 'function' in kwargs:
+                # the latest instance of the component provides the value
+                metric.function = kwargs['function']
+            return metric
+
+    def counter(self, name, help, labels=()):
+        return self.register(Counter, name, help, labels)
+
+    def gauge(self, name, help, labels=(), function=None):
+        return self.register(Gauge, name, help, labels, function=function)
+
+    def histogram(self, name, help, labels=(), lowest=1e-6, highest=100.0, subBuckets=2):
+        return self.register(Histogram, name, help, labels, lowest=lowest, highest=highest, subBuckets=subBuckets)
+
+    def exposition(self):
+        """All metrics in the Prometheus text format"""
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        described = set()
+        for metric in metrics:
+            if metric.name not in described:
+                described.add(metric.name)
+                lines.append('# HELP {} {}'.format(metric.name, metric.help))
+                lines.append('# TYPE {} {}'.format(metric.name, metric.kind))
+            for name, labels, value in metric.samples():
+                lines.append('{}{} {}'.format(name, formatLabels(labels), formatValue(value)))
+        return '\n'.join(lines) + '\n'
+
+
+# the registry of the process, used by the components unless they get another one
+REGISTRY = Registry()
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    """Serves the registry on GET /metrics (and /)"""
+
+    def do_GET(self):
+        if self.path not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.server.registry.exposition().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # unix socket clients have no address
+        return str(self.client_address[0]) if self.client_address else 'unix'
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TcpMetricsServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+class UnixMetricsServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class MetricsServer(threading.Thread):
+    """Serves the metrics over http on 'host':'port', or on the unix socket 'socketPath' if given
+    (curl --unix-socket <path> http://localhost/metrics). Daemon thread, stopped by close()"""
+
+    def __init__(self, registry=None, host='127.0.0.1', port=None, socketPath=None):
+        super(MetricsServer, self).__init__()
+        self.daemon = True
+        if socketPath:
+            if os.path.exists(socketPath):
+                os.unlink(socketPath)
+            self.server = UnixMetricsServer(socketPath, MetricsHandler)
+            self.address = socketPath
+        else:
+            self.server = TcpMetricsServer((host, port), MetricsHandler)
+            self.address = '{}:{}'.format(*self.server.server_address[:2])
+        self.server.registry = registry if registry is not None else REGISTRY
+        self.socketPath = socketPath
+
+    def run(self):
+        log.info('Metrics served on %s', self.address)
+        self.server.serve_forever()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+        if self.socketPath and os.path.exists(self.socketPath):
+            os.unlink(self.socketPath)
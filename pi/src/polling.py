@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+
+# Adaptive poll interval of the device control loop.
+
+
+class AdaptivePoller:
+    """Chooses the sleep time until the next poll (config value device_poll_mode 'adaptive'):
+    - device_poll_interval while any zone needs attention: its pump runs, its dynamic scheme lag timer runs
+      (humidity below the threshold with the pump off, or above with the pump on), its humidity is within
+      device_poll_near_band % of its watering_threshold (dynamic scheme) or moved more than half the band since the
+      previous poll
+    - otherwise the interval doubles with every poll, up to device_poll_interval_max
+    A zone needing attention is thus noticed after device_poll_interval_max sec. at the latest.
+    """
+
+    def __init__(self):
+        self.interval = None
+        # zone name -> humidity of the previous poll
+        self.previous = {}
+
+    def needsAttention(self, zone, band):
+        if zone.pumpActivated:
+            return True
+        previous = self.previous.get(zone.name)
+        if previous is not None and abs(zone.humidity - previous) > band / 2.0:
+            return True
+        if zone.config['watering_scheme'] != 'dynamic':
+            return False
+        threshold = zone.config['watering_threshold']
+        if zone.humidity < threshold:
+            # lag timer until the pump starts
+            return True
+        return zone.humidity - threshold <= band
+
+    def next(self, config, zones):
+        """Return the sleep time until the next poll"""
+        fast = config.device_poll_interval
+        band = config.device_poll_near_band
+        attention = False
+        for zone in zones:
+            if self.needsAttention(zone, band):
+                attention = True
+            self.previous[zone.name] = zone.humidity
+
+        if attention or self.interval is None:
+            self.interval = fast
+        else:
+            self.interval = min(max(self.interval * 2, fast), max(fast, config.device_poll_interval_max))
+        return self.interval
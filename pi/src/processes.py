@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+
+# Process mode (execution_mode "processes"): sampling and actuation run in their own process, away from the GIL
+# of TLS, JWT signing and json work of the cloud client. The samples are passed through a shared memory ring
+# (see samplering.py), a supervisor restarts either process independently.
+
+import multiprocessing
+import os
+import signal
+import threading
+import time
+
+from logs import getLogger
+
+log = getLogger('supervisor')
+
+# restart delay of a child process which exited, doubled up to MAX_RESTART_DELAY while it keeps failing
+MIN_RESTART_DELAY = 1.0
+MAX_RESTART_DELAY = 60.0
+# a child process which ran that long before exiting is restarted with the minimal delay
+STABLE_RUNTIME = 60.0
+# time given to a child process to stop before it is killed
+STOP_TIMEOUT = 30.0
+
+
+class ConfigWatcher(threading.Thread):
+    """Reloads the config file if it was changed by another process (the publisher writes config messages)"""
+
+    def __init__(self, configurationProvider, stopEvent, interval=2.0):
+        super(ConfigWatcher, self).__init__(name='ConfigWatcher')
+        self.daemon = True
+        self.configurationProvider = configurationProvider
+        self.stopEvent = stopEvent
+        self.interval = interval
+
+    def run(self):
+        path = self.configurationProvider.cfg_file
+        modified = os.stat(path).st_mtime_ns
+        while not self.stopEvent.wait(self.interval):
+            try:
+                current = os.stat(path).st_mtime_ns
+                if current != modified:
+                    modified = current
+                    self.configurationProvider.reload()
+            except (OSError, ValueError) as e:
+                log.warning('Config not reloaded: %s', e)
+
+
+def commandPath(ringPath):
+    """Unix socket of the device commands passed from the publisher to the sampler"""
+    return ringPath + '.commands'
+
+
+def childSignals(stopEvent):
+    """Ctrl-C reaches the whole process group, the supervisor stops the children; a SIGTERM stops this child"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopEvent.set())
+
+
+def runSampler(configFile, ringPath, stopEvent):
+    """Sampler process: DeviceControl writing its samples into the ring, optionally pinned to sampler_cpus"""
+    from commands import CommandReceiver
+    from device_control import DeviceControl
+    from providers import ConfigurationProvider
+    from samplering import RingWriter, SampleRing
+    from logs import setupLogging
+    from components import createCheckpoint, startMetricsServer
+
+    childSignals(stopEvent)
+    configuration = ConfigurationProvider(configFile)
+    logWriter = setupLogging(configuration, 'sampler')
+    cpus = configuration.getParam('sampler_cpus')
+    if cpus:
+        os.sched_setaffinity(0, cpus)
+        log.info('Sampler pinned to CPUs %s', cpus)
+
+    checkpoint = createCheckpoint(configuration, stopEvent, 'sampler')
+    ring = SampleRing(ringPath)
+    control = DeviceControl(RingWriter(ring), configuration, stopEvent, checkpoint=checkpoint)
+    control.start()
+    CommandReceiver(commandPath(ringPath), control, stopEvent).start()
+    ConfigWatcher(configuration, stopEvent).start()
+    if checkpoint is not None:
+        checkpoint.start()
+    metricsServer = startMetricsServer(configuration, 'sampler')
+
+    control.join()
+    if checkpoint is not None:
+        checkpoint.join()
+        # final state, after the pumps are off
+        checkpoint.save()
+    if metricsServer is not None:
+        metricsServer.close()
+    ring.close()
+    log.info('Sampler stopped')
+    logWriter.close()
+
+
+def runPublisher(configFile, ringPath, stopEvent):
+    """Publisher process: copies the samples of the ring into a DataProvider, which feeds GcpIotClient, the history
+    store and the LAN status server as in thread mode"""
+    from commands import CommandDispatcher, CommandSender
+    from gcp_iot_client import GcpIotClient
+    from providers import ConfigurationProvider, DataProvider
+    from samplering import RingFollower, SampleRing
+    from logs import setupLogging
+    from components import createCheckpoint, createStore, startMetricsServer, startStatusServer
+
+    childSignals(stopEvent)
+    configuration = ConfigurationProvider(configFile)
+    logWriter = setupLogging(configuration, 'publisher')
+
+    checkpoint = createCheckpoint(configuration, stopEvent)
+    store = createStore(configuration, stopEvent)
+    data = DataProvider(configuration.getParam('data_buffer_size'), store)
+    ring = SampleRing(ringPath)
+    commands = CommandDispatcher()
+    commands.forward(CommandSender(commandPath(ringPath)))
+    threads = [RingFollower(ring, data, stopEvent),
+               GcpIotClient(data, configuration, stopEvent, checkpoint=checkpoint, commands=commands)]
+    if store is not None:
+        threads.append(store)
+    if checkpoint is not None:
+        threads.append(checkpoint)
+    for thread in threads:
+        thread.start()
+    metricsServer = startMetricsServer(configuration)
+    statusServer = startStatusServer(configuration, data, store)
+
+    for thread in threads:
+        thread.join()
+    if checkpoint is not None:
+        # final state, after the last batch is spooled
+        checkpoint.save()
+    if metricsServer is not None:
+        metricsServer.close()
+    if statusServer is not None:
+        statusServer.close()
+    ring.close()
+    log.info('Publisher stopped')
+    logWriter.close()
+
+
+class Child:
+    """A supervised child process, started again with a growing delay each time it exits early"""
+
+    def __init__(self, context, name, target):
+        self.context = context
+        self.name = name
+        self.target = target
+        self.process = None
+        self.stopEvent = None
+        self.started = None
+        self.restartAt = 0.0
+        self.restartDelay = MIN_RESTART_DELAY
+
+    def start(self, configFile, ringPath):
+        # a child stopped by a SIGTERM has set its event, every run gets a new one
+        self.stopEvent = self.context.Event()
+        self.process = self.context.Process(target=self.target, name=self.name,
+                                            args=(configFile, ringPath, self.stopEvent))
+        self.process.start()
+        self.started = time.monotonic()
+        log.info('Started %s process %s', self.name, self.process.pid)
+
+    def exited(self, now):
+        """Schedule the restart of a child which exited"""
+        runtime = now - self.started
+        log.error('%s process %s exited with %s after %.0fs, restarting in %.0fs', self.name, self.process.pid,
+                  self.process.exitcode, runtime, self.restartDelay if runtime < STABLE_RUNTIME else MIN_RESTART_DELAY)
+        if runtime >= STABLE_RUNTIME:
+            self.restartDelay = MIN_RESTART_DELAY
+        self.restartAt = now + self.restartDelay
+        self.restartDelay = min(MAX_RESTART_DELAY, self.restartDelay * 2)
+        self.process = None
+
+    def stop(self):
+        if self.process is None:
+            return
+        self.stopEvent.set()
+        self.process.join(STOP_TIMEOUT)
+        if self.process.is_alive():
+            log.error('%s process %s did not stop, killing it', self.name, self.process.pid)
+            self.process.kill()
+            self.process.join()
+
+
+class Supervisor:
+    """Runs the sampler and the publisher process (see runSampler and runPublisher) and restarts a process which
+    exited, the other one keeps running: the sampler continues at the write position of the ring and the publisher
+    at its read position, samples are only lost if the ring (sample_ring_size) overflows meanwhile. Setting
+    stopEvent (eg. by a signal) stops both processes and returns from run().
+    The children are spawned, not forked: they start with a fresh interpreter without the threads and locks of the
+    supervisor."""
+
+    def __init__(self, configFile, configurationProvider, stopEvent, interval=1.0):
+        from samplering import SampleRing, defaultPath
+
+        self.configFile = configFile
+        self.stopEvent = stopEvent
+        self.interval = interval
+        self.ringPath = configurationProvider.getParam('sample_ring_file') or defaultPath()
+        self.ring = SampleRing(self.ringPath, configurationProvider.getParam('sample_ring_size'))
+        context = multiprocessing.get_context('spawn')
+        # the sampler first, the pumps must not wait for the cloud connection
+        self.children = [Child(context, 'sampler', runSampler), Child(context, 'publisher', runPublisher)]
+
+    def run(self):
+        log.info('Supervisor starting, sample ring %s', self.ringPath)
+        while not self.stopEvent.is_set():
+            now = time.monotonic()
+            for child in self.children:
+                if child.process is not None and not child.process.is_alive():
+                    child.exited(now)
+                if child.process is None and now >= child.restartAt and not self.stopEvent.is_set():
+                    child.start(self.configFile, self.ringPath)
+            self.stopEvent.wait(self.interval)
+
+        # the sampler first (pumps off, last samples), then the publisher spools the samples left in the ring
+        for child in self.children:
+            child.stop()
+        self.ring.unlink()
+        log.info('Supervisor stopped')
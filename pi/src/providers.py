@@ -1,74 +1,542 @@
 #!/usr/bin/env python3
 
 import json
+import math
 import os.path
 import random
 import threading
+import time
+from array import array
+from collections import OrderedDict, deque
+from collections.abc import Mapping
+
+from clock import SystemClock
+from logs import getLogger
+from metrics import REGISTRY
+
+log = getLogger('config')
+
+class RingStatistics:
+    """Fixed size, array backed ring buffer of numeric samples. Holds at most 'capacity' samples, the oldest
+    sample is evicted when the buffer is full. Count, sum, sum of squares, min and max of the buffered samples
+    are maintained on every add, so add and statistics are O(1) (min/max amortized, using monotonic queues).
+    Not thread-safe, callers synchronize."""
+
+    def __init__(self, capacity=1024):
+        if capacity < 1:
+            raise ValueError('capacity must be at least 1')
+        self.capacity = capacity
+        self.values = array('d', bytes(8 * capacity))
+        self.clear()
+
+    def clear(self):
+        """Remove all samples"""
+        self.start = 0   # sequence number of the oldest buffered sample
+        self.end = 0     # sequence number of the next sample
+        self.total = 0.0
+        self.squares = 0.0
+        # (sequence number, value) pairs with increasing (min) resp. decreasing (max) values
+        self.minQueue = deque()
+        self.maxQueue = deque()
+
+    def __len__(self):
+        return self.end - self.start
+
+    def add(self, value):
+        """Append a sample, evicting the oldest one if the buffer is full"""
+        if self.end - self.start == self.capacity:
+            evicted = self.values[self.start % self.capacity]
+            self.total -= evicted
+            self.squares -= evicted * evicted
+            if self.minQueue[0][0] == self.start:
+                self.minQueue.popleft()
+            if self.maxQueue[0][0] == self.start:
+                self.maxQueue.popleft()
+            self.start += 1
+
+        self.values[self.end % self.capacity] = value
+        self.total += value
+        self.squares += value * value
+        while self.minQueue and self.minQueue[-1][1] >= value:
+            self.minQueue.pop()
+        self.minQueue.append((self.end, value))
+        while self.maxQueue and self.maxQueue[-1][1] <= value:
+            self.maxQueue.pop()
+        self.maxQueue.append((self.end, value))
+        self.end += 1
+
+    def statistics(self):
+        """Return count, mean, min, max and (population) variance of the buffered samples, None values if empty"""
+        count = self.end - self.start
+        if count == 0:
+            return {'count': 0, 'mean': None, 'min': None, 'max': None, 'variance': None}
+        mean = self.total / count
+        return {
+            'count': count,
+            'mean': mean,
+            'min': self.minQueue[0][1],
+            'max': self.maxQueue[0][1],
+            'variance': max(0.0, self.squares / count - mean * mean)
+        }
+
+    def samples(self):
+        """Return the buffered samples, oldest first"""
+        return [self.values[i % self.capacity] for i in range(self.start, self.end)]
+
+
+def windowValues(stats, pumpActive, lightActive, statistics):
+    """Build the reported values of a sample window from its RingStatistics statistics"""
+    result = {}
+    result['humidity'] = 0
+    if stats['count'] > 0:
+        result['humidity'] = stats['mean']
+    result['pump_active'] = pumpActive
+    result['light_active'] = lightActive
+
+    if statistics:
+        result['humidity_min'] = stats['min']
+        result['humidity_max'] = stats['max']
+        result['humidity_stddev'] = None if stats['variance'] is None else math.sqrt(stats['variance'])
+        result['samples'] = stats['count']
+    return result
+
 
 class DataProvider:
-    """Synchronized data entity holder holding value types as lists. Each set operation adds the value
-    to the list of its type. Get operation returns a json structure containing the average of the values of each type.
-    getData/getData methods are thread-safe"""
+    """Synchronized data entity holder. Each set operation adds the humidity value to a fixed size ring buffer
+    (see RingStatistics) and replaces the pump and light state. Get operation returns a json structure containing
+    the average humidity of the window since the last get operation, optionally with min, max, standard deviation
+    and sample count, and clears the window. Both operations are O(1) and thread-safe.
+    With several zones, set operations also pass the values of each zone, which are aggregated the same way and
+    returned in the list 'zones'; the top level values are the ones of the first zone.
+    If a store is given (see timeseries.TimeSeriesStore), every sample is recorded to it as well, with the time of
+    'clock' (see clock.py), the system clock by default.
+    current() returns the latest sample without lock and without clearing the window, eg. for the LAN status server.
+    The lock wait time of both operations and the number of buffered samples are published as metrics."""
 
-    def __init__(self):
+    def __init__(self, capacity=1024, store=None, clock=None, registry=None):
+        self.clock = clock if clock is not None else SystemClock()
+        registry = registry if registry is not None else REGISTRY
+        # one histogram per operation, each has a single writer thread
+        self.setLockWait = registry.histogram('wassermat_data_lock_wait_seconds', 'DataProvider lock wait time',
+                                              {'operation': 'set'}, lowest=1e-7, highest=1.0)
+        self.getLockWait = registry.histogram('wassermat_data_lock_wait_seconds', 'DataProvider lock wait time',
+                                              {'operation': 'get'}, lowest=1e-7, highest=1.0)
+        registry.gauge('wassermat_buffered_samples', 'Samples buffered since the last get operation',
+                       function=lambda: len(self.humidity))
         self.data = {}
+        self.store = store
+        self.capacity = capacity
         self.lock = threading.Lock()
-        self.humidity = []
+        self.humidity = RingStatistics(capacity)
         self.pumpActive = False
         self.lightActive = False
+        # zone name -> [RingStatistics, pump active, light active], in zone order
+        self.zones = OrderedDict()
+        # (version, timestamp, humidity, pump active, light active, zones) of the latest sample, replaced as a whole
+        self.latest = (0, None, None, False, False, ())
 
-    def getData(self):
-        """Get average values of all lists"""
-        result = {}
-        # single threaded
-        self.lock.acquire()
+    def getData(self, statistics=False):
+        """Get average humidity and current pump/light state as json, with window statistics if requested"""
+        return json.dumps(self.getSample(statistics))
 
-        result['humidity'] = 0
-        if (len(self.humidity) > 0):
-            result['humidity'] = sum(self.humidity) / len(self.humidity)
-            self.humidity = [] # clear
+    def getSample(self, statistics=False):
+        """Get average humidity and current pump/light state as dict, with window statistics if requested"""
+        # single threaded
+        if self.lock.acquire(False):
+            # uncontended, no clock reads
+            self.getLockWait.observe(0.0)
+        else:
+            start = time.perf_counter()
+            self.lock.acquire()
+            self.getLockWait.observe(time.perf_counter() - start)
 
-        result['pump_active'] = self.pumpActive
-        result['light_active'] = self.lightActive
+        stats = self.humidity.statistics()
+        self.humidity.clear()
+        pumpActive = self.pumpActive
+        lightActive = self.lightActive
+        zones = []
+        for name, zone in self.zones.items():
+            zones.append((name, zone[0].statistics(), zone[1], zone[2]))
+            zone[0].clear()
 
         self.lock.release()
-        return json.dumps(result)
 
-    def setData(self, humidity, pumpActive, lightActive):
-        self.lock.acquire()
-        self.humidity.append(humidity)
+        result = windowValues(stats, pumpActive, lightActive, statistics)
+        if len(zones) > 1:
+            result['zones'] = []
+            for name, zoneStats, zonePump, zoneLight in zones:
+                zone = windowValues(zoneStats, zonePump, zoneLight, statistics)
+                zone['name'] = name
+                result['zones'].append(zone)
+        return result
+
+    def current(self):
+        """Latest sample as (version, timestamp, humidity, pump active, light active, zones), the version increases
+        with every sample. Does not take the lock"""
+        return self.latest
+
+    def setData(self, humidity, pumpActive, lightActive, zones=None, timestamp=None):
+        """Add a sample, zones is an optional list of (name, humidity, pump active, light active) tuples. timestamp
+        is the time of the sample if it was taken earlier (eg. in the sampler process), the clock's time otherwise"""
+        if self.lock.acquire(False):
+            # uncontended, no clock reads
+            self.setLockWait.observe(0.0)
+        else:
+            start = time.perf_counter()
+            self.lock.acquire()
+            self.setLockWait.observe(time.perf_counter() - start)
+        self.humidity.add(humidity)
         self.pumpActive = pumpActive
         self.lightActive = lightActive
+        if zones is not None:
+            if len(zones) != len(self.zones) or any(z[0] not in self.zones for z in zones):
+                # zone config changed
+                self.zones = OrderedDict((z[0], self.zones.get(z[0]) or [RingStatistics(self.capacity), False, False])
+                                         for z in zones)
+            for name, zoneHumidity, zonePump, zoneLight in zones:
+                zone = self.zones[name]
+                zone[0].add(zoneHumidity)
+                zone[1] = zonePump
+                zone[2] = zoneLight
         self.lock.release()
+        now = self.clock.time() if timestamp is None else timestamp
+        # single writer, readers see either the previous or this sample
+        self.latest = (self.latest[0] + 1, now, humidity, pumpActive, lightActive, tuple(zones) if zones else ())
+        if self.store is not None:
+            self.store.record(now, humidity, pumpActive, lightActive)
+
+
+# marker for getParam calls without default value
+_MISSING = object()
+# schema default of optional parameters which are not added if missing
+_UNSET = object()
+
+
+def parseBool(value):
+    'Convert true/false, yes/no, on/off, 1/0 (any case) or a bool to a bool'
+    if isinstance(value, bool):
+        return value
+    text = str(value).strip().lower()
+    if text in ('true', 'yes', 'on', '1'):
+        return True
+    if text in ('false', 'no', 'off', '0'):
+        return False
+    raise ValueError('not a boolean: {!r}'.format(value))
+
+
+def optional(convert):
+    'Wrap a converter to let None (json null) through'
+    return lambda value: None if value is None else convert(value)
+
+
+def choice(*values):
+    'Converter accepting one of the given strings'
+    def convert(value):
+        if value not in values:
+            raise ValueError('must be one of {}, got {!r}'.format(', '.join(values), value))
+        return value
+    return convert
+
+
+def finite(value):
+    'Reject NaN and infinity, which fail or pass every comparison of a range check'
+    if isinstance(value, float) and not math.isfinite(value):
+        raise ValueError('must be a finite number, got {!r}'.format(value))
+    return value
+
+
+def bounded(convert, minimum=None, maximum=None):
+    'Wrap a converter to reject values below minimum or above maximum'
+    def check(value):
+        value = finite(convert(value))
+        if minimum is not None and value < minimum:
+            raise ValueError('must be at least {}, got {!r}'.format(minimum, value))
+        if maximum is not None and value > maximum:
+            raise ValueError('must be at most {}, got {!r}'.format(maximum, value))
+        return value
+    return check
+
+
+def positive(convert):
+    'Wrap a converter to reject values <= 0 (intervals, timeouts)'
+    def check(value):
+        value = finite(convert(value))
+        if not value > 0:
+            raise ValueError('must be positive, got {!r}'.format(value))
+        return value
+    return check
+
+
+# log levels of logs.py
+logLevel = choice('debug', 'info', 'warning', 'error')
+
+
+# parameter -> (converter, default), parameters without default (_MISSING) are required, converters also check the
+# range of the values (see bounded and positive),
+# parameters with default _UNSET are optional and not added if missing.
+# Parameters not listed here are kept unconverted.
+CONFIG_SCHEMA = {
+    'device_poll_interval': (positive(float), _MISSING),
+    'gcp_send_interval': (positive(float), _MISSING),
+    'watering_scheme': (choice('fixed', 'dynamic'), _MISSING),
+    'watering_threshold': (bounded(float, 0, 100), _MISSING),
+    'watering_threshold_lag': (bounded(float, 0), _MISSING),
+    'watering_start': (str, _MISSING),
+    'watering_duration': (bounded(int, 0), _MISSING),
+    'lightning_start': (str, _MISSING),
+    'lightning_end': (str, _MISSING),
+    'lightning_windows': (optional(str), None),
+    'adc_backend': (choice('bitbang', 'spidev', 'fake'), 'bitbang'),
+    'gpio_backend': (choice('rpi', 'simulated'), 'rpi'),
+    'data_buffer_size': (bounded(int, 1), 1024),
+    'publish_statistics': (parseBool, False),
+    'history_dir': (optional(str), None),
+    'history_retention_raw_days': (bounded(float, 0), 7),
+    'history_retention_minute_days': (bounded(float, 0), 30),
+    'history_retention_hour_days': (bounded(float, 0), 365),
+    'history_retention_day_days': (bounded(float, 0), 3650),
+    'spool_dir': (str, '../spool'),
+    'telemetry_encoding': (choice('json', 'binary'), 'json'),
+    'telemetry_batch_size': (bounded(int, 1, 65535), 30),
+    'telemetry_batch_seconds': (positive(int), 300),
+    'publish_window': (bounded(int, 1), 20),
+    'publish_ack_timeout': (positive(float), 30),
+    'device_poll_mode': (choice('fixed', 'adaptive'), 'fixed'),
+    'device_poll_interval_max': (positive(float), 30),
+    'device_poll_near_band': (bounded(float, 0), 5),
+    'sensor_oversample': (bounded(int, 1), 1),
+    'sensor_filter': (choice('none', 'median', 'ema', 'hampel'), 'none'),
+    'sensor_filter_window': (bounded(int, 1), 5),
+    'sensor_filter_alpha': (positive(bounded(float, maximum=1)), 0.3),
+    'sensor_hampel_sigmas': (positive(float), 3.0),
+    'sensor_calibration': (optional(lambda points: [(float(raw), float(percent)) for raw, percent in points]), None),
+    'zones': (optional(lambda zones: [validate(zone, ZONE_SCHEMA) for zone in zones]), None),
+    'metrics_port': (optional(bounded(int, 0, 65535)), None),
+    'metrics_bind': (str, '127.0.0.1'),
+    'metrics_socket': (optional(str), None),
+    'lan_port': (optional(bounded(int, 0, 65535)), None),
+    'lan_bind': (str, '0.0.0.0'),
+    'lan_history_refresh': (positive(float), 10),
+    'execution_mode': (choice('threads', 'processes', 'asyncio'), 'threads'),
+    'sampler_cpus': (optional(lambda cpus: [int(cpu) for cpu in cpus]), None),
+    'sample_ring_file': (optional(str), None),
+    'sample_ring_size': (bounded(int, 1), 4096),
+    'command_pump_max_seconds': (bounded(float, 0), 300),
+    'checkpoint_file': (optional(str), None),
+    'checkpoint_interval': (positive(float), 30),
+    'checkpoint_max_age': (positive(float), 600),
+    'log_level': (logLevel, 'info'),
+    'log_levels': (optional(lambda levels: dict((str(name), logLevel(level)) for name, level in levels.items())), None),
+    'log_file': (optional(str), None),
+    'log_max_bytes': (bounded(int, 1), 1000000),
+    'log_backups': (bounded(int, 0), 3),
+    'log_flush_interval': (positive(float), 10),
+    'log_buffer_lines': (bounded(int, 1), 4096),
+    'log_rate_limit': (bounded(float, 0), 20),
+    'log_rate_burst': (bounded(int, 1), 100),
+}
+
+# zone parameters, zones inherit unset watering/lightning parameters from the top level config
+ZONE_SCHEMA = {
+    'name': (str, _MISSING),
+    'adc_channel': (bounded(int, 0, 7), _MISSING),
+    'pump_gpio': (int, _MISSING),
+    'light_gpio': (optional(int), None),
+}
+for param in ('watering_scheme', 'watering_threshold', 'watering_threshold_lag', 'watering_start',
+              'watering_duration', 'lightning_start', 'lightning_end', 'lightning_windows',
+              'sensor_filter', 'sensor_filter_window', 'sensor_filter_alpha', 'sensor_hampel_sigmas',
+              'sensor_calibration'):
+    ZONE_SCHEMA[param] = (CONFIG_SCHEMA[param][0], _UNSET)
+
+# arguments of the commands (see commands.py), 'id' is the optional idempotency key of every command
+COMMAND_SCHEMAS = {
+    # run the pump(s) for 'seconds' (capped at command_pump_max_seconds), 0 ends a manual run
+    'pump': {'id': (optional(str), None), 'zone': (optional(str), None), 'seconds': (float, _MISSING)},
+    # switch the light(s) on or off for 'seconds', or until the next scheduled transition
+    'light': {'id': (optional(str), None), 'zone': (optional(str), None), 'on': (parseBool, _MISSING),
+              'seconds': (optional(float), None)},
+    # poll the sensors and publish a sample now
+    'report': {'id': (optional(str), None)},
+}
+
+
+def freeze(value):
+    'Convert dicts to ConfigSnapshots and lists to tuples, recursively'
+    if isinstance(value, dict):
+        return ConfigSnapshot(value)
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(v) for v in value)
+    return value
+
+
+def thaw(value):
+    'Convert a frozen value back to dicts and lists (eg. for json)'
+    if isinstance(value, ConfigSnapshot):
+        return {k: thaw(v) for k, v in value.items()}
+    if isinstance(value, tuple):
+        return [thaw(v) for v in value]
+    return value
+
+
+class ConfigSnapshot(Mapping):
+    'Immutable, hashable configuration mapping, parameters are also accessible as attributes'
+    __slots__ = ('_values', '_hash')
+
+    def __init__(self, values):
+        object.__setattr__(self, '_values', {k: freeze(v) for k, v in values.items()})
+        object.__setattr__(self, '_hash', None)
+
+    def __getitem__(self, key):
+        return self._values[key]
+
+    def __iter__(self):
+        return iter(self._values)
+
+    def __len__(self):
+        return len(self._values)
+
+    def __getattr__(self, name):
+        try:
+            return self._values[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('ConfigSnapshot is immutable')
+
+    def __hash__(self):
+        if self._hash is None:
+            object.__setattr__(self, '_hash', hash(frozenset(self._values.items())))
+        return self._hash
+
+    def __eq__(self, other):
+        if isinstance(other, ConfigSnapshot):
+            return self._values == other._values
+        return Mapping.__eq__(self, other)
+
+    def __repr__(self):
+        return 'ConfigSnapshot({!r})'.format(self._values)
+
+
+def validate(config, schema=None):
+    'Convert the parameters of a raw config dict to their types, add defaults, return a ConfigSnapshot'
+    if schema is None:
+        schema = CONFIG_SCHEMA
+    if not isinstance(config, Mapping):
+        raise ValueError('Config must be a json object, got {!r}'.format(config))
+    values = dict(config)
+    for param, (convert, default) in schema.items():
+        if param not in values:
+            if default is _MISSING:
+                raise ValueError('Missing config parameter "{}"'.format(param))
+            if default is not _UNSET:
+                values[param] = convert(default)
+            continue
+        try:
+            values[param] = convert(values[param])
+        except Exception as e:
+            # any value of a received config, eg. a list where an object is expected
+            raise ValueError('Invalid config parameter "{}": {}'.format(param, e))
+    return ConfigSnapshot(values)
 
 
 class ConfigurationProvider:
-    'A file configuration abstraction. All parameters must be hashable, not lists, dicts, etc.'
-    config = {}
+    """A file configuration abstraction. The configuration is validated (see CONFIG_SCHEMA) into an immutable
+    ConfigSnapshot, a new snapshot replaces the current one atomically, readers never see a partial configuration.
+    Subscribers are called with the new snapshot whenever the effective configuration changes.
+    The file is written to a temporary file, fsync'ed and renamed, so a crash never leaves a partial file.
+    A received config (eg. the device config of IoT Core, resent on every connect) is merged over the parameters of
+    the file: parameters it does not contain, like the device-local paths, ports and execution_mode, keep their value.
+    Defaults are not written, they are filled in on every read."""
 
     def __init__(self, cfg_file):
         if (not os.path.isfile(cfg_file)):
             raise ValueError('Unable to read config file "'+cfg_file+'"')
         self.cfg_file = cfg_file
+        self.lock = threading.Lock()
+        self.subscribers = []
+        # parameters of the file (json types), without defaults
+        self.stored = {}
         # load cache
         self.read()
 
+    @property
+    def config(self):
+        'The current configuration snapshot'
+        return self.snapshot
+
+    def subscribe(self, callback):
+        'Call callback(snapshot) after every configuration change, returns the current snapshot'
+        with self.lock:
+            self.subscribers.append(callback)
+            return self.snapshot
+
     def write(self, config):
-        'Write received configuration to internal cache and save it to disk '
-        unmatched_item = set(config.items()) ^ set(self.config.items())
-        # write if changed
-        if len(unmatched_item) != 0:
-            print('Config has changed, persisting new version: \'{}\''.format(json.dumps(config, sort_keys=True, indent=4)))
-            self.config = config
-            with open(self.cfg_file, 'w') as outfile:
-                json.dump(config, outfile)
+        'Merge received configuration over the file, write it to internal cache and save it to disk if it changed, raises ValueError if invalid'
+        if not isinstance(config, Mapping):
+            raise ValueError('Config must be a json object, got {!r}'.format(config))
+        with self.lock:
+            merged = dict(self.stored)
+            merged.update(config)
+            snapshot = validate(merged)
+            # write if changed
+            if snapshot == self.snapshot:
+                return False
+            # the parameters of the file and the received ones only, later changes of the defaults apply to the others
+            stored = dict((param, thaw(snapshot[param])) for param in merged)
+            log.info('Config has changed, persisting new version: \'%s\'', json.dumps(stored, sort_keys=True, indent=4))
+            self.persist(stored)
+            self.stored = stored
+            self.snapshot = snapshot
+            subscribers = list(self.subscribers)
+        for callback in subscribers:
+            callback(snapshot)
+        return True
+
+    def persist(self, config):
+        'Atomically replace the config file with the json types of config'
+        tmp_file = self.cfg_file + '.tmp'
+        with open(tmp_file, 'w') as outfile:
+            json.dump(config, outfile, sort_keys=True, indent=4)
+            outfile.flush()
+            os.fsync(outfile.fileno())
+        os.replace(tmp_file, self.cfg_file)
+        # make the rename durable
+        dir_fd = os.open(os.path.dirname(os.path.abspath(self.cfg_file)), os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
 
     def read(self):
         'Load internal cache from disk and return it to caller'
         with open(self.cfg_file) as json_file:
-            self.config = json.load(json_file)
-        return self.config
+            stored = json.load(json_file)
+        snapshot = validate(stored)
+        with self.lock:
+            self.stored = stored
+            self.snapshot = snapshot
+        return self.snapshot
+
+    def reload(self):
+        'Read the file again if another process changed it, notify the subscribers if the configuration changed'
+        with open(self.cfg_file) as json_file:
+            stored = json.load(json_file)
+        snapshot = validate(stored)
+        with self.lock:
+            self.stored = stored
+            if snapshot == self.snapshot:
+                return False
+            log.info('Config file has changed, reloaded')
+            self.snapshot = snapshot
+            subscribers = list(self.subscribers)
+        for callback in subscribers:
+            callback(snapshot)
+        return True
 
-    def getParam(self, param):
-        'Return a config parameter'
-        return self.config[param]
+    def getParam(self, param, default=_MISSING):
+        'Return a config parameter, or default if given and the parameter is not configured'
+        if default is not _MISSING:
+            return self.snapshot.get(param, default)
+        return self.snapshot[param]
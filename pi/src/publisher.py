@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+
+# Pipelined QoS 1 publishing on top of a paho mqtt client.
+
+import collections
+import threading
+
+from clock import SystemClock
+from metrics import REGISTRY
+
+# paho's MQTT_ERR_SUCCESS and MQTT_ERR_NO_CONN, avoids importing paho here
+MQTT_ERR_SUCCESS = 0
+MQTT_ERR_NO_CONN = 4
+# number of ack latencies kept for the percentiles
+LATENCY_SAMPLES = 1024
+
+
+class InflightPublisher:
+    """Keeps up to 'window' QoS 1 messages in flight instead of one message per loop:
+    - publish(topic, payload, key): send a message if the window has room, returns False if it is full or the
+      client is not connected. A message queued by the client while disconnected (paho returns MQTT_ERR_NO_CONN
+      with a mid for QoS 1) is sent by the client after the reconnect and counts as in flight. With block=True the caller waits until the window has room (backpressure for
+      producers running in other threads than the network loop).
+    - onPublish(mid): call from paho's on_publish, releases the window slot and calls onAck(key)
+    - retransmitExpired(): publish the messages again which were not acknowledged within 'timeout' sec.
+    - restartTimeouts(): the client sent the messages in flight again (paho does after a reconnect)
+    - reset(): forget all messages in flight, eg. after a disconnect, returns their keys
+    - statistics(): throughput, ack latency (avg, p50, p99, max) and retransmit counters
+    The key identifies a message for the caller (eg. the spool sequence number), it is passed to onAck.
+    Thread-safe. Times are taken from 'clock' (see clock.py), the system clock by default.
+    The ack latency, retransmits and messages in flight are published as metrics too.
+    """
+
+    def __init__(self, client=None, window=20, timeout=30.0, onAck=None, clock=None, registry=None):
+        self.clock = clock if clock is not None else SystemClock()
+        registry = registry if registry is not None else REGISTRY
+        self.ackLatency = registry.histogram('wassermat_publish_ack_seconds', 'Time from publish to broker ack',
+                                             lowest=1e-4, highest=1000.0)
+        self.retransmits = registry.counter('wassermat_publish_retransmits_total', 'Messages published again')
+        registry.gauge('wassermat_publish_inflight_messages', 'Messages waiting for the broker ack',
+                       function=lambda: len(self.inflight))
+        self.client = client
+        self.window = window
+        self.timeout = timeout
+        self.onAck = onAck
+        self.condition = threading.Condition()
+        # mid -> [key, topic, payload, first send time, last send time], in send order
+        self.inflight = collections.OrderedDict()
+        self.published = 0
+        self.acked = 0
+        self.retransmitted = 0
+        self.bytes = 0
+        self.latencies = collections.deque(maxlen=LATENCY_SAMPLES)
+        self.since = self.clock.monotonic()
+
+    def __len__(self):
+        return len(self.inflight)
+
+    def free(self):
+        """Number of messages which can be published before the window is full"""
+        return max(0, self.window - len(self.inflight))
+
+    def attach(self, client):
+        """Publish through another client, messages in flight on the old client are forgotten"""
+        self.reset()
+        self.client = client
+
+    def publish(self, topic, payload, key=None, block=False, timeout=None):
+        """Publish a message with QoS 1, returns True if it was sent"""
+        with self.condition:
+            if block:
+                self.condition.wait_for(lambda: len(self.inflight) < self.window, timeout)
+            if len(self.inflight) >= self.window:
+                return False
+            now = self.clock.monotonic()
+            info = self.client.publish(topic, payload, qos=1)
+            if info.rc != MQTT_ERR_SUCCESS and (info.rc != MQTT_ERR_NO_CONN or info.mid is None):
+                return False
+            self.inflight[info.mid] = [key, topic, payload, now, now]
+            self.published += 1
+            self.bytes += len(payload)
+            return True
+
+    def onPublish(self, mid):
+        """Broker acknowledged a message, returns its key or None if the message is unknown"""
+        with self.condition:
+            entry = self.inflight.pop(mid, None)
+            if entry is None:
+                return None
+            self.acked += 1
+            latency = self.clock.monotonic() - entry[3]
+            self.latencies.append(latency)
+            self.ackLatency.observe(latency)
+            self.condition.notify_all()
+        if self.onAck is not None:
+            self.onAck(entry[0])
+        return entry[0]
+
+    def retransmitExpired(self):
+        """Publish messages again which were not acknowledged in time, returns the number of retransmits"""
+        count = 0
+        with self.condition:
+            now = self.clock.monotonic()
+            expired = [mid for mid, entry in self.inflight.items() if now - entry[4] > self.timeout]
+            for mid in expired:
+                entry = self.inflight.pop(mid)
+                info = self.client.publish(entry[1], entry[2], qos=1)
+                if info.rc != MQTT_ERR_SUCCESS:
+                    # not connected, the caller resets after the reconnect
+                    self.inflight[mid] = entry
+                    break
+                entry[4] = now
+                self.inflight[info.mid] = entry
+                self.retransmitted += 1
+                self.retransmits.inc()
+                count += 1
+        return count
+
+    def restartTimeouts(self):
+        """Restart the ack timeout of all messages in flight"""
+        with self.condition:
+            now = self.clock.monotonic()
+            for entry in self.inflight.values():
+                entry[4] = now
+
+    def reset(self):
+        """Forget all messages in flight, returns their keys in send order"""
+        with self.condition:
+            keys = [entry[0] for entry in self.inflight.values()]
+            self.inflight.clear()
+            self.condition.notify_all()
+        return keys
+
+    def statistics(self):
+        """Return the counters since the last call, throughput in messages/s and ack latencies in sec."""
+        with self.condition:
+            now = self.clock.monotonic()
+            elapsed = max(now - self.since, 1e-9)
+            latencies = sorted(self.latencies)
+            stats = {
+                'published': self.published,
+                'acked': self.acked,
+                'retransmitted': self.retransmitted,
+                'inflight': len(self.inflight),
+                'msg_per_sec': self.acked / elapsed,
+                'bytes_per_sec': self.bytes / elapsed,
+                'ack_latency_avg': sum(latencies) / len(latencies) if latencies else None,
+                'ack_latency_p50': percentile(latencies, 0.5),
+                'ack_latency_p99': percentile(latencies, 0.99),
+                'ack_latency_max': latencies[-1] if latencies else None
+            }
+            self.published = self.acked = self.retransmitted = self.bytes = 0
+            self.latencies.clear()
+            self.since = now
+        return stats
+
+
+def percentile(values, p):
+    """Return the p-th percentile (0..1) of sorted values, None if empty"""
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(p * len(values)))]
@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+
+# Shared memory ring buffer of samples between the sampler and the publisher process (see processes.py): one
+# writer, one reader, no locks, the reader unpacks the records in place from the shared mapping.
+
+import mmap
+import os
+import struct
+import tempfile
+import threading
+
+from clock import SystemClock
+from logs import getLogger
+from metrics import REGISTRY
+
+log = getLogger('ring')
+
+# header: magic, record count (capacity), next sequence number to write, next sequence number to read,
+# sequence number of the zone names (odd while they are written)
+HEADER = struct.Struct('<8sQQQQ24x')
+MAGIC = b'WMRB0001'
+# the zone names of the records, one utf-8 name per slot
+MAX_ZONES = 8
+NAME = struct.Struct('<32s')
+NAMES_OFFSET = HEADER.size
+RECORDS_OFFSET = NAMES_OFFSET + MAX_ZONES * NAME.size
+# sample: sequence number, timestamp, humidity, pump active, light active, zone count, zone pump bits, zone light
+# bits, sequence number of the names, humidity of the zones
+RECORD = struct.Struct('<QdfBBBxHHI{}f'.format(MAX_ZONES))
+SEQUENCE = struct.Struct('<Q')
+# sequence number of a record being written
+WRITING = 2 ** 64 - 1
+
+
+def defaultPath():
+    """Ring file in /dev/shm (RAM) if there is one"""
+    directory = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+    return os.path.join(directory, 'wassermat-samples')
+
+
+class SampleRing:
+    """Memory mapped file of 'capacity' fixed width sample records, shared by the processes which map it. A file in
+    /dev/shm is shared memory, like multiprocessing.shared_memory (python 3.8+) and without its resource tracker.
+    Each record carries its sequence number, which the writer invalidates before and sets after writing the record
+    (seqlock): a reader which was overtaken by the writer sees a different sequence number and drops the record.
+    The header holds the write and the read position, so a restarted writer or reader continues where its
+    predecessor stopped. Zone names are stored once in the header, not in every record."""
+
+    def __init__(self, path, capacity=None):
+        """Map the ring at path, if capacity is given a new ring is created (replacing an existing one)"""
+        self.path = path
+        if capacity is not None:
+            tmp = path + '.tmp'
+            with open(tmp, 'wb') as f:
+                f.write(HEADER.pack(MAGIC, capacity, 0, 0, 0))
+                f.truncate(RECORDS_OFFSET + capacity * RECORD.size)
+            os.replace(tmp, path)
+        self.file = open(path, 'r+b')
+        self.map = mmap.mmap(self.file.fileno(), 0)
+        magic, self.capacity = HEADER.unpack_from(self.map, 0)[:2]
+        if magic != MAGIC or len(self.map) != RECORDS_OFFSET + self.capacity * RECORD.size:
+            raise ValueError('"{}" is not a sample ring'.format(path))
+
+    def header(self):
+        """(write position, read position, names sequence number)"""
+        return HEADER.unpack_from(self.map, 0)[2:]
+
+    def setWritePosition(self, seq):
+        SEQUENCE.pack_into(self.map, 16, seq)
+
+    def setReadPosition(self, seq):
+        SEQUENCE.pack_into(self.map, 24, seq)
+
+    def setNamesSequence(self, seq):
+        SEQUENCE.pack_into(self.map, 32, seq)
+
+    def offset(self, seq):
+        return RECORDS_OFFSET + (seq % self.capacity) * RECORD.size
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+    def unlink(self):
+        self.close()
+        os.remove(self.path)
+
+
+class RingWriter:
+    """Write side of a SampleRing with the setData interface of DataProvider, DeviceControl writes its samples into
+    the ring instead of a DataProvider. Single writer"""
+
+    def __init__(self, ring, clock=None):
+        self.ring = ring
+        self.clock = clock if clock is not None else SystemClock()
+        self.seq, readSeq, self.namesSeq = ring.header()
+        # a predecessor may have died while writing the names, they are written again by the first sample
+        self.namesSeq += self.namesSeq % 2
+        self.names = None
+        self.warned = False
+
+    def writeNames(self, names):
+        """Replace the zone names, readers retry while the sequence number is odd or changes"""
+        ring = self.ring
+        self.namesSeq += 1
+        ring.setNamesSequence(self.namesSeq)
+        for i in range(MAX_ZONES):
+            name = names[i] if i < len(names) else ''
+            NAME.pack_into(ring.map, NAMES_OFFSET + i * NAME.size, name.encode('utf-8')[:NAME.size])
+        self.namesSeq += 1
+        ring.setNamesSequence(self.namesSeq)
+        self.names = names
+
+    def setData(self, humidity, pumpActive, lightActive, zones=None, timestamp=None):
+        """Append a sample, see DataProvider.setData. Zones beyond MAX_ZONES are not passed on"""
+        if timestamp is None:
+            timestamp = self.clock.time()
+        zones = zones or ()
+        if len(zones) > MAX_ZONES:
+            if not self.warned:
+                log.warning('Only the first %s of %s zones are passed to the publisher', MAX_ZONES, len(zones))
+                self.warned = True
+            zones = zones[:MAX_ZONES]
+        names = tuple(zone[0] for zone in zones)
+        if names != self.names:
+            self.writeNames(names)
+        humidities = [0.0] * MAX_ZONES
+        pumpBits = 0
+        lightBits = 0
+        for i, (name, zoneHumidity, zonePump, zoneLight) in enumerate(zones):
+            humidities[i] = zoneHumidity
+            pumpBits |= bool(zonePump) << i
+            lightBits |= bool(zoneLight) << i
+
+        ring = self.ring
+        offset = ring.offset(self.seq)
+        SEQUENCE.pack_into(ring.map, offset, WRITING)
+        RECORD.pack_into(ring.map, offset, WRITING, timestamp, humidity, bool(pumpActive), bool(lightActive),
+                         len(zones), pumpBits, lightBits, self.namesSeq // 2, *humidities)
+        # the record is complete before its sequence number and the write position are published
+        SEQUENCE.pack_into(ring.map, offset, self.seq)
+        self.seq += 1
+        ring.setWritePosition(self.seq)
+
+
+class RingFollower(threading.Thread):
+    """Read side of a SampleRing: copies new samples every 'interval' sec. into a DataProvider, with their
+    timestamps, so the publisher process uses the DataProvider as in a single process. Samples overwritten
+    before they were read are counted as lost."""
+
+    def __init__(self, ring, dataProvider, stopEvent, interval=0.2, registry=None):
+        super(RingFollower, self).__init__(name='RingFollower')
+        self.daemon = True
+        self.ring = ring
+        self.dataProvider = dataProvider
+        self.stopEvent = stopEvent
+        self.interval = interval
+        writeSeq, self.seq, namesSeq = ring.header()
+        # names sequence number -> names
+        self.names = {}
+        registry = registry if registry is not None else REGISTRY
+        self.lost = registry.counter('wassermat_ring_lost_samples_total',
+                                     'Samples overwritten in the ring before the publisher read them')
+
+    def readNames(self, namesSeq):
+        """Zone names with the given sequence number (as recorded in a sample), None if they were replaced since"""
+        names = self.names.get(namesSeq)
+        if names is not None:
+            return names
+        ring = self.ring
+        # a writer which died while writing the names leaves an odd sequence number
+        for attempt in range(100):
+            before = ring.header()[2]
+            if before % 2 == 0:
+                names = tuple(NAME.unpack_from(ring.map, NAMES_OFFSET + i * NAME.size)[0].rstrip(b'\0')
+                              .decode('utf-8', 'replace') for i in range(MAX_ZONES))
+                if ring.header()[2] == before:
+                    break
+        else:
+            return None
+        if before // 2 != namesSeq:
+            return None
+        self.names = {namesSeq: names}
+        return names
+
+    def poll(self):
+        """Copy the samples written since the last poll, returns their number"""
+        ring = self.ring
+        writeSeq = ring.header()[0]
+        if writeSeq - self.seq > ring.capacity:
+            self.lost.inc(writeSeq - ring.capacity - self.seq)
+            self.seq = writeSeq - ring.capacity
+        copied = 0
+        while self.seq < writeSeq:
+            offset = ring.offset(self.seq)
+            record = RECORD.unpack_from(ring.map, offset)
+            seq, timestamp, humidity, pumpActive, lightActive, zoneCount, pumpBits, lightBits, namesSeq = record[:9]
+            if seq != self.seq or SEQUENCE.unpack_from(ring.map, offset)[0] != seq:
+                # overwritten while reading
+                self.lost.inc()
+                self.seq += 1
+                continue
+            zones = None
+            if zoneCount:
+                names = self.readNames(namesSeq)
+                if names is not None:
+                    zones = [(names[i], record[9 + i], bool(pumpBits >> i & 1), bool(lightBits >> i & 1))
+                             for i in range(zoneCount)]
+            self.dataProvider.setData(humidity, bool(pumpActive), bool(lightActive), zones, timestamp=timestamp)
+            self.seq += 1
+            copied += 1
+        ring.setReadPosition(self.seq)
+        return copied
+
+    def run(self):
+        while not self.stopEvent.is_set():
+            self.poll()
+            self.stopEvent.wait(self.interval)
+        self.poll()
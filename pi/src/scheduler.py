@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+
+# Event driven schedule of on/off transitions (light, fixed scheme pump).
+
+import datetime
+import heapq
+import itertools
+import time
+
+# transitions are compiled for this many days ahead, then the schedule recompiles itself
+HORIZON_DAYS = 2
+
+
+def parseTime(hhMi):
+    """Parse 'hh:mm' into a datetime.time"""
+    t = time.strptime(hhMi.strip(), '%H:%M')
+    return datetime.time(hour=t.tm_hour, minute=t.tm_min)
+
+
+def parseWindows(windows):
+    """Parse 'hh:mm-hh:mm[,hh:mm-hh:mm...]' into a list of (start, end) datetime.time pairs"""
+    result = []
+    for window in str(windows).split(','):
+        if not window.strip():
+            continue
+        start, end = window.split('-')
+        result.append((parseTime(start), parseTime(end)))
+    return result
+
+
+def parseStarts(starts, durationSecs):
+    """Parse 'hh:mm[,hh:mm...]' start times into a list of (start, duration in sec.) pairs"""
+    return [(parseTime(start), int(durationSecs)) for start in str(starts).split(',') if start.strip()]
+
+
+def localTimestamp(date, tm):
+    """Epoch timestamp of the wall clock time tm on date in the local timezone, DST aware"""
+    return time.mktime((date.year, date.month, date.day, tm.hour, tm.minute, tm.second, 0, 0, -1))
+
+
+class Schedule:
+    """Daily on windows of one output. A window is either (start, end) wall clock times, an end before or equal
+    to the start wraps past midnight, or (start, duration in sec.). Wall clock times are converted with the local
+    timezone of each day, so windows stay at the same wall clock time across DST changes."""
+
+    def __init__(self, windows):
+        self.windows = windows
+
+    def intervals(self, fromTs, toTs):
+        """Return the merged (on, off) epoch intervals overlapping [fromTs, toTs), sorted"""
+        first = datetime.date.fromtimestamp(fromTs) - datetime.timedelta(days=1)
+        last = datetime.date.fromtimestamp(toTs)
+        intervals = []
+        day = first
+        while day <= last:
+            for start, end in self.windows:
+                on = localTimestamp(day, start)
+                if isinstance(end, datetime.time):
+                    endDay = day if end > start else day + datetime.timedelta(days=1)
+                    off = localTimestamp(endDay, end)
+                else:
+                    off = on + end
+                if off > fromTs and on < toTs:
+                    intervals.append((on, off))
+            day += datetime.timedelta(days=1)
+
+        intervals.sort()
+        merged = []
+        for on, off in intervals:
+            if merged and on <= merged[-1][1]:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], off))
+            else:
+                merged.append((on, off))
+        return merged
+
+    def isActive(self, ts):
+        """True if ts is within an on window"""
+        return any(on <= ts < off for on, off in self.intervals(ts, ts + 1))
+
+
+class Scheduler:
+    """Timer heap of the upcoming on/off transitions of several named schedules. compile() converts the windows of
+    a schedule once into transition timestamps, due() pops the transitions that are due, which costs a single
+    comparison while no transition is due. Recompiling a schedule invalidates its queued transitions.
+    Not thread-safe, used by the control loop only."""
+
+    def __init__(self):
+        self.heap = []
+        self.schedules = {}
+        self.versions = {}
+        # tie breaker for transitions at the same time
+        self.sequence = itertools.count()
+
+    def compile(self, name, windows, now):
+        """(Re)compile the schedule 'name' from its windows, returns its state (on/off) at now"""
+        schedule = Schedule(windows)
+        self.schedules[name] = schedule
+        self.versions[name] = self.versions.get(name, 0) + 1
+        self._push(name, now, now + HORIZON_DAYS * 86400)
+        return schedule.isActive(now)
+
+    def remove(self, name):
+        """Drop the schedule 'name' and its queued transitions"""
+        self.schedules.pop(name, None)
+        self.versions[name] = self.versions.get(name, 0) + 1
+
+    def _push(self, name, fromTs, toTs):
+        version = self.versions[name]
+        for on, off in self.schedules[name].intervals(fromTs, toTs):
+            if fromTs <= on < toTs:
+                heapq.heappush(self.heap, (on, next(self.sequence), name, version, True))
+            if fromTs < off <= toTs:
+                heapq.heappush(self.heap, (off, next(self.sequence), name, version, False))
+        # marker to compile the next days
+        heapq.heappush(self.heap, (toTs, next(self.sequence), name, version, None))
+
+    def isActive(self, name, ts):
+        """State (on/off) of the schedule 'name' at ts, False if there is no such schedule"""
+        schedule = self.schedules.get(name)
+        return schedule is not None and schedule.isActive(ts)
+
+    def nextDue(self):
+        """Timestamp of the next transition, None if there is none"""
+        return self.heap[0][0] if self.heap else None
+
+    def due(self, now):
+        """Pop the transitions due at now, returns a list of (name, on) in time order"""
+        result = []
+        heap = self.heap
+        while heap and heap[0][0] <= now:
+            ts, unused_sequence, name, version, on = heapq.heappop(heap)
+            if version != self.versions.get(name) or name not in self.schedules:
+                continue
+            if on is None:
+                self._push(name, ts, ts + HORIZON_DAYS * 86400)
+            else:
+                result.append((name, on))
+        return result
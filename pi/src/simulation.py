@@ -0,0 +1,548 @@
+#!/usr/bin/env python3
+
+# Deterministic simulation of the wassermat: DeviceControl and GcpIotClient run on a virtual clock against simulated
+# GPIO pins, a soil moisture model behind the adc and a stand-in mqtt broker, so weeks of operation take seconds.
+#
+# usage: python3 simulation.py [--days 14] [--set watering_scheme=dynamic] [--outage 30:32] [--no-mqtt]
+# see python3 simulation.py --help
+
+import argparse
+import collections
+import datetime
+import heapq
+import itertools
+import json
+import logging
+import math
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import logs
+from adc import ADC_MAX, AdcBackend, checkChannels
+from clock import VirtualClock
+from commands import CommandDispatcher
+from device_control import PUMP_ON, LIGHT_ON, DeviceControl, zoneConfigs
+from hardware import SimulatedGpio
+from providers import ConfigurationProvider, DataProvider, thaw
+
+DEFAULT_CONFIG = '../resources/wassermat.json'
+
+# paho return codes used by the stand-in client
+MQTT_ERR_SUCCESS = 0
+MQTT_ERR_NO_CONN = 4
+MQTT_ERR_CONN_LOST = 7
+
+
+class SoilMoistureModel(AdcBackend):
+    """Soil moisture % of each zone, read through the adc like the real sensors. Between two reads the moisture of
+    a zone follows dm/dt = -dry * (m - dryFloor) + pump * (saturation - m), integrated exactly over the intervals in
+    which the zone's pump and light pins did not change (taken from the SimulatedGpio history):
+    - the soil dries out exponentially towards 'dryFloor' with a half-life of 'dryHalfLife' sec., 'lightFactor'
+      times faster while the light is on
+    - while the pump runs, the soil is watered towards 'saturation' with a time constant of 'pumpTau' sec.
+    The sensor value is the moisture scaled to the adc range (raw = % * 10.24, the default calibration) plus
+    gaussian noise with a standard deviation of 'noise' raw units, from a seeded random generator.
+    """
+
+    def __init__(self, clock, gpio, zones, initial=55.0, dryFloor=10.0, saturation=90.0, dryHalfLife=4 * 86400,
+                 lightFactor=2.0, pumpTau=120.0, noise=4.0, seed=0):
+        self.clock = clock
+        self.gpio = gpio
+        self.dryFloor = dryFloor
+        self.saturation = saturation
+        self.dryRate = math.log(2) / dryHalfLife
+        self.lightFactor = lightFactor
+        self.pumpRate = 1.0 / pumpTau
+        self.noise = noise
+        self.random = random.Random(seed)
+        # channel -> [moisture, pump pin, light pin]
+        self.zones = dict((zone['adc_channel'], [float(initial), zone['pump_gpio'], zone.get('light_gpio')])
+                          for zone in zones)
+        self.updated = clock.time()
+        # output pin levels at self.updated, replayed from the gpio history up to historyPos (pins not set up yet
+        # are off)
+        self.levels = {}
+        self.historyPos = 0
+        # per channel moisture extremes and integral since the start, for the summary
+        self.extremes = dict((channel, [zone[0], zone[0]]) for channel, zone in self.zones.items())
+        self.integral = collections.defaultdict(float)
+        self.start = self.updated
+
+    def integrate(self, until):
+        """Advance all zones from self.updated to until with the current pin levels"""
+        dt = until - self.updated
+        if dt <= 0:
+            return
+        for channel, zone in self.zones.items():
+            dry = self.dryRate * (self.lightFactor if self.levels.get(zone[2]) == LIGHT_ON else 1.0)
+            pump = self.pumpRate if self.levels.get(zone[1]) == PUMP_ON else 0.0
+            rate = dry + pump
+            equilibrium = (dry * self.dryFloor + pump * self.saturation) / rate
+            moisture = equilibrium + (zone[0] - equilibrium) * math.exp(-rate * dt)
+            # exact integral of the exponential, for the mean moisture
+            self.integral[channel] += equilibrium * dt + (zone[0] - equilibrium) * (1 - math.exp(-rate * dt)) / rate
+            zone[0] = moisture
+            extremes = self.extremes[channel]
+            extremes[0] = min(extremes[0], moisture)
+            extremes[1] = max(extremes[1], moisture)
+        self.updated = until
+
+    def update(self):
+        """Integrate up to the current time, replaying the pin changes since the last update"""
+        history = self.gpio.history
+        for ts, pin, level in history[self.historyPos:]:
+            self.integrate(ts)
+            self.levels[pin] = level
+        self.historyPos = len(history)
+        self.integrate(self.clock.time())
+
+    def moisture(self, channel):
+        return self.zones[channel][0]
+
+    def mean(self, channel):
+        elapsed = self.updated - self.start
+        return self.integral[channel] / elapsed if elapsed > 0 else self.zones[channel][0]
+
+    def scan(self, channels):
+        checkChannels(channels)
+        self.update()
+        values = []
+        for channel in channels:
+            zone = self.zones.get(channel)
+            if zone is None:
+                # unconnected input
+                values.append(0)
+                continue
+            raw = zone[0] * 10.24 + self.random.gauss(0.0, self.noise)
+            values.append(max(0, min(ADC_MAX, int(round(raw)))))
+        return values
+
+
+MessageInfo = collections.namedtuple('MessageInfo', ('rc', 'mid'))
+Message = collections.namedtuple('Message', ('topic', 'payload', 'qos'))
+
+
+class FakeMqttClient:
+    """Stand-in for the paho client and the broker behind it, the sink of the published messages. Implements the
+    subset used by GcpIotClient on the virtual clock:
+    - publish() acknowledges QoS 1 messages after 'latency' sec., on_publish is called from loop()
+    - loop(timeout) advances the clock to the next network event, at most by timeout sec.
+    - outages: list of (start, end) times during which the connection drops and connects fail
+    - sendConfig(ts, config) delivers a config message on the subscribed config topic at time ts
+    - sendCommand(ts, command) delivers a command message on the commands topic at time ts
+    All acknowledged messages are kept in 'messages' as (time, topic, payload). Like paho, QoS 1 messages not yet
+    acknowledged (or published while disconnected) are kept and sent again after the reconnect.
+    """
+
+    def __init__(self, clock, client_id=None, latency=0.05, outages=()):
+        self.clock = clock
+        self.client_id = client_id
+        self.latency = latency
+        self.outages = sorted(outages)
+        self.connected = False
+        self.subscriptions = {}
+        self.mid = itertools.count(1)
+        self.sequence = itertools.count()
+        # (ts, seq, callback), processed by loop()
+        self.events = []
+        self.messages = []
+        # mid -> (topic, payload) of the QoS 1 messages not yet acknowledged
+        self.outgoing = collections.OrderedDict()
+        self.disconnects = 0
+        self.on_connect = None
+        self.on_disconnect = None
+        self.on_publish = None
+        self.on_message = None
+
+    def inOutage(self, ts):
+        return any(start <= ts < end for start, end in self.outages)
+
+    def schedule(self, ts, callback):
+        heapq.heappush(self.events, (ts, next(self.sequence), callback))
+
+    def username_pw_set(self, username=None, password=None):
+        self.password = password
+
+    def tls_set(self, **kwargs):
+        pass
+
+    def connect(self, host=None, port=None):
+        if self.inOutage(self.clock.time()):
+            raise ConnectionRefusedError('simulated outage')
+        self.connected = True
+        self.schedule(self.clock.time() + self.latency, self.connack)
+        return MQTT_ERR_SUCCESS
+
+    def reconnect(self):
+        if self.connected:
+            self.drop(MQTT_ERR_SUCCESS)
+        return self.connect()
+
+    def disconnect(self):
+        if self.connected:
+            self.drop(MQTT_ERR_SUCCESS)
+        return MQTT_ERR_SUCCESS
+
+    def connack(self):
+        if not self.connected:
+            return
+        for mid, (topic, payload) in self.outgoing.items():
+            self.sendPublish(mid, topic, payload)
+        if self.on_connect is not None:
+            self.on_connect(self, None, {}, 0)
+
+    def drop(self, rc):
+        """Close the connection, acknowledgements on the way are lost"""
+        self.connected = False
+        self.disconnects += 1
+        self.events = []
+        self.subscriptions = {}
+        if self.on_disconnect is not None:
+            self.on_disconnect(self, None, rc)
+
+    def subscribe(self, topic, qos=0):
+        self.subscriptions[topic] = qos
+        return (MQTT_ERR_SUCCESS, next(self.mid))
+
+    def publish(self, topic, payload, qos=0):
+        mid = next(self.mid)
+        if qos:
+            self.outgoing[mid] = (topic, payload)
+        if not self.connected:
+            return MessageInfo(MQTT_ERR_NO_CONN, mid if qos else None)
+        self.sendPublish(mid, topic, payload)
+        return MessageInfo(MQTT_ERR_SUCCESS, mid)
+
+    def sendPublish(self, mid, topic, payload):
+        self.schedule(self.clock.time() + self.latency, lambda: self.ack(mid, topic, payload))
+
+    def ack(self, mid, topic, payload):
+        self.outgoing.pop(mid, None)
+        self.messages.append((self.clock.time(), topic, payload))
+        if self.on_publish is not None:
+            self.on_publish(self, None, mid)
+
+    def sendConfig(self, ts, config):
+        """Deliver a config message at time ts (if connected and subscribed then)"""
+        def deliver():
+            topic = next((t for t in self.subscriptions if t.endswith('/config')), None)
+            if topic is not None and self.on_message is not None:
+                self.on_message(self, None, Message(topic, json.dumps(config).encode('utf-8'), 1))
+        self.schedule(ts, deliver)
+
+    def sendCommand(self, ts, command):
+        """Deliver a command message at time ts (if connected and subscribed then)"""
+        def deliver():
+            topic = next((t for t in self.subscriptions if '/commands' in t), None)
+            if topic is not None and self.on_message is not None:
+                topic = topic.rstrip('#').rstrip('/')
+                self.on_message(self, None, Message(topic, json.dumps(command).encode('utf-8'), 1))
+        self.schedule(ts, deliver)
+
+    def nextOutageChange(self, now):
+        times = [t for outage in self.outages for t in outage if t > now]
+        return min(times) if times else None
+
+    def loop(self, timeout=1.0):
+        now = self.clock.time()
+        deadline = now + timeout
+        if self.connected and self.inOutage(now):
+            self.drop(MQTT_ERR_CONN_LOST)
+        if not self.connected:
+            self.clock.sleep(timeout)
+            return MQTT_ERR_NO_CONN
+        until = deadline
+        if self.events:
+            until = min(until, self.events[0][0])
+        outage = self.nextOutageChange(now)
+        if outage is not None:
+            until = min(until, outage)
+        self.clock.sleep(max(0.0, until - now))
+        if self.inOutage(self.clock.time()):
+            self.drop(MQTT_ERR_CONN_LOST)
+            return MQTT_ERR_CONN_LOST
+        while self.events and self.events[0][0] <= self.clock.time():
+            ts, unused_seq, callback = heapq.heappop(self.events)
+            callback()
+        return MQTT_ERR_SUCCESS
+
+
+class StaticCredentials:
+    """Stand-in for the CredentialManager, the token never expires"""
+
+    def token(self):
+        return 'simulated'
+
+    def refreshDue(self):
+        return False
+
+    def rotate(self, client):
+        client.reconnect()
+
+    def cancel(self):
+        pass
+
+
+def parseValue(value):
+    """Parse a --set value as json, plain strings are taken as they are"""
+    try:
+        return json.loads(value)
+    except ValueError:
+        return value
+
+
+def parseAssignments(assignments):
+    result = {}
+    for assignment in assignments:
+        key, sep, value = assignment.partition('=')
+        if not sep:
+            raise ValueError('Expected key=value, got "{}"'.format(assignment))
+        result[key.strip()] = parseValue(value)
+    return result
+
+
+class Simulation:
+    """Wires DeviceControl (and GcpIotClient if mqtt is True) to the simulated hardware on a virtual clock starting
+    at 'start' (epoch sec.). The config file is copied to a temporary directory, spool and history directories are
+    placed there as well and removed by close(). Runs single threaded: DeviceControl polls are timer callbacks of the
+    clock, GcpIotClient.run() drives the clock through the stand-in client's loop()."""
+
+    def __init__(self, config, start, mqtt=True, latency=0.05, outages=(), model=None):
+        self.clock = VirtualClock(start)
+        self.start = start
+        self.stopEvent = threading.Event()
+        self.directory = tempfile.mkdtemp(prefix='wassermat-sim-')
+        config = dict(config)
+        config['spool_dir'] = os.path.join(self.directory, 'spool')
+        config['history_dir'] = None
+        cfgFile = os.path.join(self.directory, 'wassermat.json')
+        with open(cfgFile, 'w') as f:
+            json.dump(config, f)
+        self.configuration = ConfigurationProvider(cfgFile)
+
+        self.gpio = SimulatedGpio(self.clock)
+        self.model = SoilMoistureModel(self.clock, self.gpio, zoneConfigs(self.configuration.snapshot),
+                                       **(model or {}))
+        self.data = DataProvider(self.configuration.getParam('data_buffer_size'), clock=self.clock)
+        self.control = DeviceControl(self.data, self.configuration, self.stopEvent, adc=self.model, gpio=self.gpio,
+                                     clock=self.clock)
+        # the scheduled poll of DeviceControl, replaced by a poll at once when a command is submitted
+        self.nextStep = None
+        self.client = None
+        self.iot = None
+        if mqtt:
+            # imports paho
+            from gcp_iot_client import GcpIotClient
+            self.commands = CommandDispatcher()
+            self.commands.forward(self)
+            self.client = FakeMqttClient(self.clock, latency=latency,
+                                         outages=[(start + s, start + e) for s, e in outages])
+            self.iot = GcpIotClient(self.data, self.configuration, self.stopEvent, clock=self.clock,
+                                    clientFactory=self.createClient, credentials=StaticCredentials(),
+                                    commands=self.commands)
+
+    def createClient(self, client_id):
+        self.client.client_id = client_id
+        return self.client
+
+    def changeConfig(self, at, values):
+        """Change config values at 'at' sec. after the start, through a config message if mqtt is simulated"""
+        def change():
+            config = thaw(self.configuration.snapshot)
+            config.update(values)
+            if self.client is not None:
+                self.client.sendConfig(self.clock.time(), config)
+            else:
+                self.configuration.write(config)
+        self.clock.callAt(self.start + at, change)
+
+    def sendCommand(self, at, command):
+        """Send a command message (a dict) at 'at' sec. after the start, mqtt only"""
+        self.clock.callAt(self.start + at, lambda: self.client.sendCommand(self.clock.time(), command))
+
+    def submit(self, name, args):
+        """Commands for DeviceControl, its wakeup event ends the wait for the next poll as in DeviceControl.run()"""
+        self.control.submit(name, args)
+        self.scheduleStep(0)
+
+    def scheduleStep(self, delay):
+        step = self.nextStep = object()
+        self.clock.callLater(delay, lambda: self.deviceStep(step))
+
+    def deviceStep(self, step=None):
+        if step is not self.nextStep:
+            # replaced by an earlier poll
+            return
+        delay = self.control.step()
+        if not self.stopEvent.is_set():
+            self.scheduleStep(delay)
+
+    def run(self, duration):
+        """Simulate duration sec."""
+        self.clock.callAt(self.start, lambda: self.scheduleStep(0))
+        self.clock.callAt(self.start + duration, self.stopEvent.set)
+        if self.iot is not None:
+            self.iot.run()
+        else:
+            self.clock.wait(self.stopEvent, duration)
+        self.control.shutdown()
+        self.model.update()
+
+    def summary(self):
+        """Per zone pump, light and moisture figures and the mqtt counters"""
+        elapsed = self.clock.time() - self.start
+        result = {'days': elapsed / 86400.0, 'zones': []}
+        for zone in self.control.zones:
+            pumpOn, pumpSeconds = self.onTime(zone.pumpGpio, PUMP_ON)
+            lightOn, lightSeconds = self.onTime(zone.lightGpio, LIGHT_ON)
+            extremes = self.model.extremes.get(zone.channel, (None, None))
+            result['zones'].append({
+                'name': zone.name,
+                'pump_cycles': pumpOn,
+                'pump_seconds': pumpSeconds,
+                'light_hours': lightSeconds / 3600.0,
+                'moisture_min': extremes[0],
+                'moisture_max': extremes[1],
+                'moisture_mean': self.model.mean(zone.channel),
+                'moisture_end': self.model.moisture(zone.channel)})
+        if self.client is not None:
+            result['messages'] = len(self.client.messages)
+            result['disconnects'] = self.client.disconnects
+            result['backlog'] = len(self.iot.spool)
+        return result
+
+    def onTime(self, pin, onLevel):
+        """Number of switch-ons and total on time in sec. of an output pin"""
+        if pin is None:
+            return 0, 0.0
+        count = 0
+        total = 0.0
+        since = None
+        for ts, p, level in self.gpio.history:
+            if p != pin:
+                continue
+            if level == onLevel and since is None:
+                count += 1
+                since = ts
+            elif level != onLevel and since is not None:
+                total += ts - since
+                since = None
+        if since is not None:
+            total += self.clock.time() - since
+        return count, total
+
+    def close(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def printSummary(summary, wallTime):
+    print('Simulated {:.1f} days in {:.1f}s'.format(summary['days'], wallTime))
+    for zone in summary['zones']:
+        print('zone {name}: {pump_cycles} pump cycles, {pump_seconds:.0f}s pumping, {light_hours:.1f}h light, '
+              'moisture min {moisture_min:.1f}% max {moisture_max:.1f}% mean {moisture_mean:.1f}% '
+              'end {moisture_end:.1f}%'.format(**zone))
+    if 'messages' in summary:
+        print('mqtt: {messages} messages, {disconnects} disconnects, '
+              'backlog {backlog}'.format(**summary))
+
+
+class VirtualTime(logging.Filter):
+    """Stamps log records with the time of the virtual clock"""
+
+    def __init__(self, clock):
+        super(VirtualTime, self).__init__()
+        self.clock = clock
+
+    def filter(self, record):
+        record.created = self.clock.time()
+        record.msecs = (record.created % 1) * 1000
+        return True
+
+
+def setupLogging(clock, verbose):
+    """Log the components to stdout with virtual time stamps if verbose, discard their lines otherwise"""
+    root = logging.getLogger(logs.ROOT)
+    root.propagate = False
+    if verbose:
+        handler = logging.StreamHandler(sys.stdout)
+        handler.setFormatter(logging.Formatter(logs.FORMAT))
+        handler.addFilter(VirtualTime(clock))
+        root.setLevel(logging.DEBUG)
+    else:
+        handler = logging.NullHandler()
+        root.setLevel(logging.WARNING)
+    root.addHandler(handler)
+
+
+def parseCommand(value):
+    """'hours:json' -> (sec. after the start, command)"""
+    hours, sep, command = value.partition(':')
+    return (float(hours) * 3600, json.loads(command))
+
+
+def parseOutage(value):
+    """'from:to' in hours after the start -> (from, to) in sec."""
+    start, sep, end = value.partition(':')
+    return (float(start) * 3600, float(end) * 3600)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Simulate the wassermat on a virtual clock')
+    parser.add_argument('--config', default=DEFAULT_CONFIG, help='config file (default %(default)s)')
+    parser.add_argument('--set', action='append', default=[], metavar='KEY=VALUE',
+                        help='override a config value, the value is parsed as json if possible')
+    parser.add_argument('--change', action='append', default=[], metavar='HOURS:KEY=VALUE',
+                        help='change a config value during the run (as config message if mqtt is simulated)')
+    parser.add_argument('--command', action='append', default=[], type=parseCommand, metavar='HOURS:JSON',
+                        help='send a command message during the run, eg. 1.5:\'{"command": "pump", "seconds": 30}\'')
+    parser.add_argument('--days', type=float, default=14, help='simulated days (default %(default)s)')
+    parser.add_argument('--start', default=None, help='start date yyyy-mm-dd, local midnight (default today)')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the sensor noise (default %(default)s)')
+    parser.add_argument('--no-mqtt', action='store_true', help='simulate DeviceControl only')
+    parser.add_argument('--latency', type=float, default=0.05, help='broker ack latency in sec.')
+    parser.add_argument('--outage', action='append', default=[], type=parseOutage, metavar='FROM:TO',
+                        help='network outage, in hours after the start')
+    parser.add_argument('--initial', type=float, default=55.0, help='initial soil moisture %%')
+    parser.add_argument('--dry-half-life', type=float, default=4.0, help='drying half-life in days')
+    parser.add_argument('--light-factor', type=float, default=2.0, help='drying speed-up while the light is on')
+    parser.add_argument('--pump-tau', type=float, default=120.0, help='watering time constant in sec.')
+    parser.add_argument('--noise', type=float, default=4.0, help='sensor noise in raw adc units')
+    parser.add_argument('--verbose', action='store_true', help='show the output of the simulated components')
+    args = parser.parse_args(argv)
+
+    with open(args.config) as f:
+        config = json.load(f)
+    config.update(parseAssignments(args.set))
+    # changes at the same time are sent as one config
+    changes = collections.OrderedDict()
+    for change in args.change:
+        hours, sep, assignment = change.partition(':')
+        changes.setdefault(float(hours) * 3600, {}).update(parseAssignments([assignment]))
+
+    day = datetime.date.today() if args.start is None else datetime.datetime.strptime(args.start, '%Y-%m-%d').date()
+    start = time.mktime(day.timetuple())
+    model = {'initial': args.initial, 'dryHalfLife': args.dry_half_life * 86400, 'lightFactor': args.light_factor,
+             'pumpTau': args.pump_tau, 'noise': args.noise, 'seed': args.seed}
+
+    wallStart = time.monotonic()
+    simulation = Simulation(config, start, mqtt=not args.no_mqtt, latency=args.latency, outages=args.outage,
+                            model=model)
+    setupLogging(simulation.clock, args.verbose)
+    try:
+        for at, values in changes.items():
+            simulation.changeConfig(at, values)
+        for at, command in args.command:
+            simulation.sendCommand(at, command)
+        simulation.run(args.days * 86400)
+    finally:
+        simulation.close()
+    printSummary(simulation.summary(), time.monotonic() - wallStart)
+
+
+if __name__ == '__main__':
+    main()
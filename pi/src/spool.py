@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+
+# Durable store-and-forward spool for outgoing messages.
+
+import bisect
+import os
+import struct
+import time
+import zlib
+
+from logs import getLogger
+
+log = getLogger('spool')
+
+# record frame: payload length, sequence number, crc32 of the payload
+FRAME = struct.Struct('<IQI')
+SEGMENT_SUFFIX = '.seg'
+CURSOR_FILE = 'cursor'
+
+
+class Spool:
+    """Segmented append-only log of messages waiting for delivery. Each message gets a sequence number,
+    messages are delivered at least once and in order of their sequence numbers:
+    - append(payload): add a message (bytes) to the log
+    - readBatch(): return the next (seq, payload) pairs not yet handed out, bounded by count and bytes
+    - ack(seq): mark a message as delivered, acks may arrive out of order
+    - rewind(seq): hand out the unacknowledged messages from seq (default the first one) again
+    The log consists of segment files named after their first sequence number. Appends are fsync'ed in batches
+    (every fsyncEvery records or fsyncInterval sec., whatever comes first), so a crash loses at most one batch.
+    The lowest unacknowledged sequence number (the cursor) is persisted with the same policy, messages acked
+    after the last sync are delivered again after a crash. A torn record at the end of the log is truncated
+    on open. Segments below the cursor are deleted; if the spool exceeds maxBytes the oldest segment is dropped.
+    Not thread-safe, callers synchronize.
+    """
+
+    def __init__(self, directory, segmentBytes=1024 * 1024, maxBytes=64 * 1024 * 1024,
+                 fsyncEvery=50, fsyncInterval=5.0):
+        self.directory = directory
+        self.segmentBytes = segmentBytes
+        self.maxBytes = maxBytes
+        self.fsyncEvery = fsyncEvery
+        self.fsyncInterval = fsyncInterval
+        self.dropped = 0
+        os.makedirs(directory, exist_ok=True)
+
+        # first sequence numbers of the segment files, ascending
+        self.segments = sorted(int(name[:-len(SEGMENT_SUFFIX)]) for name in os.listdir(directory)
+                               if name.endswith(SEGMENT_SUFFIX))
+        self.cursor = self._readCursor()
+        self.acked = set()
+        self.nextSeq = self.cursor
+        self.writer = None
+        if self.segments:
+            self.nextSeq = max(self.nextSeq, self._recover(self.segments[-1]))
+            self.writer = open(self._segmentPath(self.segments[-1]), 'ab')
+        self.unsynced = 0
+        self.lastSync = time.time()
+        self.cursorDirty = False
+        # read position: next sequence number to hand out, open segment file
+        self.reader = None
+        self.readSeq = self.cursor
+        self._removeDelivered()
+
+    def __len__(self):
+        """Number of unacknowledged messages"""
+        return self.nextSeq - self.cursor - len(self.acked)
+
+    def _segmentPath(self, firstSeq):
+        return os.path.join(self.directory, '{:016d}{}'.format(firstSeq, SEGMENT_SUFFIX))
+
+    def _readCursor(self):
+        try:
+            with open(os.path.join(self.directory, CURSOR_FILE)) as f:
+                cursor = int(f.read().strip() or 0)
+        except (OSError, ValueError):
+            cursor = 0
+        if self.segments:
+            cursor = max(cursor, self.segments[0])
+        return cursor
+
+    def _writeCursor(self):
+        path = os.path.join(self.directory, CURSOR_FILE)
+        with open(path + '.tmp', 'w') as f:
+            f.write(str(self.cursor))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + '.tmp', path)
+        self.cursorDirty = False
+
+    def _recover(self, firstSeq):
+        """Validate the records of a segment, truncate a torn tail, return the next sequence number"""
+        path = self._segmentPath(firstSeq)
+        seq = firstSeq
+        valid = 0
+        with open(path, 'rb') as f:
+            for recordSeq, payload, end in self._records(f):
+                if payload is None:
+                    break
+                seq = recordSeq + 1
+                valid = end
+        if valid < os.path.getsize(path):
+            log.warning('Spool: truncating torn record in %s at offset %s', path, valid)
+            with open(path, 'r+b') as f:
+                f.truncate(valid)
+        return seq
+
+    def _records(self, f):
+        """Yield (seq, payload, end offset) of the records of an open segment file, payload None if corrupt"""
+        while True:
+            header = f.read(FRAME.size)
+            if len(header) == 0:
+                return
+            if len(header) < FRAME.size:
+                yield (None, None, f.tell())
+                return
+            length, seq, crc = FRAME.unpack(header)
+            payload = f.read(length)
+            if len(payload) < length or zlib.crc32(payload) != crc:
+                yield (None, None, f.tell())
+                return
+            yield (seq, payload, f.tell())
+
+    def append(self, payload):
+        """Append a message, return its sequence number"""
+        if self.writer is None or self.writer.tell() >= self.segmentBytes:
+            self._rollSegment()
+        seq = self.nextSeq
+        self.writer.write(FRAME.pack(len(payload), seq, zlib.crc32(payload)))
+        self.writer.write(payload)
+        self.nextSeq += 1
+        self.unsynced += 1
+        self.maybeSync()
+        return seq
+
+    def _rollSegment(self):
+        if self.writer is not None:
+            self.writer.flush()
+            os.fsync(self.writer.fileno())
+            self.writer.close()
+        self.segments.append(self.nextSeq)
+        self.writer = open(self._segmentPath(self.nextSeq), 'ab')
+        self._enforceMaxBytes()
+
+    def _enforceMaxBytes(self):
+        """Drop the oldest segments while the spool is larger than maxBytes"""
+        sizes = [os.path.getsize(self._segmentPath(s)) for s in self.segments]
+        while len(self.segments) > 1 and sum(sizes) > self.maxBytes:
+            dropTo = self.segments[1]
+            self.dropped += dropTo - max(self.cursor, self.segments[0])
+            log.warning('Spool: size limit reached, dropping messages %s to %s', self.segments[0], dropTo - 1)
+            os.remove(self._segmentPath(self.segments.pop(0)))
+            sizes.pop(0)
+            if self.cursor < dropTo:
+                self.cursor = dropTo
+                self.acked = set(s for s in self.acked if s >= dropTo)
+                self.cursorDirty = True
+            if self.readSeq < dropTo:
+                self.rewind()
+
+    def maybeSync(self):
+        """fsync appends and the cursor if the batch size or interval is reached"""
+        if self.unsynced >= self.fsyncEvery or time.time() - self.lastSync >= self.fsyncInterval:
+            self.sync()
+
+    def sync(self):
+        if self.writer is not None and self.unsynced > 0:
+            self.writer.flush()
+            os.fsync(self.writer.fileno())
+        if self.cursorDirty:
+            self._writeCursor()
+            self._removeDelivered()
+        self.unsynced = 0
+        self.lastSync = time.time()
+
+    def ack(self, seq):
+        """Mark a message as delivered"""
+        if seq < self.cursor:
+            return
+        self.acked.add(seq)
+        while self.cursor in self.acked:
+            self.acked.remove(self.cursor)
+            self.cursor += 1
+            self.cursorDirty = True
+
+    def skipTo(self, seq):
+        """Mark all messages before seq as delivered, eg. acknowledged according to a checkpoint written after the
+        cursor was persisted the last time"""
+        seq = min(seq, self.nextSeq)
+        if seq <= self.cursor:
+            return
+        self.acked = set(s for s in self.acked if s >= seq)
+        self.cursor = seq
+        self.cursorDirty = True
+        if self.readSeq < seq:
+            self._closeReader()
+            self.readSeq = seq
+
+    def _removeDelivered(self):
+        """Delete the segments whose messages are all acknowledged"""
+        while len(self.segments) > 1 and self.segments[1] <= self.cursor:
+            if self.reader is not None and self.reader[0] == self.segments[0]:
+                self._closeReader()
+            os.remove(self._segmentPath(self.segments.pop(0)))
+
+    def rewind(self, seq=None):
+        """Restart reading at seq, by default at the first unacknowledged message"""
+        self._closeReader()
+        self.readSeq = self.cursor if seq is None else max(self.cursor, min(seq, self.nextSeq))
+
+    def _closeReader(self):
+        if self.reader is not None:
+            self.reader[1].close()
+            self.reader = None
+
+    def pending(self):
+        """True if there are messages not yet handed out by readBatch"""
+        return self.readSeq < self.nextSeq
+
+    def readBatch(self, maxRecords=100, maxBytes=256 * 1024):
+        """Return up to maxRecords / maxBytes (at least one record) of (seq, payload) pairs not yet handed out"""
+        if not self.pending():
+            return []
+        # make appended records visible to the reader
+        self.writer.flush()
+        batch = []
+        size = 0
+        while self.readSeq < self.nextSeq and len(batch) < maxRecords and (not batch or size < maxBytes):
+            if self.reader is None:
+                self._openReader()
+            record = next(self.reader[2], None)
+            if record is None and self.reader[0] == self.segments[-1]:
+                # end of the segment in write, continue at the current position in case records were appended
+                self.reader = (self.reader[0], self.reader[1], self._records(self.reader[1]))
+                record = next(self.reader[2], None)
+                if record is None:
+                    break
+            elif record is None:
+                # end of segment, continue with the next one
+                self._closeReader()
+                continue
+            seq, payload, end = record
+            if payload is None:
+                break
+            if seq < self.readSeq:
+                continue
+            if seq not in self.acked:
+                batch.append((seq, payload))
+                size += len(payload)
+            self.readSeq = seq + 1
+        return batch
+
+    def _openReader(self):
+        """Open the segment containing readSeq"""
+        i = max(0, bisect.bisect_right(self.segments, self.readSeq) - 1)
+        f = open(self._segmentPath(self.segments[i]), 'rb')
+        self.reader = (self.segments[i], f, self._records(f))
+
+    def close(self):
+        self.sync()
+        self._closeReader()
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+
+# Read-only http server for dashboards on the LAN: current state and history rollups from the Pi, without a cloud
+# round trip. The responses are built once per new sample and served from memory with ETags.
+
+import datetime
+import http.server
+import json
+import os
+import threading
+import time
+import urllib.parse
+from collections import OrderedDict
+
+from clock import SystemClock
+from logs import getLogger
+from metrics import REGISTRY
+
+log = getLogger('lan')
+
+CONTENT_TYPE = 'application/json; charset=utf-8'
+RESOLUTIONS = ('minute', 'hour', 'day')
+# history responses kept, by resolution and number of days
+MAX_HISTORY_ENTRIES = 16
+MAX_HISTORY_DAYS = 3650
+
+
+def isoTime(timestamp):
+    """Epoch sec. as ISO 8601 UTC string, like the timestamps returned by BigQuery"""
+    utc = datetime.datetime.utcfromtimestamp(timestamp)
+    return utc.strftime('%Y-%m-%dT%H:%M:%S.') + '{:03d}Z'.format(utc.microsecond // 1000)
+
+
+class CachedResponse:
+    """Encoded body of a response with the data version it was built from"""
+
+    def __init__(self, version, built, etag, body):
+        self.version = version
+        self.built = built
+        self.etag = etag
+        self.body = body
+
+
+class ResponseCache:
+    """Responses by key, rebuilt when the data version changed. A response may be served up to 'maxAge' sec. after
+    a new sample (history rollups, which change a little with every sample). Used by the server thread only."""
+
+    def __init__(self, bootId, builds=None, monotonic=time.monotonic, maxEntries=MAX_HISTORY_ENTRIES):
+        self.bootId = bootId
+        # optional counter of the built responses
+        self.builds = builds
+        self.monotonic = monotonic
+        self.maxEntries = maxEntries
+        self.entries = OrderedDict()
+
+    def get(self, key, version, build, maxAge=0.0):
+        """Cached response of key, build() returns the json value if it has to be (re)built"""
+        entry = self.entries.get(key)
+        now = self.monotonic()
+        if entry is None or (entry.version != version and now - entry.built >= maxAge):
+            body = json.dumps(build(), separators=(',', ':')).encode('utf-8')
+            entry = CachedResponse(version, now, '"{}-{}"'.format(self.bootId, version), body)
+            self.entries[key] = entry
+            if self.builds is not None:
+                self.builds.inc()
+            if len(self.entries) > self.maxEntries:
+                self.entries.popitem(last=False)
+        return entry
+
+
+class StatusHandler(http.server.BaseHTTPRequestHandler):
+    """GET /status, /history?resolution=hour&days=7 and /getReportData (the rows of the cloud function)"""
+
+    # a slow client must not hold the single server thread
+    timeout = 5
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        try:
+            entry = self.server.status.response(url.path, query)
+        except ValueError as e:
+            self.sendError(400, str(e))
+            return
+        if entry is None:
+            if url.path in StatusServer.HISTORY_PATHS:
+                self.sendError(404, 'No history, history_dir is not configured')
+            else:
+                self.sendError(404, 'Not found')
+            return
+        if self.notModified(entry.etag):
+            self.send_response(304)
+            self.sendCommonHeaders(entry.etag)
+            self.end_headers()
+            self.server.status.countResponse(304)
+            return
+        self.send_response(200)
+        self.sendCommonHeaders(entry.etag)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(entry.body)))
+        self.end_headers()
+        self.wfile.write(entry.body)
+        self.server.status.countResponse(200)
+
+    def notModified(self, etag):
+        header = self.headers.get('If-None-Match')
+        if not header:
+            return False
+        tags = [tag.strip() for tag in header.split(',')]
+        return '*' in tags or etag in tags or 'W/' + etag in tags
+
+    def sendCommonHeaders(self, etag):
+        self.send_header('ETag', etag)
+        # revalidate on every refresh, a 304 is cheap
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Access-Control-Allow-Origin', '*')
+
+    def sendError(self, code, message):
+        body = json.dumps({'error': message}).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.status.countResponse(code)
+
+    def log_message(self, format, *args):
+        log.debug('%s %s', self.address_string(), format % args)
+
+
+class StatusHttpServer(http.server.HTTPServer):
+    """Single threaded: requests are answered from the cache, one after the other, so a burst of dashboard
+    refreshes costs one thread's time slices and never a thread per request next to the control loop"""
+    request_queue_size = 64
+
+    def service_actions(self):
+        # between requests, at most every poll interval: build the responses of new samples ahead of the requests
+        self.status.precompute()
+
+
+class StatusServer(threading.Thread):
+    """Serves the current state of the DataProvider and the history rollups of the TimeSeriesStore (if any) as json
+    on 'host':'port'. Each response is built at most once per sample (see DataProvider.current()), in the server
+    thread while it is idle or on the first request after a sample, and carries an ETag: conditional GETs
+    (If-None-Match) are answered with 304 Not Modified. History responses are rebuilt at most every
+    'historyRefresh' sec. The control loop is never blocked, reading the state takes no lock.
+    Daemon thread, stopped by close()"""
+
+    HISTORY_PATHS = ('/history', '/getReportData')
+
+    def __init__(self, dataProvider, store=None, host='0.0.0.0', port=8080, historyRefresh=10.0, clock=None,
+                 registry=None):
+        super(StatusServer, self).__init__(name='StatusServer')
+        self.daemon = True
+        self.dataProvider = dataProvider
+        self.store = store
+        self.historyRefresh = historyRefresh
+        self.clock = clock if clock is not None else SystemClock()
+        registry = registry if registry is not None else REGISTRY
+        self.responses = {}
+        for code in (200, 304, 400, 404):
+            self.responses[code] = registry.counter('wassermat_lan_responses_total', 'LAN status server responses',
+                                                    {'code': str(code)})
+        # ETags of a restarted server never match the ones of the previous process
+        self.cache = ResponseCache('{:x}{:x}'.format(int(time.time()), os.getpid()),
+                                   registry.counter('wassermat_lan_builds_total', 'LAN status responses built'))
+        self.server = StatusHttpServer((host, port), StatusHandler)
+        self.server.status = self
+        self.address = '{}:{}'.format(*self.server.server_address[:2])
+
+    def countResponse(self, code):
+        counter = self.responses.get(code)
+        if counter is not None:
+            counter.inc()
+
+    def response(self, path, query):
+        """Cached response of a path, None if there is none"""
+        version = self.dataProvider.current()[0]
+        if path in ('/', '/status'):
+            return self.cache.get('status', version, self.status)
+        if path not in self.HISTORY_PATHS or self.store is None:
+            return None
+        if path == '/getReportData':
+            return self.cache.get('report', version, self.report, self.historyRefresh)
+        resolution = query.get('resolution', ['hour'])[0]
+        if resolution not in RESOLUTIONS:
+            raise ValueError('resolution must be one of ' + ', '.join(RESOLUTIONS))
+        try:
+            days = float(query.get('days', ['7'])[0])
+        except ValueError:
+            raise ValueError('days must be a number')
+        if not 0 < days <= MAX_HISTORY_DAYS:
+            raise ValueError('days must be within 0 and {}'.format(MAX_HISTORY_DAYS))
+        return self.cache.get(('history', resolution, days), version,
+                              lambda: self.history(resolution, days), self.historyRefresh)
+
+    def precompute(self):
+        """Build the status and the report of a new sample"""
+        try:
+            self.response('/status', {})
+            self.response('/getReportData', {})
+        except Exception as e:
+            log.warning('Precomputing the responses failed: %s', e)
+
+    def status(self):
+        """Latest sample, with the field names of the device state in firebase"""
+        version, timestamp, humidity, pumpActive, lightActive, zones = self.dataProvider.current()
+        result = {'humidity': humidity, 'pumpActive': pumpActive, 'lightActive': lightActive,
+                  'lastTimestamp': isoTime(timestamp) if timestamp is not None else None}
+        if len(zones) > 1:
+            result['zones'] = [{'name': name, 'humidity': zoneHumidity, 'pumpActive': zonePump,
+                                'lightActive': zoneLight} for name, zoneHumidity, zonePump, zoneLight in zones]
+        return result
+
+    def history(self, resolution, days):
+        now = self.clock.time()
+        return [{'start': isoTime(bucket.start), 'count': bucket.count, 'avg': bucket.avg, 'min': bucket.min,
+                 'max': bucket.max, 'pump_ratio': bucket.pump_ratio, 'light_ratio': bucket.light_ratio}
+                for bucket in self.store.query(now - days * 86400, now + 1, resolution)]
+
+    def report(self):
+        """Hourly humidity of the last 7 days in the rows of the getReportData cloud function"""
+        now = self.clock.time()
+        return [{'date_hour': {'value': isoTime(bucket.start)}, 'avg_hum': bucket.avg, 'min_hum': bucket.min,
+                 'max_hum': bucket.max, 'data_points': bucket.count}
+                for bucket in self.store.query(now - 7 * 86400, now + 1, 'hour')]
+
+    def run(self):
+        log.info('Status served on %s', self.address)
+        self.server.serve_forever(poll_interval=1.0)
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
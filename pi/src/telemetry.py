@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+
+# Compact binary telemetry encoding, packs a batch of samples into one mqtt message.
+# The matching decoder for the cloud side is decodeTelemetry in functions/index.js.
+#
+# Version 1 layout (little endian):
+#   uint8   version (1), json payloads start with '{' instead
+#   uint32  timestamp of the first sample (epoch sec.)
+#   uint16  number of samples n
+#   varint  n-1 timestamp deltas to the previous sample in sec. (unsigned LEB128)
+#   uint8   n humidity values in % (0-100)
+#   uint8   ceil(n/4) flag bytes, 2 bits per sample: bit 2i = pump active, bit 2i+1 = light active
+
+import struct
+
+VERSION = 1
+HEADER = struct.Struct('<BIH')
+MAX_SAMPLES = 0xffff
+
+
+def encode(samples):
+    """Encode a list of (timestamp, humidity, pumpActive, lightActive) samples, timestamps ascending"""
+    if len(samples) == 0 or len(samples) > MAX_SAMPLES:
+        raise ValueError('Batch must contain 1 to {} samples, got {}'.format(MAX_SAMPLES, len(samples)))
+    first = int(samples[0][0])
+    out = bytearray(HEADER.pack(VERSION, first, len(samples)))
+
+    previous = first
+    for sample in samples[1:]:
+        timestamp = int(sample[0])
+        delta = timestamp - previous
+        if delta < 0:
+            raise ValueError('Sample timestamps must be ascending')
+        previous = timestamp
+        # unsigned LEB128
+        while delta >= 0x80:
+            out.append((delta & 0x7f) | 0x80)
+            delta >>= 7
+        out.append(delta)
+
+    for sample in samples:
+        out.append(max(0, min(100, int(round(sample[1])))))
+
+    flags = bytearray((len(samples) + 3) // 4)
+    for i, sample in enumerate(samples):
+        if sample[2]:
+            flags[i // 4] |= 1 << (2 * (i % 4))
+        if sample[3]:
+            flags[i // 4] |= 2 << (2 * (i % 4))
+    out.extend(flags)
+    return bytes(out)
+
+
+def decode(payload):
+    """Decode a binary batch into a list of (timestamp, humidity, pumpActive, lightActive) samples"""
+    version, timestamp, count = HEADER.unpack_from(payload, 0)
+    if version != VERSION:
+        raise ValueError('Unsupported telemetry version {}'.format(version))
+    pos = HEADER.size
+    timestamps = [timestamp]
+    for i in range(count - 1):
+        delta = 0
+        shift = 0
+        while True:
+            byte = payload[pos]
+            pos += 1
+            delta |= (byte & 0x7f) << shift
+            shift += 7
+            if byte < 0x80:
+                break
+        timestamp += delta
+        timestamps.append(timestamp)
+    humidity = payload[pos:pos + count]
+    pos += count
+    samples = []
+    for i in range(count):
+        flags = payload[pos + i // 4] >> (2 * (i % 4))
+        samples.append((timestamps[i], humidity[i], bool(flags & 1), bool(flags & 2)))
+    return samples
+
+
+class TelemetryBatcher:
+    """Collects samples until 'batchSize' samples are collected or the first sample is older than
+    'batchSeconds', then returns them encoded as one binary message."""
+
+    def __init__(self, batchSize, batchSeconds):
+        self.batchSize = min(batchSize, MAX_SAMPLES)
+        self.batchSeconds = batchSeconds
+        self.samples = []
+
+    def add(self, timestamp, humidity, pumpActive, lightActive):
+        """Add a sample, return the encoded batch if it is complete, None otherwise"""
+        self.samples.append((timestamp, humidity, pumpActive, lightActive))
+        if len(self.samples) >= self.batchSize or timestamp - self.samples[0][0] >= self.batchSeconds:
+            return self.flush()
+        return None
+
+    def flush(self):
+        """Return the collected samples encoded, None if there are none"""
+        if not self.samples:
+            return None
+        payload = encode(self.samples)
+        self.samples = []
+        return payload
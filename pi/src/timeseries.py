@@ -0,0 +1,293 @@
+#!/usr/bin/env python3
+
+# On-device time series store: every sample is appended to a memory mapped file of fixed width records,
+# 1 minute, 1 hour and 1 day rollups are maintained as samples arrive.
+
+import collections
+import mmap
+import os
+import queue
+import struct
+import threading
+import time
+
+from logs import getLogger
+
+log = getLogger('history')
+
+# file header: magic, record size, index of the first live record, number of records (incl. expired ones)
+HEADER = struct.Struct('<8sIQQ4x')
+MAGIC = b'WMTS0001'
+# raw sample: timestamp (epoch sec.), humidity %, pump active, light active
+SAMPLE_RECORD = struct.Struct('<dfBB2x')
+# rollup bucket: bucket start (epoch sec.), sample count, humidity sum/min/max, pump/light active sample counts
+BUCKET_RECORD = struct.Struct('<dIdffII')
+# file growth in records
+GROW_RECORDS = 4096
+
+Sample = collections.namedtuple('Sample', ['timestamp', 'humidity', 'pump_active', 'light_active'])
+Bucket = collections.namedtuple('Bucket', ['start', 'count', 'avg', 'min', 'max', 'pump_ratio', 'light_ratio'])
+
+# rollup resolutions in sec., buckets are aligned to the epoch (UTC)
+RESOLUTIONS = collections.OrderedDict([('minute', 60), ('hour', 3600), ('day', 86400)])
+# default retention in days per resolution
+DEFAULT_RETENTION = {'raw': 7, 'minute': 30, 'hour': 365, 'day': 3650}
+
+
+class RecordFile:
+    """Append-only file of fixed width records, memory mapped. Records must be appended in timestamp order
+    (the timestamp is the first field), which makes the file its own time index: range lookups are binary
+    searches over the mapped records. Expired records are skipped by moving the head index, the file is
+    compacted once more than half of it is expired. Not thread-safe, callers synchronize."""
+
+    def __init__(self, path, recordStruct):
+        self.path = path
+        self.record = recordStruct
+        if not os.path.exists(path):
+            self._create(path, 0, b'')
+        self._open()
+
+    def _create(self, path, count, records):
+        """Write a new file with the given packed records, atomically replacing path"""
+        capacity = max(GROW_RECORDS, count + GROW_RECORDS)
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, self.record.size, 0, count))
+            f.write(records)
+            f.truncate(HEADER.size + capacity * self.record.size)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+
+    def _open(self):
+        self.file = open(self.path, 'r+b')
+        self.map = mmap.mmap(self.file.fileno(), 0)
+        magic, size, self.head, self.count = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC or size != self.record.size:
+            raise ValueError('"{}" is not a time series file with {} byte records'.format(self.path, self.record.size))
+        self.capacity = (len(self.map) - HEADER.size) // self.record.size
+
+    def close(self):
+        self.map.flush()
+        self.map.close()
+        self.file.close()
+
+    def flush(self):
+        """Write dirty pages to disk"""
+        self.map.flush()
+
+    def _writeHeader(self):
+        HEADER.pack_into(self.map, 0, MAGIC, self.record.size, self.head, self.count)
+
+    def __len__(self):
+        return self.count - self.head
+
+    def __getitem__(self, i):
+        """Return the i-th live record as tuple"""
+        return self.record.unpack_from(self.map, HEADER.size + (self.head + i) * self.record.size)
+
+    def timestamp(self, i):
+        """Return the timestamp of the i-th live record"""
+        return struct.unpack_from('<d', self.map, HEADER.size + (self.head + i) * self.record.size)[0]
+
+    def last(self):
+        """Return the newest record or None"""
+        return self[len(self) - 1] if len(self) > 0 else None
+
+    def append(self, *values):
+        if self.count == self.capacity:
+            self._grow()
+        self.record.pack_into(self.map, HEADER.size + self.count * self.record.size, *values)
+        # the record is written before the count is published
+        self.count += 1
+        self._writeHeader()
+
+    def _grow(self):
+        self.map.flush()
+        self.map.close()
+        self.capacity += GROW_RECORDS
+        self.file.truncate(HEADER.size + self.capacity * self.record.size)
+        self.map = mmap.mmap(self.file.fileno(), 0)
+
+    def bisect(self, timestamp):
+        """Return the index of the first live record with a timestamp >= timestamp, O(log n)"""
+        lo, hi = 0, len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.timestamp(mid) < timestamp:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def range(self, start, end):
+        """Return the records with start <= timestamp < end"""
+        first = self.bisect(start)
+        last = self.bisect(end)
+        return [self[i] for i in range(first, last)]
+
+    def expire(self, before):
+        """Drop all records older than before"""
+        expired = self.bisect(before)
+        if expired == 0:
+            return
+        self.head += expired
+        self._writeHeader()
+        if self.head > len(self):
+            self._compact()
+
+    def _compact(self):
+        """Rewrite the file with the live records only"""
+        start = HEADER.size + self.head * self.record.size
+        records = self.map[start:HEADER.size + self.count * self.record.size]
+        count = self.count - self.head
+        self.close()
+        self._create(self.path, count, records)
+        self._open()
+
+
+class Rollup:
+    """Aggregates samples into epoch aligned buckets of a fixed resolution and appends each completed bucket
+    to its record file. The bucket in progress is kept in memory."""
+
+    def __init__(self, path, resolution):
+        self.resolution = resolution
+        self.file = RecordFile(path, BUCKET_RECORD)
+        self.current = None
+
+    def nextStart(self):
+        """Start of the first bucket not yet written to the file"""
+        last = self.file.last()
+        return 0 if last is None else last[0] + self.resolution
+
+    def add(self, timestamp, humidity, pumpActive, lightActive):
+        start = timestamp - timestamp % self.resolution
+        if self.current is not None and self.current[0] != start:
+            self.file.append(*self.current)
+            self.current = None
+        if self.current is None:
+            self.current = [start, 0, 0.0, humidity, humidity, 0, 0]
+        bucket = self.current
+        bucket[1] += 1
+        bucket[2] += humidity
+        if humidity < bucket[3]:
+            bucket[3] = humidity
+        if humidity > bucket[4]:
+            bucket[4] = humidity
+        bucket[5] += pumpActive
+        bucket[6] += lightActive
+
+    def range(self, start, end):
+        """Return the buckets starting within [start, end), incl. the one in progress"""
+        records = self.file.range(start, end)
+        if self.current is not None and start <= self.current[0] < end:
+            records.append(tuple(self.current))
+        return [toBucket(r) for r in records]
+
+
+def toBucket(record):
+    start, count, total, minimum, maximum, pumpCount, lightCount = record
+    return Bucket(start, count, total / count, minimum, maximum, pumpCount / count, lightCount / count)
+
+
+class TimeSeriesStore(threading.Thread):
+    """Persists every sample in <directory>/raw.ts and maintains the minute.ts, hour.ts and day.ts rollups.
+    record() only enqueues the sample, a background thread appends it, so the caller never waits for disk I/O.
+    If the queue is full (disk stalled) samples are dropped and counted in 'dropped'.
+    Timestamps must not go backwards, samples older than the newest one are stored with the newest timestamp.
+    Retention is given in days per resolution ('raw', 'minute', 'hour', 'day').
+    The buckets in progress are rebuilt from the raw samples by the thread on start (see _restoreRollups), not by
+    the constructor, the control loop does not wait for the replay.
+    """
+
+    def __init__(self, directory, stopEvent, retention=None, flushInterval=30, queueSize=4096):
+        super(TimeSeriesStore, self).__init__()
+        self.stopEvent = stopEvent
+        self.retention = dict(DEFAULT_RETENTION)
+        self.retention.update(retention or {})
+        self.flushInterval = flushInterval
+        self.queue = queue.Queue(queueSize)
+        self.dropped = 0
+        # guards the files against concurrent queries
+        self.lock = threading.Lock()
+
+        os.makedirs(directory, exist_ok=True)
+        self.raw = RecordFile(os.path.join(directory, 'raw.ts'), SAMPLE_RECORD)
+        self.rollups = collections.OrderedDict()
+        for name, resolution in RESOLUTIONS.items():
+            self.rollups[name] = Rollup(os.path.join(directory, name + '.ts'), resolution)
+        last = self.raw.last()
+        self.lastTimestamp = 0 if last is None else last[0]
+
+    def _restoreRollups(self):
+        """Rebuild the in-progress buckets from the raw samples after the last written bucket"""
+        with self.lock:
+            for rollup in self.rollups.values():
+                first = self.raw.bisect(rollup.nextStart())
+                for i in range(first, len(self.raw)):
+                    timestamp, humidity, pumpActive, lightActive = self.raw[i]
+                    rollup.add(timestamp, humidity, pumpActive, lightActive)
+
+    def record(self, timestamp, humidity, pumpActive, lightActive):
+        """Enqueue a sample, never blocks"""
+        try:
+            self.queue.put_nowait((timestamp, humidity, pumpActive, lightActive))
+        except queue.Full:
+            self.dropped += 1
+
+    def append(self, timestamp, humidity, pumpActive, lightActive):
+        """Write a sample to the raw file and the rollups"""
+        with self.lock:
+            timestamp = max(timestamp, self.lastTimestamp)
+            self.lastTimestamp = timestamp
+            pumpActive = int(bool(pumpActive))
+            lightActive = int(bool(lightActive))
+            self.raw.append(timestamp, humidity, pumpActive, lightActive)
+            for rollup in self.rollups.values():
+                rollup.add(timestamp, humidity, pumpActive, lightActive)
+
+    def query(self, start, end, resolution='raw'):
+        """Return the samples (resolution 'raw') or buckets ('minute', 'hour', 'day') within [start, end)"""
+        with self.lock:
+            if resolution == 'raw':
+                return [Sample(t, h, bool(p), bool(l)) for t, h, p, l in self.raw.range(start, end)]
+            if resolution not in self.rollups:
+                raise ValueError('Unknown resolution "{}"'.format(resolution))
+            return self.rollups[resolution].range(start, end)
+
+    def applyRetention(self, now):
+        """Expire records older than the configured retention"""
+        with self.lock:
+            self.raw.expire(now - self.retention['raw'] * 86400)
+            for name, rollup in self.rollups.items():
+                rollup.file.expire(now - self.retention[name] * 86400)
+
+    def flush(self):
+        with self.lock:
+            self.raw.flush()
+            for rollup in self.rollups.values():
+                rollup.file.flush()
+
+    def close(self):
+        with self.lock:
+            self.raw.close()
+            for rollup in self.rollups.values():
+                rollup.file.close()
+
+    def run(self):
+        log.info('TimeSeriesStore starting')
+        # samples recorded meanwhile wait in the queue
+        self._restoreRollups()
+        nextFlush = time.time() + self.flushInterval
+        self.applyRetention(time.time())
+        while (not self.stopEvent.is_set() or not self.queue.empty()):
+            try:
+                self.append(*self.queue.get(timeout=1))
+            except queue.Empty:
+                pass
+            if time.time() > nextFlush:
+                self.flush()
+                self.applyRetention(time.time())
+                nextFlush = time.time() + self.flushInterval
+        self.close()
+        log.info('TimeSeriesStore stopped')
@@ -9,36 +9,90 @@ from providers import DataProvider
 from providers import ConfigurationProvider
 from gcp_iot_client import GcpIotClient
 from device_control import DeviceControl
+from commands import CommandDispatcher
+from components import createCheckpoint, createStore, startMetricsServer, startStatusServer
+from logs import getLogger, setupLogging
 
 CONFIG_FILE = '../resources/wassermat.json'
 
+log = getLogger('main')
+
 threads = []
 stopEvent = threading.Event()
-configuration = ConfigurationProvider(CONFIG_FILE)
-data = DataProvider()
+
 
 def quit_gracefully(signum, frame):
-    print('quit_gracefully called')
+    log.info('quit_gracefully called')
     stopEvent.set()
 
-signal.signal(signal.SIGINT, quit_gracefully)
-signal.signal(signal.SIGTERM, quit_gracefully)
 
 def main():
+    # only the config is read before the first tick, hardware, crypto and mqtt are set up by their threads
+    configuration = ConfigurationProvider(CONFIG_FILE)
+
+    # everything is logged through the background writer from here on
+    logWriter = setupLogging(configuration)
+
+    signal.signal(signal.SIGINT, quit_gracefully)
+    signal.signal(signal.SIGTERM, quit_gracefully)
+
+    if configuration.getParam('execution_mode') == 'processes':
+        # sampler and publisher in child processes, this one supervises them
+        from processes import Supervisor
+        Supervisor(CONFIG_FILE, configuration, stopEvent).run()
+        log.info('Exiting Main Thread')
+        logWriter.close()
+        return
+
+    if configuration.getParam('execution_mode') == 'asyncio':
+        # control loop and mqtt client as tasks of one event loop, it handles the signals itself
+        from eventloop import run
+        run(configuration, stopEvent)
+        log.info('Exiting Main Thread')
+        logWriter.close()
+        return
 
-    thread1 = DeviceControl(data, configuration, stopEvent)
+    checkpoint = createCheckpoint(configuration, stopEvent)
+    store = createStore(configuration, stopEvent)
+    data = DataProvider(configuration.getParam('data_buffer_size'), store)
+
+    # the control loop first, the pumps must not wait for the cloud connection
+    thread1 = DeviceControl(data, configuration, stopEvent, checkpoint=checkpoint)
     thread1.start()
     threads.append(thread1)
 
-    thread2 = GcpIotClient(data, configuration, stopEvent)
+    commands = CommandDispatcher()
+    commands.forward(thread1)
+    thread2 = GcpIotClient(data, configuration, stopEvent, checkpoint=checkpoint, commands=commands)
     thread2.start()
     threads.append(thread2)
 
+    if store is not None:
+        store.start()
+        threads.append(store)
+
+    if checkpoint is not None:
+        checkpoint.start()
+        threads.append(checkpoint)
+
+    metricsServer = startMetricsServer(configuration)
+    statusServer = startStatusServer(configuration, data, store)
+
     # Wait for all threads to complete
     for t in threads:
         t.join()
 
-    print ("Exiting Main Thread")
+    if checkpoint is not None:
+        # final state, after the pumps are off and the last batch is spooled
+        checkpoint.save()
+
+    if metricsServer is not None:
+        metricsServer.close()
+    if statusServer is not None:
+        statusServer.close()
+
+    log.info('Exiting Main Thread')
+    logWriter.close()
 
 
 if __name__ == '__main__':
@@ -20,7 +20,8 @@
 cd /home/pi/wassermat/pi
 source env/bin/activate
 cd src
-# logging: journalctl -u wassermat -b
-PYTHONUNBUFFERED="true" ./wassermat.py >> ../../wassermat.log 2>&1
+# logging: the application writes wassermat.log itself (config value log_file), in batches and rotated by size,
+# startup errors and tracebacks: journalctl -u wassermat -b
+./wassermat.py
 
 